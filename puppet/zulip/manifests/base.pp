@@ -78,6 +78,7 @@ class zulip::base {
     'error_reports',
     'feedback_messages',
     'invites',
+    'message_fanout',
     'missedmessage_email_senders',
     'email_senders',
     'missedmessage_emails',
@@ -1,6 +1,6 @@
 from typing import (
     AbstractSet, Any, Callable, Dict, Iterable, List, Mapping, MutableMapping,
-    Optional, Sequence, Set, Tuple, Union, cast
+    Iterator, Optional, Sequence, Set, Tuple, Union, cast
 )
 from typing_extensions import TypedDict
 
@@ -30,7 +30,12 @@ from zerver.lib.bot_config import (
 from zerver.lib.cache import (
     bot_dict_fields,
     display_recipient_cache_key,
+    delete_stream_subscriber_rows_cache,
     delete_user_profile_caches,
+    flush_realm_search_results,
+    flush_realm_unread_summaries,
+    flush_unread_summaries,
+    flush_user_search_results,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
 )
@@ -44,6 +49,7 @@ from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.message import (
     access_message,
     MessageDict,
+    remove_read_messages_from_unread_summary,
     render_markdown,
     update_first_visible_message_id,
 )
@@ -57,9 +63,12 @@ from zerver.lib.stream_subscription import (
     get_active_subscriptions_for_stream_id,
     get_active_subscriptions_for_stream_ids,
     get_bulk_stream_subscriber_info,
+    get_stream_subscriber_rows,
     get_stream_subscriptions_for_user,
     get_stream_subscriptions_for_users,
     num_subscribers_for_stream_id,
+    STREAM_EMAIL_NOTIFY,
+    STREAM_PUSH_NOTIFY,
 )
 from zerver.lib.stream_topic import StreamTopicTarget
 from zerver.lib.topic import (
@@ -112,7 +121,6 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     get_user_including_cross_realm, get_user_by_id_in_realm_including_cross_realm, \
     get_stream_by_id_in_realm
 
-from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.avatar import avatar_url, avatar_url_from_dict
 from zerver.lib.stream_recipient import StreamRecipientMap
 from zerver.lib.validator import check_widget_content
@@ -160,11 +168,15 @@ if settings.BILLING_ENABLED:
 import ujson
 import time
 import datetime
+import io
 import os
 import platform
 import logging
 import itertools
+import threading
+from array import array
 from collections import defaultdict
+from contextlib import contextmanager
 from operator import itemgetter
 
 # This will be used to type annotate parameters in a function if the function
@@ -356,18 +368,6 @@ def process_new_human_user(user_profile: UserProfile,
 
     add_new_user_history(user_profile, streams)
 
-    # mit_beta_users don't have a referred_by field
-    if not mit_beta_user and prereg_user is not None and prereg_user.referred_by is not None:
-        # This is a cross-realm private message.
-        internal_send_private_message(
-            user_profile.realm,
-            get_system_bot(settings.NOTIFICATION_BOT),
-            prereg_user.referred_by,
-            "%s <`%s`> accepted your invitation to join Zulip!" % (
-                user_profile.full_name,
-                user_profile.email,
-            )
-        )
     # Mark any other PreregistrationUsers that are STATUS_ACTIVE as
     # inactive so we can keep track of the PreregistrationUser we
     # actually used for analytics
@@ -379,17 +379,34 @@ def process_new_human_user(user_profile: UserProfile,
     else:
         PreregistrationUser.objects.filter(email__iexact=user_profile.delivery_email).update(status=0)
 
-    notify_new_user(user_profile)
     # Clear any scheduled invitation emails to prevent them
     # from being sent after the user is created.
     clear_scheduled_invitation_emails(user_profile.delivery_email)
     if user_profile.realm.send_welcome_emails:
         enqueue_welcome_emails(user_profile, realm_creation)
 
-    # We have an import loop here; it's intentional, because we want
-    # to keep all the onboarding code in zerver/lib/onboarding.py.
-    from zerver.lib.onboarding import send_initial_pms
-    send_initial_pms(user_profile)
+    # Send all of the notification bot and welcome bot messages for
+    # the new user with a single do_send_messages call.
+    with batch_internal_messages():
+        # mit_beta_users don't have a referred_by field
+        if not mit_beta_user and prereg_user is not None and prereg_user.referred_by is not None:
+            # This is a cross-realm private message.
+            internal_send_private_message(
+                user_profile.realm,
+                get_system_bot(settings.NOTIFICATION_BOT),
+                prereg_user.referred_by,
+                "%s <`%s`> accepted your invitation to join Zulip!" % (
+                    user_profile.full_name,
+                    user_profile.email,
+                )
+            )
+
+        notify_new_user(user_profile)
+
+        # We have an import loop here; it's intentional, because we want
+        # to keep all the onboarding code in zerver/lib/onboarding.py.
+        from zerver.lib.onboarding import send_initial_pms
+        send_initial_pms(user_profile)
 
     if newsletter_data is not None:
         # If the user was created automatically via the API, we may
@@ -772,6 +789,7 @@ def do_deactivate_stream(stream: Stream, log: bool=True) -> None:
     affected_user_ids = can_access_stream_user_ids(stream)
 
     get_active_subscriptions_for_stream_id(stream.id).update(active=False)
+    delete_stream_subscriber_rows_cache([get_stream_recipient(stream.id).id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -903,17 +921,20 @@ def render_incoming_message(message: Message,
                             user_ids: Set[int],
                             realm: Realm,
                             mention_data: Optional[bugdown.MentionData]=None,
-                            email_gateway: Optional[bool]=False) -> str:
-    realm_alert_words_automaton = get_alert_word_automaton(realm)
+                            email_gateway: Optional[bool]=False,
+                            render_context: Optional[bugdown.RealmRenderContext]=None) -> str:
+    if render_context is None:
+        render_context = bugdown.get_realm_render_context(realm)
     try:
         rendered_content = render_markdown(
             message=message,
             content=content,
             realm=realm,
-            realm_alert_words_automaton = realm_alert_words_automaton,
+            realm_alert_words_automaton = render_context.realm_alert_words_automaton,
             user_ids=user_ids,
             mention_data=mention_data,
             email_gateway=email_gateway,
+            render_context=render_context,
         )
     except BugdownRenderingException:
         raise JsonableError(_('Unable to render message'))
@@ -954,10 +975,31 @@ RecipientInfoResult = TypedDict('RecipientInfoResult', {
     'service_bot_tuples': List[Tuple[int, int]],
 })
 
+RecipientInfoTarget = TypedDict('RecipientInfoTarget', {
+    'recipient': Recipient,
+    'sender_id': int,
+    'stream_topic': Optional[StreamTopicTarget],
+    'possibly_mentioned_user_ids': Optional[Set[int]],
+})
+
 def get_recipient_info(recipient: Recipient,
                        sender_id: int,
                        stream_topic: Optional[StreamTopicTarget],
                        possibly_mentioned_user_ids: Optional[Set[int]]=None) -> RecipientInfoResult:
+    target = dict(
+        recipient=recipient,
+        sender_id=sender_id,
+        stream_topic=stream_topic,
+        possibly_mentioned_user_ids=possibly_mentioned_user_ids,
+    )  # type: RecipientInfoTarget
+    return bulk_get_recipient_info([target])[0]
+
+def get_message_to_user_ids(recipient: Recipient, sender_id: int,
+                            stream_topic: Optional[StreamTopicTarget]
+                            ) -> Tuple[List[int], Set[int], Set[int]]:
+    """Returns the ids of the users a message is addressed to, and for
+    stream messages, those of them with stream push and email
+    notifications enabled for it."""
     stream_push_user_ids = set()  # type: Set[int]
     stream_email_user_ids = set()  # type: Set[int]
 
@@ -973,47 +1015,21 @@ def get_recipient_info(recipient: Recipient,
         # of this function for different message types.
         assert(stream_topic is not None)
 
-        subscription_rows = stream_topic.get_active_subscriptions().annotate(
-            user_profile_email_notifications=F('user_profile__enable_stream_email_notifications'),
-            user_profile_push_notifications=F('user_profile__enable_stream_push_notifications'),
-        ).values(
-            'user_profile_id',
-            'push_notifications',
-            'email_notifications',
-            'user_profile_email_notifications',
-            'user_profile_push_notifications',
-            'is_muted',
-        ).order_by('user_profile_id')
-
-        message_to_user_ids = [
-            row['user_profile_id']
-            for row in subscription_rows
-        ]
-
-        def should_send(setting: str, row: Dict[str, Any]) -> bool:
-            # This implements the structure that the UserProfile stream notification settings
-            # are defaults, which can be overridden by the stream-level settings (if those
-            # values are not null).
-            if row['is_muted']:
-                return False
-            if row[setting] is not None:
-                return row[setting]
-            return row['user_profile_' + setting]
+        (subscriber_ids, subscriber_flags) = get_stream_subscriber_rows(recipient.id)
+        message_to_user_ids = list(subscriber_ids)
 
         user_ids_muting_topic = stream_topic.user_ids_muting_topic()
 
         stream_push_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_push_notify
-            if should_send('push_notifications', row)
+            user_id
+            for (user_id, flags) in zip(subscriber_ids, subscriber_flags)
+            if flags & STREAM_PUSH_NOTIFY
         } - user_ids_muting_topic
 
         stream_email_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_email_notify
-            if should_send('email_notifications', row)
+            user_id
+            for (user_id, flags) in zip(subscriber_ids, subscriber_flags)
+            if flags & STREAM_EMAIL_NOTIFY
         } - user_ids_muting_topic
 
     elif recipient.type == Recipient.HUDDLE:
@@ -1022,46 +1038,97 @@ def get_recipient_info(recipient: Recipient,
     else:
         raise ValueError('Bad recipient type')
 
-    message_to_user_id_set = set(message_to_user_ids)
-
-    user_ids = set(message_to_user_id_set)
-    if possibly_mentioned_user_ids:
-        # Important note: Because we haven't rendered bugdown yet, we
-        # don't yet know which of these possibly-mentioned users was
-        # actually mentioned in the message (in other words, the
-        # mention syntax might have been in a code block or otherwise
-        # escaped).  `get_ids_for` will filter these extra user rows
-        # for our data structures not related to bots
-        user_ids |= possibly_mentioned_user_ids
-
-    if user_ids:
-        query = UserProfile.objects.filter(
-            is_active=True,
-        ).values(
-            'id',
-            'enable_online_push_notifications',
-            'is_bot',
-            'bot_type',
-            'long_term_idle',
-        )
+    return (message_to_user_ids, stream_push_user_ids, stream_email_user_ids)
+
+def bulk_get_recipient_info(targets: Sequence[RecipientInfoTarget]) -> List[RecipientInfoResult]:
+    """Computes get_recipient_info for each of a list of messages.
+
+    Messages are grouped by recipient and topic (the sender too, for
+    personal messages), and the subscription and user rows are only
+    queried once for each group; so e.g. sending hundreds of messages
+    to the same stream and topic takes a constant number of queries."""
+    groups = {}  # type: Dict[Tuple[Any, ...], List[int]]
+    for (i, target) in enumerate(targets):
+        recipient = target['recipient']
+        if recipient.type == Recipient.PERSONAL:
+            key = (recipient.id, target['sender_id'])  # type: Tuple[Any, ...]
+        elif recipient.type == Recipient.STREAM:
+            stream_topic = target['stream_topic']
+            assert(stream_topic is not None)
+            # Topic mutes are case-insensitive; see user_ids_muting_topic.
+            key = (recipient.id, stream_topic.topic_name.lower())
+        else:
+            key = (recipient.id,)
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * len(targets)  # type: List[Optional[RecipientInfoResult]]
+    for indexes in groups.values():
+        first = targets[indexes[0]]
+        (message_to_user_ids, stream_push_user_ids, stream_email_user_ids) = \
+            get_message_to_user_ids(first['recipient'], first['sender_id'],
+                                    first['stream_topic'])
+        message_to_user_id_set = set(message_to_user_ids)
+
+        group_user_ids = set(message_to_user_id_set)
+        for i in indexes:
+            possibly_mentioned_user_ids = targets[i]['possibly_mentioned_user_ids']
+            if possibly_mentioned_user_ids:
+                group_user_ids |= possibly_mentioned_user_ids
+
+        if group_user_ids:
+            query = UserProfile.objects.filter(
+                is_active=True,
+            ).values(
+                'id',
+                'enable_online_push_notifications',
+                'is_bot',
+                'bot_type',
+                'long_term_idle',
+            )
 
-        # query_for_ids is fast highly optimized for large queries, and we
-        # need this codepath to be fast (it's part of sending messages)
-        query = query_for_ids(
-            query=query,
-            user_ids=sorted(list(user_ids)),
-            field='id'
-        )
-        rows = list(query)
-    else:
-        # TODO: We should always have at least one user_id as a recipient
-        #       of any message we send.  Right now the exception to this
-        #       rule is `notify_new_user`, which, at least in a possibly
-        #       contrived test scenario, can attempt to send messages
-        #       to an inactive bot.  When we plug that hole, we can avoid
-        #       this `else` clause and just `assert(user_ids)`.
-        rows = []
+            # query_for_ids is fast highly optimized for large queries, and we
+            # need this codepath to be fast (it's part of sending messages)
+            query = query_for_ids(
+                query=query,
+                user_ids=sorted(list(group_user_ids)),
+                field='id'
+            )
+            group_rows = list(query)
+        else:
+            # TODO: We should always have at least one user_id as a recipient
+            #       of any message we send.  Right now the exception to this
+            #       rule is `notify_new_user`, which, at least in a possibly
+            #       contrived test scenario, can attempt to send messages
+            #       to an inactive bot.  When we plug that hole, we can avoid
+            #       this `else` clause and just `assert(user_ids)`.
+            group_rows = []
+
+        for i in indexes:
+            possibly_mentioned_user_ids = targets[i]['possibly_mentioned_user_ids']
+            if possibly_mentioned_user_ids:
+                # Important note: Because we haven't rendered bugdown yet, we
+                # don't yet know which of these possibly-mentioned users was
+                # actually mentioned in the message (in other words, the
+                # mention syntax might have been in a code block or otherwise
+                # escaped).  `get_ids_for` will filter these extra user rows
+                # for our data structures not related to bots
+                user_ids = message_to_user_id_set | possibly_mentioned_user_ids
+                rows = [row for row in group_rows if row['id'] in user_ids]
+            else:
+                rows = [row for row in group_rows if row['id'] in message_to_user_id_set]
 
+            # Callers modify the returned sets, so each message gets
+            # its own copies.
+            results[i] = get_recipient_info_from_rows(
+                rows, message_to_user_id_set,
+                set(stream_push_user_ids), set(stream_email_user_ids))
+
+    return cast(List[RecipientInfoResult], results)
+
+def get_recipient_info_from_rows(rows: List[Dict[str, Any]],
+                                 message_to_user_id_set: Set[int],
+                                 stream_push_user_ids: Set[int],
+                                 stream_email_user_ids: Set[int]) -> RecipientInfoResult:
     def get_ids_for(f: Callable[[Dict[str, Any]], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
         return {
@@ -1227,6 +1294,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     messages = new_messages
 
     links_for_embed = set()  # type: Set[str]
+    recipient_info_targets = []  # type: List[RecipientInfoTarget]
     # For consistency, changes to the default values for these gets should also be applied
     # to the default args in do_send_message
     for message in messages:
@@ -1251,13 +1319,21 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         else:
             stream_topic = None
 
-        info = get_recipient_info(
+        recipient_info_targets.append(dict(
             recipient=message['message'].recipient,
             sender_id=message['message'].sender_id,
             stream_topic=stream_topic,
             possibly_mentioned_user_ids=mention_data.get_user_ids(),
-        )
+        ))
+
+    # Messages to the same recipient (e.g. from internal_send_* helpers
+    # or imports) share their subscription and user queries.
+    recipient_infos = bulk_get_recipient_info(recipient_info_targets)
 
+    # Messages in a batch are usually all to the same realm, so they
+    # share the realm's render context.
+    render_contexts = {}  # type: Dict[int, bugdown.RealmRenderContext]
+    for (message, info) in zip(messages, recipient_infos):
         message['active_user_ids'] = info['active_user_ids']
         message['push_notify_user_ids'] = info['push_notify_user_ids']
         message['stream_push_user_ids'] = info['stream_push_user_ids']
@@ -1270,6 +1346,8 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         # Render our messages.
         assert message['message'].rendered_content is None
 
+        if message['realm'].id not in render_contexts:
+            render_contexts[message['realm'].id] = bugdown.get_realm_render_context(message['realm'])
         rendered_content = render_incoming_message(
             message['message'],
             message['message'].content,
@@ -1277,6 +1355,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
             message['realm'],
             mention_data=message['mention_data'],
             email_gateway=email_gateway,
+            render_context=render_contexts[message['realm'].id],
         )
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
@@ -1306,7 +1385,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     user_message_flags = defaultdict(dict)  # type: Dict[int, Dict[int, List[str]]]
     with transaction.atomic():
         Message.objects.bulk_create([message['message'] for message in messages])
-        ums = []  # type: List[UserMessageLite]
+        ums = []  # type: List[UserMessageBatch]
         for message in messages:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
@@ -1321,10 +1400,9 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 mark_as_read=mark_as_read
             )
 
-            for um in user_messages:
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
+            user_message_flags[message['message'].id] = user_messages.flags_lists_by_user_id()
 
-            ums.extend(user_messages)
+            ums.append(user_messages)
 
             message['message'].service_queue_events = get_service_bot_events(
                 sender=message['message'].sender,
@@ -1334,7 +1412,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 recipient_type=message['message'].recipient.type,
             )
 
-        bulk_insert_ums(ums)
+        bulk_insert_user_message_batches(ums)
 
         # Claim attachments in message
         for message in messages:
@@ -1344,119 +1422,205 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         for message in messages:
             do_widget_post_save_actions(message)
 
+    fanouts = []  # type: List[Dict[str, Any]]
     for message in messages:
-        # Deliver events to the real-time push system, as well as
-        # enqueuing any additional processing triggered by the message.
-        wide_message_dict = MessageDict.wide_dict(message['message'])
-
-        user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        message_type = wide_message_dict['type']
-
-        presence_idle_user_ids = get_active_presence_idle_user_ids(
-            realm=sender.realm,
-            sender_id=sender.id,
-            message_type=message_type,
+        fanouts.append(dict(
             active_user_ids=message['active_user_ids'],
-            user_flags=user_flags,
-        )
+            push_notify_user_ids=message['push_notify_user_ids'],
+            stream_push_user_ids=message['stream_push_user_ids'],
+            stream_email_user_ids=message['stream_email_user_ids'],
+            user_flags=user_message_flags.get(message['message'].id, {}),
+            local_id=message['local_id'],
+            sender_queue_id=message['sender_queue_id'],
+            links_for_embed=links_for_embed,
+            service_queue_events=message['message'].service_queue_events,
+        ))
+
+    if settings.ASYNC_MESSAGE_FANOUT:
+        # The messages are saved, so hand everything else over to the
+        # message_fanout worker, with a single queue publish, rather
+        # than making the sender wait for it.  The worker reads the
+        # messages back from the database, so if we're called inside
+        # an outer transaction, we must wait for that to commit.
+        fanout_event = dict(messages=[
+            dict(message_fanout_to_json(fanout),
+                 message_id=message['message'].id,
+                 realm_id=message['realm'].id)
+            for (message, fanout) in zip(messages, fanouts)
+        ])
+        transaction.on_commit(lambda: queue_json_publish('message_fanout', fanout_event))
+    else:
+        for (message, fanout) in zip(messages, fanouts):
+            do_send_message_events(message['message'], message['realm'],
+                                   message['stream'], fanout)
 
-        event = dict(
-            type='message',
-            message=message['message'].id,
-            message_dict=wide_message_dict,
-            presence_idle_user_ids=presence_idle_user_ids,
-        )
+    # Note that this does not preserve the order of message ids
+    # returned.  In practice, this shouldn't matter, as we only
+    # mirror single zephyr messages at a time and don't otherwise
+    # intermingle sending zephyr messages with other messages.
+    return already_sent_ids + [message['message'].id for message in messages]
 
-        '''
-        TODO:  We may want to limit user_ids to only those users who have
-               UserMessage rows, if only for minor performance reasons.
+MessageFanout = Dict[str, Any]
+
+def do_send_message_events(message: Message, realm: Realm, stream: Optional[Stream],
+                           fanout: MessageFanout) -> None:
+    """Delivers the events for a newly sent message to the real-time
+    push system, and enqueues any additional processing triggered by
+    the message.  This is the part of do_send_messages after its
+    transaction commits, which with ASYNC_MESSAGE_FANOUT runs in the
+    message_fanout worker instead.
+
+    `fanout` has the recipient data computed by do_send_messages:
+    the sets of active_user_ids, push_notify_user_ids,
+    stream_push_user_ids and stream_email_user_ids, the user_flags of
+    each user with a UserMessage row, the local_id and sender_queue_id
+    of the message, the links_for_embed and the service_queue_events.
+    """
+    wide_message_dict = MessageDict.wide_dict(message)
+
+    user_flags = fanout['user_flags']  # type: Dict[int, List[str]]
+    sender = message.sender
+    message_type = wide_message_dict['type']
+
+    presence_idle_user_ids = get_active_presence_idle_user_ids(
+        realm=sender.realm,
+        sender_id=sender.id,
+        message_type=message_type,
+        active_user_ids=fanout['active_user_ids'],
+        user_flags=user_flags,
+    )
 
-               For now we queue events for all subscribers/sendees of the
-               message, since downstream code may still do notifications
-               that don't require UserMessage rows.
+    event = dict(
+        type='message',
+        message=message.id,
+        message_dict=wide_message_dict,
+        presence_idle_user_ids=presence_idle_user_ids,
+    )
 
-               Our automated tests have gotten better on this codepath,
-               but we may have coverage gaps, so we should be careful
-               about changing the next line.
-        '''
-        user_ids = message['active_user_ids'] | set(user_flags.keys())
-
-        users = [
-            dict(
-                id=user_id,
-                flags=user_flags.get(user_id, []),
-                always_push_notify=(user_id in message['push_notify_user_ids']),
-                stream_push_notify=(user_id in message['stream_push_user_ids']),
-                stream_email_notify=(user_id in message['stream_email_user_ids']),
+    '''
+    TODO:  We may want to limit user_ids to only those users who have
+           UserMessage rows, if only for minor performance reasons.
+
+           For now we queue events for all subscribers/sendees of the
+           message, since downstream code may still do notifications
+           that don't require UserMessage rows.
+
+           Our automated tests have gotten better on this codepath,
+           but we may have coverage gaps, so we should be careful
+           about changing the next line.
+    '''
+    user_ids = fanout['active_user_ids'] | set(user_flags.keys())
+
+    users = [
+        dict(
+            id=user_id,
+            flags=user_flags.get(user_id, []),
+            always_push_notify=(user_id in fanout['push_notify_user_ids']),
+            stream_push_notify=(user_id in fanout['stream_push_user_ids']),
+            stream_email_notify=(user_id in fanout['stream_email_user_ids']),
+        )
+        for user_id in user_ids
+    ]
+
+    if message.is_stream_message():
+        # Note: This is where authorization for single-stream
+        # get_updates happens! We only attach stream data to the
+        # notify new_message request if it's a public stream,
+        # ensuring that in the tornado server, non-public stream
+        # messages are only associated to their subscribed users.
+        if stream is None:
+            stream_id = message.recipient.type_id
+            stream = Stream.objects.select_related("realm").get(id=stream_id)
+        assert stream is not None  # assert needed because stubs for django are missing
+        if stream.is_public():
+            event['realm_id'] = stream.realm_id
+            event['stream_name'] = stream.name
+        if stream.invite_only:
+            event['invite_only'] = True
+        if stream.first_message_id is None:
+            stream.first_message_id = message.id
+            stream.save(update_fields=["first_message_id"])
+    if fanout['local_id'] is not None:
+        event['local_id'] = fanout['local_id']
+    if fanout['sender_queue_id'] is not None:
+        event['sender_queue_id'] = fanout['sender_queue_id']
+    send_event(realm, event, users)
+
+    if url_embed_preview_enabled(message) and fanout['links_for_embed']:
+        event_data = {
+            'message_id': message.id,
+            'message_content': message.content,
+            'message_realm_id': realm.id,
+            'urls': fanout['links_for_embed']}
+        queue_json_publish('embed_links', event_data)
+
+    if (settings.ENABLE_FEEDBACK and settings.FEEDBACK_BOT and
+            message.recipient.type == Recipient.PERSONAL):
+
+        feedback_bot_id = get_system_bot(email=settings.FEEDBACK_BOT).id
+        if feedback_bot_id in fanout['active_user_ids']:
+            queue_json_publish(
+                'feedback_messages',
+                wide_message_dict,
             )
-            for user_id in user_ids
-        ]
 
-        if message['message'].is_stream_message():
-            # Note: This is where authorization for single-stream
-            # get_updates happens! We only attach stream data to the
-            # notify new_message request if it's a public stream,
-            # ensuring that in the tornado server, non-public stream
-            # messages are only associated to their subscribed users.
-            if message['stream'] is None:
-                stream_id = message['message'].recipient.type_id
-                message['stream'] = Stream.objects.select_related("realm").get(id=stream_id)
-            assert message['stream'] is not None  # assert needed because stubs for django are missing
-            if message['stream'].is_public():
-                event['realm_id'] = message['stream'].realm_id
-                event['stream_name'] = message['stream'].name
-            if message['stream'].invite_only:
-                event['invite_only'] = True
-            if message['stream'].first_message_id is None:
-                message['stream'].first_message_id = message['message'].id
-                message['stream'].save(update_fields=["first_message_id"])
-        if message['local_id'] is not None:
-            event['local_id'] = message['local_id']
-        if message['sender_queue_id'] is not None:
-            event['sender_queue_id'] = message['sender_queue_id']
-        send_event(message['realm'], event, users)
-
-        if url_embed_preview_enabled(message['message']) and links_for_embed:
-            event_data = {
-                'message_id': message['message'].id,
-                'message_content': message['message'].content,
-                'message_realm_id': message['realm'].id,
-                'urls': links_for_embed}
-            queue_json_publish('embed_links', event_data)
-
-        if (settings.ENABLE_FEEDBACK and settings.FEEDBACK_BOT and
-                message['message'].recipient.type == Recipient.PERSONAL):
-
-            feedback_bot_id = get_system_bot(email=settings.FEEDBACK_BOT).id
-            if feedback_bot_id in message['active_user_ids']:
-                queue_json_publish(
-                    'feedback_messages',
-                    wide_message_dict,
-                )
+    if message.recipient.type == Recipient.PERSONAL:
+        welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
+        if (welcome_bot_id in fanout['active_user_ids'] and
+                welcome_bot_id != message.sender_id):
+            send_welcome_bot_response(dict(message=message, realm=realm))
+
+    for queue_name, events in fanout['service_queue_events'].items():
+        for event in events:
+            queue_json_publish(
+                queue_name,
+                {
+                    "message": wide_message_dict,
+                    "trigger": event['trigger'],
+                    "user_profile_id": event["user_profile_id"],
+                }
+            )
 
-        if message['message'].recipient.type == Recipient.PERSONAL:
-            welcome_bot_id = get_system_bot(settings.WELCOME_BOT).id
-            if (welcome_bot_id in message['active_user_ids'] and
-                    welcome_bot_id != message['message'].sender_id):
-                send_welcome_bot_response(message)
-
-        for queue_name, events in message['message'].service_queue_events.items():
-            for event in events:
-                queue_json_publish(
-                    queue_name,
-                    {
-                        "message": wide_message_dict,
-                        "trigger": event['trigger'],
-                        "user_profile_id": event["user_profile_id"],
-                    }
-                )
 
-    # Note that this does not preserve the order of message ids
-    # returned.  In practice, this shouldn't matter, as we only
-    # mirror single zephyr messages at a time and don't otherwise
-    # intermingle sending zephyr messages with other messages.
-    return already_sent_ids + [message['message'].id for message in messages]
+def message_fanout_to_json(fanout: MessageFanout) -> Dict[str, Any]:
+    return dict(
+        fanout,
+        active_user_ids=list(fanout['active_user_ids']),
+        push_notify_user_ids=list(fanout['push_notify_user_ids']),
+        stream_push_user_ids=list(fanout['stream_push_user_ids']),
+        stream_email_user_ids=list(fanout['stream_email_user_ids']),
+        user_flags=list(fanout['user_flags'].items()),
+        links_for_embed=list(fanout['links_for_embed']),
+    )
+
+def message_fanout_from_json(data: Mapping[str, Any]) -> MessageFanout:
+    return dict(
+        data,
+        active_user_ids=set(data['active_user_ids']),
+        push_notify_user_ids=set(data['push_notify_user_ids']),
+        stream_push_user_ids=set(data['stream_push_user_ids']),
+        stream_email_user_ids=set(data['stream_email_user_ids']),
+        user_flags=dict(data['user_flags']),
+        links_for_embed=set(data['links_for_embed']),
+    )
+
+def do_send_queued_message_events(event: Mapping[str, Any]) -> None:
+    """The message_fanout worker's side of ASYNC_MESSAGE_FANOUT."""
+    message_ids = [data['message_id'] for data in event['messages']]
+    messages = Message.objects.select_related(
+        'sender', 'sender__realm', 'recipient', 'sending_client',
+    ).in_bulk(message_ids)
+    realms = {}  # type: Dict[int, Realm]
+    for data in event['messages']:
+        if data['message_id'] not in messages:
+            # The message was deleted (or archived) before we got to
+            # it, so there's nothing left to notify anyone about.
+            logging.warning("message_fanout: Skipping missing message %s" % (data['message_id'],))
+            continue
+        if data['realm_id'] not in realms:
+            realms[data['realm_id']] = Realm.objects.get(id=data['realm_id'])
+        do_send_message_events(messages[data['message_id']], realms[data['realm_id']],
+                               None, message_fanout_from_json(data))
 
 class UserMessageLite:
     '''
@@ -1472,40 +1636,69 @@ class UserMessageLite:
     def flags_list(self) -> List[str]:
         return UserMessage.flags_list_for_flags(self.flags)
 
+class UserMessageBatch:
+    '''
+    The UserMessage rows for a single message, stored as parallel
+    arrays of user ids and flags rather than one UserMessageLite per
+    row, since for messages to large streams building and looping
+    over those objects is a significant part of the cost of sending.
+    '''
+    def __init__(self, message_id: int, user_profile_ids: Iterable[int],
+                 flags: Iterable[int]) -> None:
+        self.message_id = message_id
+        self.user_profile_ids = array('i', user_profile_ids)
+        self.flags = array('q', flags)
+        assert len(self.user_profile_ids) == len(self.flags)
+
+    def __len__(self) -> int:
+        return len(self.user_profile_ids)
+
+    def flags_lists_by_user_id(self) -> Dict[int, List[str]]:
+        # Most rows share one of a handful of flags values, so we only
+        # compute the list of flag names once for each of them.
+        flags_lists = {}  # type: Dict[int, List[str]]
+        result = {}  # type: Dict[int, List[str]]
+        for user_profile_id, flags in zip(self.user_profile_ids, self.flags):
+            if flags not in flags_lists:
+                flags_lists[flags] = UserMessage.flags_list_for_flags(flags)
+            result[user_profile_id] = flags_lists[flags]
+        return result
+
+    def copy_rows(self) -> str:
+        row_format = '%d\t' + str(self.message_id) + '\t%d\n'
+        return ''.join([row_format % row for row in zip(self.user_profile_ids, self.flags)])
+
 def create_user_messages(message: Message,
                          um_eligible_user_ids: Set[int],
                          long_term_idle_user_ids: Set[int],
                          stream_push_user_ids: Set[int],
                          stream_email_user_ids: Set[int],
                          mentioned_user_ids: Set[int],
-                         mark_as_read: List[int]=[]) -> List[UserMessageLite]:
-    ums_to_create = []
-    for user_profile_id in um_eligible_user_ids:
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-            flags=0,
-        )
-        ums_to_create.append(um)
-
+                         mark_as_read: List[int]=[]) -> UserMessageBatch:
+    # Flags that every recipient gets.
+    base_flags = 0
     # These properties on the Message are set via
     # render_markdown by code in the bugdown inline patterns
-    wildcard = message.mentions_wildcard
-    ids_with_alert_words = message.user_ids_with_alert_words
-
-    for um in ums_to_create:
-        if (um.user_profile_id == message.sender.id and
-                message.sent_by_human()) or \
-           um.user_profile_id in mark_as_read:
-            um.flags |= UserMessage.flags.read
-        if wildcard:
-            um.flags |= UserMessage.flags.wildcard_mentioned
-        if um.user_profile_id in mentioned_user_ids:
-            um.flags |= UserMessage.flags.mentioned
-        if um.user_profile_id in ids_with_alert_words:
-            um.flags |= UserMessage.flags.has_alert_word
-        if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
-            um.flags |= UserMessage.flags.is_private
+    if message.mentions_wildcard:
+        base_flags |= int(UserMessage.flags.wildcard_mentioned)
+    if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
+        base_flags |= int(UserMessage.flags.is_private)
+
+    # Flags that only some recipients get; each is computed with set
+    # operations, so we only look at the (usually few) users who have
+    # any of them individually.
+    read_user_ids = set(mark_as_read)
+    if message.sent_by_human():
+        read_user_ids.add(message.sender.id)
+    per_user_flags = [
+        (read_user_ids, int(UserMessage.flags.read)),
+        (mentioned_user_ids, int(UserMessage.flags.mentioned)),
+        (message.user_ids_with_alert_words, int(UserMessage.flags.has_alert_word)),
+    ]
+    extra_flags = {}  # type: Dict[int, int]
+    for user_ids, flag in per_user_flags:
+        for user_profile_id in um_eligible_user_ids & user_ids:
+            extra_flags[user_profile_id] = extra_flags.get(user_profile_id, 0) | flag
 
     # For long_term_idle (aka soft-deactivated) users, we are allowed
     # to optimize by lazily not creating UserMessage rows that would
@@ -1526,17 +1719,24 @@ def create_user_messages(message: Message,
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
-    user_messages = []
-    for um in ums_to_create:
-        if (um.user_profile_id in long_term_idle_user_ids and
-                um.user_profile_id not in stream_push_user_ids and
-                um.user_profile_id not in stream_email_user_ids and
-                message.is_stream_message() and
-                int(um.flags) == 0):
-            continue
-        user_messages.append(um)
+    if message.is_stream_message() and base_flags == 0:
+        skipped_user_ids = (long_term_idle_user_ids - stream_push_user_ids -
+                            stream_email_user_ids - set(extra_flags))
+    else:
+        skipped_user_ids = set()
 
-    return user_messages
+    if skipped_user_ids:
+        user_profile_ids = [user_profile_id for user_profile_id in um_eligible_user_ids
+                            if user_profile_id not in skipped_user_ids]
+    else:
+        user_profile_ids = list(um_eligible_user_ids)
+    if extra_flags:
+        flags = [base_flags | extra_flags.get(user_profile_id, 0)
+                 for user_profile_id in user_profile_ids]  # type: Iterable[int]
+    else:
+        flags = itertools.repeat(base_flags, len(user_profile_ids))
+
+    return UserMessageBatch(message.id, user_profile_ids, flags)
 
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     '''
@@ -1548,18 +1748,35 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     if not ums:
         return
 
-    vals = ','.join([
-        '(%d, %d, %d)' % (um.user_profile_id, um.message_id, um.flags)
+    copy_user_message_rows(''.join([
+        '%d\t%d\t%d\n' % (um.user_profile_id, um.message_id, um.flags)
         for um in ums
-    ])
+    ]))
+
+def bulk_insert_user_message_batches(batches: List[UserMessageBatch]) -> None:
+    '''
+    Like bulk_insert_ums, but for the rows created by
+    create_user_messages, without building an object for each row.
+    '''
+    if not any(len(batch) for batch in batches):
+        return
+
+    copy_user_message_rows(''.join([batch.copy_rows() for batch in batches]))
+
+def copy_user_message_rows(rows: str) -> None:
+    '''
+    We stream the rows to the database with COPY, rather than as
+    one huge INSERT statement, which for large streams was slow both
+    for us to build and for postgres to parse.
+    '''
     query = '''
-        INSERT into
+        COPY
             zerver_usermessage (user_profile_id, message_id, flags)
-        VALUES
-    ''' + vals
+        FROM STDIN
+    '''
 
     with connection.cursor() as cursor:
-        cursor.execute(query)
+        cursor.copy_expert(query, io.StringIO(rows))
 
 def do_add_submessage(realm: Realm,
                       sender_id: int,
@@ -2409,6 +2626,51 @@ def internal_prep_private_message(realm: Realm,
         content=content,
     )
 
+# The `messages` attribute holds the messages queued by the
+# internal_send_* functions while inside a batch_internal_messages()
+# block in this thread, and is None when no batch is open.  This is
+# per-thread, since e.g. queue workers may run as threads of a single
+# process, and one thread's batch must not capture another's messages.
+internal_message_batch = threading.local()
+
+def get_internal_message_batch() -> Optional[List[Dict[str, Any]]]:
+    return getattr(internal_message_batch, 'messages', None)
+
+@contextmanager
+def batch_internal_messages() -> Iterator[None]:
+    """Collect the messages sent by the internal_send_* functions inside
+    the `with` block, and send them all with a single do_send_messages
+    call when the block exits, rather than paying do_send_messages'
+    per-call overhead (transaction, rendering setup, fanout) for each
+    one.  process_new_human_user uses this to send a new user's
+    notification and welcome bot messages together.
+
+    Inside the block, those functions return None, since the message IDs
+    aren't known until the batch is sent.  Nested blocks join the
+    outermost batch, and if the block raises an exception, the queued
+    messages are discarded.
+    """
+    if get_internal_message_batch() is not None:
+        yield
+        return
+
+    internal_message_batch.messages = []
+    try:
+        yield
+        messages = internal_message_batch.messages
+    finally:
+        internal_message_batch.messages = None
+    if messages:
+        do_send_messages(messages)
+
+def _internal_send_prepped_message(message: Dict[str, Any]) -> Optional[int]:
+    messages = get_internal_message_batch()
+    if messages is not None:
+        messages.append(message)
+        return None
+    message_ids = do_send_messages([message])
+    return message_ids[0]
+
 def internal_send_message(realm: Realm, sender_email: str, recipient_type_name: str,
                           recipients: str, topic_name: str, content: str,
                           email_gateway: Optional[bool]=False) -> Optional[int]:
@@ -2437,8 +2699,12 @@ def internal_send_message(realm: Realm, sender_email: str, recipient_type_name:
     if msg is None:
         return None
 
-    message_ids = do_send_messages([msg], email_gateway=email_gateway)
-    return message_ids[0]
+    if email_gateway:
+        # email_gateway applies to a whole do_send_messages call, so
+        # these can't join a batch of internal messages.
+        message_ids = do_send_messages([msg], email_gateway=email_gateway)
+        return message_ids[0]
+    return _internal_send_prepped_message(msg)
 
 def internal_send_private_message(realm: Realm,
                                   sender: UserProfile,
@@ -2447,8 +2713,7 @@ def internal_send_private_message(realm: Realm,
     message = internal_prep_private_message(realm, sender, recipient_user, content)
     if message is None:
         return None
-    message_ids = do_send_messages([message])
-    return message_ids[0]
+    return _internal_send_prepped_message(message)
 
 def internal_send_stream_message(
         realm: Realm, sender: UserProfile,
@@ -2461,8 +2726,7 @@ def internal_send_stream_message(
 
     if message is None:
         return None
-    message_ids = do_send_messages([message])
-    return message_ids[0]
+    return _internal_send_prepped_message(message)
 
 def internal_send_stream_message_by_name(
         realm: Realm, sender: UserProfile,
@@ -2475,8 +2739,7 @@ def internal_send_stream_message_by_name(
 
     if message is None:
         return None
-    message_ids = do_send_messages([message])
-    return message_ids[0]
+    return _internal_send_prepped_message(message)
 
 def internal_send_huddle_message(realm: Realm, sender: UserProfile, emails: List[str],
                                  content: str) -> Optional[int]:
@@ -2489,8 +2752,7 @@ def internal_send_huddle_message(realm: Realm, sender: UserProfile, emails: List
     )
     if message is None:
         return None
-    message_ids = do_send_messages([message])
-    return message_ids[0]
+    return _internal_send_prepped_message(message)
 
 def pick_color(user_profile: UserProfile, subs: Iterable[Subscription]) -> str:
     # These colors are shared with the palette in subs.js.
@@ -2820,6 +3082,10 @@ def bulk_add_subscriptions(streams: Iterable[Stream],
         sub_ids = [sub.id for (sub, stream) in subs_to_activate]
         Subscription.objects.filter(id__in=sub_ids).update(active=True)
         occupied_streams_after = list(get_occupied_streams(realm))
+    delete_stream_subscriber_rows_cache(recipients)
+    # Unread summaries exclude messages on streams the user had
+    # unsubscribed from; see get_unread_conversations.
+    flush_unread_summaries({sub.user_profile_id for (sub, stream) in subs_to_activate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -3010,6 +3276,7 @@ def bulk_remove_subscriptions(users: Iterable[UserProfile],
             id__in=sub_ids_to_deactivate,
         ) .update(active=False)
         occupied_streams_after = list(get_occupied_streams(our_realm))
+    delete_stream_subscriber_rows_cache({sub.recipient_id for (sub, stream) in subs_to_deactivate})
 
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
@@ -3530,6 +3797,8 @@ def do_rename_stream(stream: Stream,
     old_name = stream.name
     stream.name = new_name
     stream.save(update_fields=["name"])
+    # Cached search results are keyed by stream names.
+    flush_realm_search_results(stream.realm_id)
 
     if log:
         log_event({'type': 'stream_name_change',
@@ -3983,6 +4252,7 @@ def do_update_pointer(user_profile: UserProfile, client: Client,
                                    message__id__gt=prev_pointer,
                                    message__id__lte=pointer).extra(where=[UserMessage.where_unread()]) \
                            .update(flags=F('flags').bitor(UserMessage.flags.read))
+        flush_unread_summaries([user_profile.id])
         do_clear_mobile_push_notifications_for_ids(user_profile, app_message_ids)
 
     event = dict(type='pointer', pointer=pointer)
@@ -4031,6 +4301,7 @@ def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    remove_read_messages_from_unread_summary(user_profile.id, None)
 
     event = dict(
         type='update_message_flags',
@@ -4080,6 +4351,7 @@ def do_mark_stream_messages_as_read(user_profile: UserProfile,
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    remove_read_messages_from_unread_summary(user_profile.id, message_ids)
 
     event = dict(
         type='update_message_flags',
@@ -4159,6 +4431,7 @@ def do_update_message_flags(user_profile: UserProfile,
         UserMessage.objects.create(user_profile=user_profile,
                                    message=message,
                                    flags=UserMessage.flags.historical | UserMessage.flags.read)
+        flush_user_search_results([user_profile.id])
 
     if operation == 'add':
         count = msgs.update(flags=F('flags').bitor(flagattr))
@@ -4166,6 +4439,10 @@ def do_update_message_flags(user_profile: UserProfile,
         count = msgs.update(flags=F('flags').bitand(~flagattr))
     else:
         raise AssertionError("Invalid message flags operation")
+    if flag == "read" and operation == "add":
+        remove_read_messages_from_unread_summary(user_profile.id, messages)
+    elif flag == "read":
+        flush_unread_summaries([user_profile.id])
 
     event = {'type': 'update_message_flags',
              'operation': operation,
@@ -4301,6 +4578,7 @@ def do_update_embedded_data(user_profile: UserProfile,
     message.save(update_fields=["content", "rendered_content"])
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
+    flush_realm_search_results(user_profile.realm_id)
 
     def user_info(um: UserMessage) -> Dict[str, Any]:
         return {
@@ -4439,6 +4717,7 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
     save_message_for_edit_use_case(message=message)
 
     event['message_ids'] = update_to_dict_cache(changed_messages)
+    flush_realm_search_results(user_profile.realm_id)
 
     def user_info(um: UserMessage) -> Dict[str, Any]:
         return {
@@ -4478,6 +4757,14 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
             subscribers_ids = [user.user_profile_id for user in subscribers]
             users_to_be_notified += list(map(subscriber_info, subscribers_ids))
 
+    # Edits can change the topic or mentions of unread messages.
+    affected_user_ids = {um.user_profile_id for um in ums}
+    if len(changed_messages) > 1:
+        affected_user_ids |= set(UserMessage.objects.filter(
+            message_id__in=[changed_message.id for changed_message in changed_messages],
+        ).values_list('user_profile_id', flat=True))
+    flush_unread_summaries(affected_user_ids)
+
     send_event(user_profile.realm, event, users_to_be_notified)
     return len(changed_messages)
 
@@ -4508,12 +4795,16 @@ def do_delete_messages(user_profile: UserProfile, messages: Iterable[Message]) -
         ums = [{'id': um.user_profile_id} for um in
                UserMessage.objects.filter(message=message.id)]
         move_messages_to_archive([message.id])
+        flush_unread_summaries(um['id'] for um in ums)
+        flush_realm_search_results(user_profile.realm_id)
         send_event(user_profile.realm, event, ums)
 
 def do_delete_messages_by_sender(user: UserProfile) -> None:
     message_ids = Message.objects.filter(sender=user).values_list('id', flat=True).order_by('id')
     if message_ids:
         move_messages_to_archive(message_ids)
+        flush_realm_unread_summaries(user.realm_id)
+        flush_realm_search_results(user.realm_id)
 
 def get_streams_traffic(stream_ids: Set[int]) -> Dict[int, int]:
     stat = COUNT_STATS['messages_in_stream:is_bot:day']
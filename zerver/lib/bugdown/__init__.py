@@ -38,7 +38,8 @@ from zerver.lib.storage import static_path
 from zerver.lib.url_encoding import encode_stream, hash_util_encode
 from zerver.lib.thumbnail import user_uploads_or_external
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, NotFoundInCache
+from zerver.lib.alert_words import get_alert_word_automaton
+from zerver.lib.cache import cache_with_key, get_realm_render_context_version, NotFoundInCache
 from zerver.lib.url_preview import preview as link_preview
 from zerver.models import (
     all_realm_filters,
@@ -1781,16 +1782,29 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
     allowed_after_punctuation = set([' ', '\n', ')', '",', '?', ':', '.', ',', '\'', ';', ']', '!',
                                      '*', '`'])
 
-    def check_valid_start_position(self, content: str, index: int) -> bool:
-        if index <= 0 or content[index] in self.allowed_before_punctuation:
+    @classmethod
+    def check_valid_start_position(cls, content: str, index: int) -> bool:
+        if index <= 0 or content[index] in cls.allowed_before_punctuation:
             return True
         return False
 
-    def check_valid_end_position(self, content: str, index: int) -> bool:
-        if index >= len(content) or content[index] in self.allowed_after_punctuation:
+    @classmethod
+    def check_valid_end_position(cls, content: str, index: int) -> bool:
+        if index >= len(content) or content[index] in cls.allowed_after_punctuation:
             return True
         return False
 
+    @classmethod
+    def get_user_ids_with_alert_words(cls, content: str,
+                                      realm_alert_words_automaton: ahocorasick.Automaton) -> Set[int]:
+        content = content.lower()
+        user_ids_with_alert_words = set()  # type: Set[int]
+        for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
+            if cls.check_valid_start_position(content, end_index - len(original_value)) and \
+               cls.check_valid_end_position(content, end_index + 1):
+                user_ids_with_alert_words.update(user_ids)
+        return user_ids_with_alert_words
+
     def run(self, lines: Iterable[str]) -> Iterable[str]:
         db_data = self.markdown.zulip_db_data
         if self.markdown.zulip_message and db_data is not None:
@@ -1804,11 +1818,9 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
             realm_alert_words_automaton = db_data['realm_alert_words_automaton']
 
             if realm_alert_words_automaton is not None:
-                content = '\n'.join(lines).lower()
-                for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
-                    if self.check_valid_start_position(content, end_index - len(original_value)) and \
-                       self.check_valid_end_position(content, end_index + 1):
-                        self.markdown.zulip_message.user_ids_with_alert_words.update(user_ids)
+                self.markdown.zulip_message.user_ids_with_alert_words.update(
+                    self.get_user_ids_with_alert_words('\n'.join(lines),
+                                                       realm_alert_words_automaton))
         return lines
 
 # This prevents realm_filters from running on the content of a
@@ -2093,7 +2105,8 @@ def topic_links(realm_filters_key: int, topic_name: str) -> List[str]:
 
     return matches
 
-def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gateway: bool) -> None:
+def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gateway: bool,
+                                  realm_filters: Optional[List[Tuple[str, str, int]]]=None) -> None:
     # If realm_filters_key is None, load all filters
     global realm_filter_data
     if realm_filters_key is None:
@@ -2106,7 +2119,8 @@ def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gatewa
         realm_filter_data[ZEPHYR_MIRROR_BUGDOWN_KEY] = []
         make_md_engine(ZEPHYR_MIRROR_BUGDOWN_KEY, False)
     else:
-        realm_filters = realm_filters_for_realm(realm_filters_key)
+        if realm_filters is None:
+            realm_filters = realm_filters_for_realm(realm_filters_key)
         if realm_filters_key not in realm_filter_data or    \
                 realm_filter_data[realm_filters_key] != realm_filters:
             # Realm filters data has changed, update `realm_filter_data` and any
@@ -2284,6 +2298,73 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     }
     return dct
 
+# Content matching this, and not PLAIN_TEXT_EXCLUDED_RE, is a single
+# line of words made of ASCII letters and digits and a few punctuation
+# characters that none of our markdown syntax uses, separated by
+# single spaces.  Apart from realm filters (see is_plain_text), the
+# full markdown pipeline renders it as a single paragraph containing
+# the escaped content.
+PLAIN_TEXT_RE = re.compile(r"^[A-Za-z0-9\"',?!&.]+(?: [A-Za-z0-9\"',?!&.]+)*$")
+# Things made of those characters that aren't plain text: ordered
+# lists, dots that may be part of a URL like example.com, and
+# ampersands that may start an HTML entity.
+PLAIN_TEXT_EXCLUDED_RE = re.compile(r"^[0-9]+\.|\.(?! |$)|&(?! |$)")
+
+@functools.lru_cache(maxsize=1000)
+def get_realm_filter_regex(pattern: str) -> Pattern:
+    return re.compile(prepare_realm_pattern(pattern), re.UNICODE)
+
+def is_plain_text(content: str, realm_filters: List[Tuple[str, str, int]]) -> bool:
+    if not PLAIN_TEXT_RE.match(content) or PLAIN_TEXT_EXCLUDED_RE.search(content):
+        return False
+    for (pattern, url_format_string, id) in realm_filters:
+        if get_realm_filter_regex(pattern).search(content):
+            return False
+    return True
+
+def render_plain_text(content: str) -> str:
+    """Renders content for which is_plain_text is True, exactly as the
+    full markdown pipeline would, but at a small fraction of the cost;
+    this is most of the messages people send."""
+    return '<p>%s</p>' % (html.escape(content, quote=False),)
+
+
+class RealmRenderContext:
+    """The per-realm data needed to render messages: the alert word
+    automaton, the realm filters, and (fetched the first time a
+    message uses emoji syntax) the active realm emoji.
+
+    Fetching these for every message is a significant part of the
+    cost of rendering, so we keep them in this process between
+    messages and requests; `version` is the version token from
+    get_realm_render_context_version they were fetched with."""
+
+    def __init__(self, realm: Realm, version: str) -> None:
+        self.version = version
+        self.realm_alert_words_automaton = get_alert_word_automaton(realm)
+        self.realm_filters = realm_filters_for_realm(realm.id)
+        self.active_realm_emoji = None  # type: Optional[Dict[str, Dict[str, Any]]]
+
+    def get_active_realm_emoji(self, realm: Realm) -> Dict[str, Dict[str, Any]]:
+        if self.active_realm_emoji is None:
+            self.active_realm_emoji = realm.get_active_emoji()
+        return self.active_realm_emoji
+
+realm_render_contexts = {}  # type: Dict[int, RealmRenderContext]
+
+def get_realm_render_context(realm: Realm) -> RealmRenderContext:
+    """Returns this process's RealmRenderContext for the realm,
+    fetching it again if flush_realm_render_context has been called
+    (in any process) since it was fetched."""
+    version = get_realm_render_context_version(realm.id)
+    render_context = realm_render_contexts.get(realm.id)
+    if render_context is None or render_context.version != version:
+        render_context = RealmRenderContext(realm, version)
+        realm_render_contexts[realm.id] = render_context
+    return render_context
+
+def clear_realm_render_contexts() -> None:
+    realm_render_contexts.clear()
 
 def do_convert(content: str,
                realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
@@ -2293,7 +2374,8 @@ def do_convert(content: str,
                translate_emoticons: Optional[bool]=False,
                mention_data: Optional[MentionData]=None,
                email_gateway: Optional[bool]=False,
-               no_previews: Optional[bool]=False) -> str:
+               no_previews: Optional[bool]=False,
+               render_context: Optional[RealmRenderContext]=None) -> str:
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
@@ -2319,7 +2401,22 @@ def do_convert(content: str,
                 # delivered via zephyr_mirror
                 realm_filters_key = ZEPHYR_MIRROR_BUGDOWN_KEY
 
-    maybe_update_markdown_engines(realm_filters_key, email_gateway)
+    if render_context is not None and message_realm is not None and \
+            realm_filters_key == message_realm.id:
+        realm_filters = render_context.realm_filters
+    else:
+        realm_filters = realm_filters_for_realm(realm_filters_key)
+
+    if (not email_gateway and realm_filters_key != ZEPHYR_MIRROR_BUGDOWN_KEY and
+            is_plain_text(content, realm_filters)):
+        if message is not None and realm_alert_words_automaton is not None:
+            message.user_ids_with_alert_words.update(
+                AlertWordsNotificationProcessor.get_user_ids_with_alert_words(
+                    content, realm_alert_words_automaton))
+        return render_plain_text(content)
+
+    maybe_update_markdown_engines(realm_filters_key, email_gateway,
+                                  realm_filters=realm_filters)
     md_engine_key = (realm_filters_key, email_gateway)
 
     if md_engine_key in md_engines:
@@ -2361,7 +2458,10 @@ def do_convert(content: str,
         stream_name_info = get_stream_name_info(message_realm, stream_names)
 
         if content_has_emoji_syntax(content):
-            active_realm_emoji = message_realm.get_active_emoji()
+            if render_context is not None:
+                active_realm_emoji = render_context.get_active_realm_emoji(message_realm)
+            else:
+                active_realm_emoji = message_realm.get_active_emoji()
         else:
             active_realm_emoji = dict()
 
@@ -2438,11 +2538,13 @@ def convert(content: str,
             translate_emoticons: Optional[bool]=False,
             mention_data: Optional[MentionData]=None,
             email_gateway: Optional[bool]=False,
-            no_previews: Optional[bool]=False) -> str:
+            no_previews: Optional[bool]=False,
+            render_context: Optional[RealmRenderContext]=None) -> str:
     bugdown_stats_start()
     ret = do_convert(content, realm_alert_words_automaton,
                      message, message_realm, sent_by_bot,
                      translate_emoticons, mention_data, email_gateway,
-                     no_previews=no_previews)
+                     no_previews=no_previews,
+                     render_context=render_context)
     bugdown_stats_finish()
     return ret
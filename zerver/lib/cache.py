@@ -181,6 +181,15 @@ def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optio
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
 
+def cache_add(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> bool:
+    """Like cache_set, but only stores the value if the key isn't already
+    set; returns whether it did."""
+    remote_cache_stats_start()
+    cache_backend = get_cache_backend(cache_name)
+    ret = cache_backend.add(KEY_PREFIX + key, (val,), timeout=timeout)
+    remote_cache_stats_finish()
+    return ret
+
 def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
@@ -373,6 +382,19 @@ bot_dict_fields = ['id', 'full_name', 'short_name', 'bot_type', 'email',
 def bot_dicts_in_realm_cache_key(realm: 'Realm') -> str:
     return "bot_dicts_in_realm:%s" % (realm.id,)
 
+def stream_subscriber_rows_cache_key(recipient_id: int) -> str:
+    return "stream_subscriber_rows:%s" % (recipient_id,)
+
+# The UserProfile fields that get_stream_subscriber_rows depends on.
+stream_subscriber_rows_user_fields = [
+    'is_active', 'enable_stream_push_notifications',
+    'enable_stream_email_notifications',
+]  # type: List[str]
+
+def delete_stream_subscriber_rows_cache(recipient_ids: Iterable[int]) -> None:
+    cache_delete_many([stream_subscriber_rows_cache_key(recipient_id)
+                       for recipient_id in recipient_ids])
+
 def get_stream_cache_key(stream_name: str, realm_id: int) -> str:
     return "stream_by_realm_and_name:%s:%s" % (
         realm_id, make_safe_digest(stream_name.strip().lower()))
@@ -434,6 +456,18 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(kwargs, ['email', 'full_name', 'short_name', 'id', 'is_mirror_dummy']):
         delete_display_recipient_cache(user_profile)
 
+    # Unlike the checks above, this one requires a query, so we skip
+    # it for saves without update_fields; the code changing these
+    # fields always passes update_fields.
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and \
+            not set(update_fields).isdisjoint(stream_subscriber_rows_user_fields):
+        from zerver.models import Recipient, Subscription
+        delete_stream_subscriber_rows_cache(Subscription.objects.filter(
+            user_profile=user_profile,
+            recipient__type=Recipient.STREAM,
+        ).values_list('recipient_id', flat=True))
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(kwargs, bot_dict_fields):
@@ -444,6 +478,7 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(kwargs, ['alert_words']):
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
         cache_delete(realm_alert_words_automaton_cache_key(user_profile.realm))
+        flush_realm_render_context(user_profile.realm_id)
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -460,6 +495,7 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
         cache_delete(realm_alert_words_automaton_cache_key(realm))
+        flush_realm_render_context(realm.id)
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
         cache_delete(realm_rendered_description_cache_key(realm))
         cache_delete(realm_text_description_cache_key(realm))
@@ -474,6 +510,75 @@ def realm_alert_words_cache_key(realm: 'Realm') -> str:
 def realm_alert_words_automaton_cache_key(realm: 'Realm') -> str:
     return "realm_alert_words_automaton:%s" % (realm.string_id,)
 
+def realm_render_context_version_cache_key(realm_id: int) -> str:
+    return "realm_render_context_version:%s" % (realm_id,)
+
+def get_realm_render_context_version(realm_id: int) -> str:
+    """Returns a token identifying the current version of the per-realm
+    data used to render messages (see bugdown.get_realm_render_context),
+    which changes whenever flush_realm_render_context is called."""
+    key = realm_render_context_version_cache_key(realm_id)
+    version = cache_get(key)
+    if version is not None:
+        return version[0]
+    new_version = base64.b16encode(os.urandom(8)).decode()
+    cache_set(key, new_version, timeout=3600*24*7)
+    return new_version
+
+def flush_realm_render_context(realm_id: int) -> None:
+    cache_delete(realm_render_context_version_cache_key(realm_id))
+
+def realm_search_results_version_cache_key(realm_id: int) -> str:
+    return "realm_search_results_version:%s" % (realm_id,)
+
+def user_search_results_version_cache_key(user_profile_id: int) -> str:
+    return "user_search_results_version:%s" % (user_profile_id,)
+
+def get_search_results_version(realm_id: int, user_profile_id: int) -> str:
+    """Returns a token identifying the current version of a user's
+    cached search results (see views.messages.get_search_message_ids),
+    which changes whenever flush_realm_search_results or
+    flush_user_search_results is called for them."""
+    keys = [realm_search_results_version_cache_key(realm_id),
+            user_search_results_version_cache_key(user_profile_id)]
+    versions = cache_get_many(keys)
+    new_versions = {}  # type: Dict[str, Tuple[str]]
+    for key in keys:
+        if key not in versions:
+            new_versions[key] = (base64.b16encode(os.urandom(8)).decode(),)
+    if new_versions:
+        cache_set_many(new_versions, timeout=3600*24*7)
+        versions.update(new_versions)
+    return ":".join(versions[key][0] for key in keys)
+
+def flush_realm_search_results(realm_id: int) -> None:
+    cache_delete(realm_search_results_version_cache_key(realm_id))
+
+def flush_user_search_results(user_profile_ids: Iterable[int]) -> None:
+    cache_delete_many(user_search_results_version_cache_key(user_profile_id)
+                      for user_profile_id in user_profile_ids)
+
+def search_results_cache_key(user_profile_id: int, version: str, narrow_digest: str) -> str:
+    return "search_results:%s:%s:%s" % (user_profile_id, version, narrow_digest)
+
+def unread_summary_cache_key(user_profile_id: int) -> str:
+    return "unread_summary:%s" % (user_profile_id,)
+
+def unread_summary_lock_cache_key(user_profile_id: int) -> str:
+    return "unread_summary_lock:%s" % (user_profile_id,)
+
+def flush_unread_summaries(user_profile_ids: Iterable[int]) -> None:
+    """Flushes the unread summaries (see message.get_unread_conversations) of
+    the given users.  This needs to be called whenever their unread
+    UserMessage rows change other than by new messages being sent."""
+    cache_delete_many(unread_summary_cache_key(user_profile_id)
+                      for user_profile_id in user_profile_ids)
+
+def flush_realm_unread_summaries(realm_id: int) -> None:
+    from zerver.models import UserProfile
+    flush_unread_summaries(UserProfile.objects.filter(
+        realm_id=realm_id).values_list('id', flat=True))
+
 def realm_rendered_description_cache_key(realm: 'Realm') -> str:
     return "realm_rendered_description:%s" % (realm.string_id,)
 
@@ -495,6 +600,14 @@ def flush_stream(sender: Any, **kwargs: Any) -> None:
            Q(default_events_register_stream=stream)).exists():
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
+# Called by models.py to flush the stream subscriber cache whenever we
+# save a Subscription object; bulk updates of subscriptions need to
+# call delete_stream_subscriber_rows_cache themselves.
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    subscription = kwargs['instance']
+    if changed(kwargs, ['active', 'is_muted', 'push_notifications', 'email_notifications']):
+        delete_stream_subscriber_rows_cache([subscription.recipient_id])
+
 def flush_used_upload_space_cache(sender: Any, **kwargs: Any) -> None:
     attachment = kwargs['instance']
 
@@ -507,6 +620,10 @@ def to_dict_cache_key_id(message_id: int) -> str:
 def to_dict_cache_key(message: 'Message') -> str:
     return to_dict_cache_key_id(message.id)
 
+def message_payload_cache_key(message_id: int, apply_markdown: bool,
+                              client_gravatar: bool) -> str:
+    return 'message_payload:%d:%d:%d' % (message_id, apply_markdown, client_gravatar)
+
 def open_graph_description_cache_key(content: Any, request: HttpRequest) -> str:
     return 'open_graph_description_path:%s' % (make_safe_digest(request.META['PATH_INFO']),)
 
@@ -1,7 +1,7 @@
 import time
 from psycopg2.extensions import cursor, connection
 
-from typing import Callable, Optional, Iterable, Any, Dict, List, Union, TypeVar, \
+from typing import Callable, Optional, Iterable, Any, Dict, IO, List, Union, TypeVar, \
     Mapping
 
 CursorObj = TypeVar('CursorObj', bound=cursor)
@@ -34,6 +34,16 @@ class TimeTrackingCursor(cursor):
                     vars: Iterable[Any]) -> 'TimeTrackingCursor':
         return wrapper_execute(self, super().executemany, query, vars)
 
+    def copy_expert(self, sql: str, file: IO[Any], size: int=8192) -> None:
+        start = time.time()
+        try:
+            super().copy_expert(sql, file, size)
+        finally:
+            duration = time.time() - start
+            self.connection.queries.append({
+                'time': "%.3f" % (duration,),
+            })
+
 class TimeTrackingConnection(connection):
     """A psycopg2 connection class that uses TimeTrackingCursors."""
 
@@ -202,6 +202,10 @@ NON_EXPORTED_TABLES = {
     # This is low priority, since users can easily just reset themselves to away.
     'zerver_userstatus',
 
+    # This is maintained by a database trigger on zerver_message, and
+    # thus rebuilt as the messages are imported.
+    'zerver_streamtopic',
+
     # For any tables listed below here, it's a bug that they are not present in the export.
 }
 
@@ -1,8 +1,17 @@
+import base64
+import bisect
 import datetime
+import hashlib
+import heapq
+import os
+import pickle
+import time
 import ujson
 import zlib
 import ahocorasick
 
+from array import array
+
 from django.utils.translation import ugettext as _
 from django.utils.timezone import now as timezone_now
 from django.db import connection
@@ -13,10 +22,20 @@ from analytics.lib.counts import COUNT_STATS, RealmCount
 from zerver.lib.avatar import get_avatar_field
 import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import (
+    cache_add,
+    cache_delete,
+    cache_get,
+    cache_set,
     cache_with_key,
+    cache_get_many,
+    cache_set_many,
     generic_bulk_cached_fetch,
+    message_payload_cache_key,
     to_dict_cache_key,
     to_dict_cache_key_id,
+    flush_unread_summaries,
+    unread_summary_cache_key,
+    unread_summary_lock_cache_key,
 )
 from zerver.lib.request import JsonableError
 from zerver.lib.stream_subscription import (
@@ -78,6 +97,49 @@ UnreadMessagesResult = TypedDict('UnreadMessagesResult', {
 # user has more older unread messages that were cut off.
 MAX_UNREAD_MESSAGES = 50000
 
+# A user's unread messages, grouped by conversation: maps (recipient_id,
+# recipient type, recipient type_id, topic) to arrays of the IDs of its
+# unread messages, in increasing order, of their senders' IDs, and of
+# the IDs of those that mention the user.  Arrays keep the cached
+# summaries (see get_unread_conversations) compact.
+UnreadConversation = Tuple['array[int]', 'array[int]', 'array[int]']
+UnreadConversations = Dict[Tuple[int, int, int, str], UnreadConversation]
+
+UnreadSummary = TypedDict('UnreadSummary', {
+    'version': str,
+    'max_message_id': int,
+    'conversations': UnreadConversations,
+    'pending_message_id': Optional[int],
+    'pending_time': float,
+})
+
+# We don't cache unread summaries that compress to more than this, to
+# stay well below memcached's default 1MB limit on the size of a value.
+# In practice, even a summary of MAX_UNREAD_MESSAGES messages is much
+# smaller, unless they're spread over a huge number of topics.
+MAX_UNREAD_SUMMARY_BYTES = 768 * 1024
+
+# How long one can hold the lock on a user's cached unread summary
+# (see save_unread_summary), and how long we wait for it.
+UNREAD_SUMMARY_LOCK_SECONDS = 2
+UNREAD_SUMMARY_LOCK_WAIT_SECONDS = 0.5
+
+# The fields of a message's sender that end up in its payload; see
+# MessageDict.bulk_get_sender_rows.
+SENDER_INFO_FIELDS = [
+    'full_name',
+    'short_name',
+    'email',
+    'realm__string_id',
+    'avatar_source',
+    'avatar_version',
+    'is_mirror_dummy',
+]
+
+# How long we wait after seeing an unread message before adding it
+# to a user's cached unread summary; see get_unread_conversations.
+UNREAD_SUMMARY_SETTLE_SECONDS = 60
+
 def messages_for_ids(message_ids: List[int],
                      user_message_flags: Dict[int, List[str]],
                      search_fields: Dict[int, Dict[str, str]],
@@ -85,22 +147,27 @@ def messages_for_ids(message_ids: List[int],
                      client_gravatar: bool,
                      allow_edit_history: bool) -> List[Dict[str, Any]]:
 
-    cache_transformer = MessageDict.build_dict_from_raw_db_row
+    cache_transformer = lambda row: stringify_message_dict(
+        MessageDict.build_dict_from_raw_db_row(row))
     id_fetcher = lambda row: row['id']
 
-    message_dicts = generic_bulk_cached_fetch(
+    # We leave the to_dict cache entries compressed here; we only need
+    # to decompress those that don't have a usable cached payload.
+    message_jsons = generic_bulk_cached_fetch(
         to_dict_cache_key_id,
         MessageDict.get_raw_db_rows,
         message_ids,
         id_fetcher=id_fetcher,
         cache_transformer=cache_transformer,
-        extractor=extract_message_dict,
-        setter=stringify_message_dict)
+        extractor=lambda message_json: message_json,
+        setter=lambda message_json: message_json)
+
+    message_payloads = get_message_payloads(message_jsons, apply_markdown, client_gravatar)
 
     message_list = []  # type: List[Dict[str, Any]]
 
     for message_id in message_ids:
-        msg_dict = message_dicts[message_id]
+        msg_dict = message_payloads[message_id]
         msg_dict.update({"flags": user_message_flags[message_id]})
         if message_id in search_fields:
             msg_dict.update(search_fields[message_id])
@@ -110,10 +177,69 @@ def messages_for_ids(message_ids: List[int],
             del msg_dict["edit_history"]
         message_list.append(msg_dict)
 
-    MessageDict.post_process_dicts(message_list, apply_markdown, client_gravatar)
-
     return message_list
 
+def get_message_payloads(message_jsons: Dict[int, bytes],
+                         apply_markdown: bool,
+                         client_gravatar: bool) -> Dict[int, Dict[str, Any]]:
+    '''
+    Returns the finalized payloads (see MessageDict.post_process_dicts)
+    for the given to_dict cache entries, minus the per-user fields.
+
+    Each payload variant is cached alongside the to_dict cache entry
+    it was built from.  A cached payload is only used if that entry is
+    unchanged (we check a digest of it, so we don't need to flush
+    payloads everywhere we update the to_dict cache) and if the
+    sender's details haven't changed since (which we still fetch in a
+    single query, as post_process_dicts does).
+    '''
+    payload_keys = {
+        message_id: message_payload_cache_key(message_id, apply_markdown, client_gravatar)
+        for message_id in message_jsons
+    }
+    cached_payloads = cache_get_many(list(payload_keys.values()))
+
+    source_digests = {}  # type: Dict[int, str]
+    cached_senders = {}  # type: Dict[int, Tuple[int, Tuple[Any, ...], bytes]]
+    objs = {}  # type: Dict[int, Dict[str, Any]]
+    for message_id, message_json in message_jsons.items():
+        source_digest = hashlib.sha1(message_json).hexdigest()
+        source_digests[message_id] = source_digest
+        cached = cached_payloads.get(payload_keys[message_id])
+        if cached is not None and cached[0] == source_digest:
+            cached_senders[message_id] = cached[1:]
+        else:
+            objs[message_id] = extract_message_dict(message_json)
+
+    sender_ids = {sender_id for (sender_id, snapshot, payload) in cached_senders.values()}
+    sender_ids |= {obj['sender_id'] for obj in objs.values()}
+    sender_rows = MessageDict.bulk_get_sender_rows(list(sender_ids))
+
+    payloads = {}  # type: Dict[int, Dict[str, Any]]
+    for message_id, (sender_id, snapshot, payload) in cached_senders.items():
+        if snapshot == MessageDict.sender_snapshot(sender_rows[sender_id]):
+            payloads[message_id] = extract_message_dict(payload)
+        else:
+            objs[message_id] = extract_message_dict(message_jsons[message_id])
+
+    items_for_remote_cache = {}  # type: Dict[str, Tuple[str, int, Tuple[Any, ...], bytes]]
+    for message_id, obj in objs.items():
+        sender_row = sender_rows[obj['sender_id']]
+        MessageDict.hydrate_sender_info(obj, sender_row)
+        MessageDict.hydrate_recipient_info(obj)
+        MessageDict.finalize_payload(obj, apply_markdown, client_gravatar)
+        payloads[message_id] = obj
+        items_for_remote_cache[payload_keys[message_id]] = (
+            source_digests[message_id],
+            obj['sender_id'],
+            MessageDict.sender_snapshot(sender_row),
+            stringify_message_dict(obj),
+        )
+
+    if items_for_remote_cache:
+        cache_set_many(items_for_remote_cache)
+    return payloads
+
 def sew_messages_and_reactions(messages: List[Dict[str, Any]],
                                reactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Given a iterable of messages and reactions stitch reactions
@@ -386,37 +512,39 @@ class MessageDict:
             for obj in objs
         })
 
+        sender_dict = MessageDict.bulk_get_sender_rows(sender_ids)
+
+        for obj in objs:
+            sender_id = obj['sender_id']
+            MessageDict.hydrate_sender_info(obj, sender_dict[sender_id])
+
+    @staticmethod
+    def bulk_get_sender_rows(sender_ids: List[int]) -> Dict[int, Dict[str, Any]]:
         if not sender_ids:
-            return
+            return {}
 
-        query = UserProfile.objects.values(
-            'id',
-            'full_name',
-            'short_name',
-            'email',
-            'realm__string_id',
-            'avatar_source',
-            'avatar_version',
-            'is_mirror_dummy',
-        )
+        query = UserProfile.objects.values('id', *SENDER_INFO_FIELDS)
 
         rows = query_for_ids(query, sender_ids, 'zerver_userprofile.id')
 
-        sender_dict = {
+        return {
             row['id']: row
             for row in rows
         }
 
-        for obj in objs:
-            sender_id = obj['sender_id']
-            user_row = sender_dict[sender_id]
-            obj['sender_full_name'] = user_row['full_name']
-            obj['sender_short_name'] = user_row['short_name']
-            obj['sender_email'] = user_row['email']
-            obj['sender_realm_str'] = user_row['realm__string_id']
-            obj['sender_avatar_source'] = user_row['avatar_source']
-            obj['sender_avatar_version'] = user_row['avatar_version']
-            obj['sender_is_mirror_dummy'] = user_row['is_mirror_dummy']
+    @staticmethod
+    def sender_snapshot(user_row: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(user_row[field] for field in SENDER_INFO_FIELDS)
+
+    @staticmethod
+    def hydrate_sender_info(obj: Dict[str, Any], user_row: Dict[str, Any]) -> None:
+        obj['sender_full_name'] = user_row['full_name']
+        obj['sender_short_name'] = user_row['short_name']
+        obj['sender_email'] = user_row['email']
+        obj['sender_realm_str'] = user_row['realm__string_id']
+        obj['sender_avatar_source'] = user_row['avatar_source']
+        obj['sender_avatar_version'] = user_row['avatar_version']
+        obj['sender_is_mirror_dummy'] = user_row['is_mirror_dummy']
 
     @staticmethod
     def hydrate_recipient_info(obj: Dict[str, Any]) -> None:
@@ -583,7 +711,8 @@ def render_markdown(message: Message,
                     realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                     user_ids: Optional[Set[int]]=None,
                     mention_data: Optional[bugdown.MentionData]=None,
-                    email_gateway: Optional[bool]=False) -> str:
+                    email_gateway: Optional[bool]=False,
+                    render_context: Optional[bugdown.RealmRenderContext]=None) -> str:
     '''
     This is basically just a wrapper for do_render_markdown.
     '''
@@ -610,6 +739,7 @@ def render_markdown(message: Message,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
         email_gateway=email_gateway,
+        render_context=render_context,
     )
 
     return rendered_content
@@ -622,7 +752,8 @@ def do_render_markdown(message: Message,
                        translate_emoticons: bool,
                        realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None,
                        mention_data: Optional[bugdown.MentionData]=None,
-                       email_gateway: Optional[bool]=False) -> str:
+                       email_gateway: Optional[bool]=False,
+                       render_context: Optional[bugdown.RealmRenderContext]=None) -> str:
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
     `mentions_wildcard`.  These are only on this Django object and are not
@@ -645,7 +776,8 @@ def do_render_markdown(message: Message,
         sent_by_bot=sent_by_bot,
         translate_emoticons=translate_emoticons,
         mention_data=mention_data,
-        email_gateway=email_gateway
+        email_gateway=email_gateway,
+        render_context=render_context,
     )
     return rendered_content
 
@@ -755,12 +887,47 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
         'message_id'
     ).values_list('message_id', flat=True)[0:10000])
 
-def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
-
-    excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
+def get_unread_conversations(user_profile: UserProfile,
+                             excluded_recipient_ids: List[int]) -> UnreadConversations:
+    """Returns the user's unread messages, grouped by conversation.
+
+    So that we don't need to scan all of a user's unread UserMessage
+    rows on every page load, we cache a summary of them, which contains
+    every unread message with an ID <= its max_message_id; we only
+    fetch the unread rows with higher IDs, i.e. generally just the
+    messages sent since our previous call.  This means sending
+    messages doesn't need to touch the summary; code that otherwise
+    changes a user's unread UserMessage rows (marking messages as
+    read, editing or deleting messages, subscribing, etc.) needs to
+    call flush_unread_summaries, or, when just marking messages as read,
+    remove_read_messages_from_unread_summary.
+
+    A message with a lower ID than the rows we fetch may still be
+    being sent in an uncommitted transaction, so we can't just advance
+    max_message_id to the highest ID we've fetched.  Instead, we advance
+    it to the highest ID we'd fetched on a previous call, as long as
+    that was at least UNREAD_SUMMARY_SETTLE_SECONDS ago.
+
+    Messages in excluded_recipient_ids aren't fetched, but may be in
+    the summary; the caller is responsible for filtering them out.
+    """
+    cached = get_unread_summary(user_profile.id)
+    if cached is not None:
+        summary = cached
+        base_version = summary['version']  # type: Optional[str]
+    else:
+        summary = dict(
+            version='',
+            max_message_id=0,
+            conversations={},
+            pending_message_id=None,
+            pending_time=0,
+        )
+        base_version = None
 
     user_msgs = UserMessage.objects.filter(
-        user_profile=user_profile
+        user_profile=user_profile,
+        message_id__gt=summary['max_message_id'],
     ).exclude(
         message__recipient_id__in=excluded_recipient_ids
     ).extra(
@@ -776,9 +943,164 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     ).order_by("-message_id")
 
     # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    rows = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    changed = cached is None
+
+    conversations = summary['conversations']
+    if len(rows) == MAX_UNREAD_MESSAGES and conversations:
+        # Any older unread messages are past the limit anyway.
+        conversations.clear()
+        changed = True
+
+    now = time.time()
+    pending_message_id = summary['pending_message_id']
+    settled = (pending_message_id is not None and
+               now - summary['pending_time'] >= UNREAD_SUMMARY_SETTLE_SECONDS)
+    if settled:
+        summary['max_message_id'] = pending_message_id
+        summary['pending_message_id'] = None
+        changed = True
+
+    unsettled_rows = []
+    for row in reversed(rows):
+        if row['message_id'] <= summary['max_message_id']:
+            add_unread_row(conversations, row)
+        else:
+            unsettled_rows.append(row)
+
+    if unsettled_rows and summary['pending_message_id'] is None:
+        summary['pending_message_id'] = unsettled_rows[-1]['message_id']
+        summary['pending_time'] = now
+        changed = True
+
+    if changed:
+        save_unread_summary(user_profile.id, summary, base_version, wait=False)
+
+    # The unsettled rows are only added after caching the summary.
+    for row in unsettled_rows:
+        add_unread_row(conversations, row)
+    return conversations
+
+def add_unread_row(conversations: UnreadConversations, row: Dict[str, Any]) -> None:
+    conversation = (
+        row['message__recipient_id'],
+        row['message__recipient__type'],
+        row['message__recipient__type_id'],
+        row[MESSAGE__TOPIC],
+    )
+    if conversation not in conversations:
+        conversations[conversation] = (array('i'), array('i'), array('i'))
+    (message_ids, sender_ids, mentioned_message_ids) = conversations[conversation]
+    message_ids.append(row['message_id'])
+    sender_ids.append(row['message__sender_id'])
+    if row['flags'] & UserMessage.flags.mentioned:
+        mentioned_message_ids.append(row['message_id'])
+
+def get_unread_summary(user_profile_id: int) -> Optional[UnreadSummary]:
+    cached = cache_get(unread_summary_cache_key(user_profile_id))
+    if cached is None:
+        return None
+    return pickle.loads(zlib.decompress(cached[0]))
+
+def save_unread_summary(user_profile_id: int, summary: UnreadSummary,
+                        base_version: Optional[str], wait: bool) -> bool:
+    """Caches the user's unread summary, as long as the cached one is
+    still the one it's based on, i.e. the one with base_version (None
+    meaning there was none); returns whether it did.
+
+    Since this is a read-modify-write of the cached summary, we hold
+    a lock on it meanwhile, waiting for the lock if `wait` is set.
+    Flushing the summary doesn't take the lock; it makes any save based
+    on the flushed summary fail, unless that save has already checked
+    the version (the usual race between filling a cache and flushing it).
+    """
+    lock_key = unread_summary_lock_cache_key(user_profile_id)
+    wait_until = time.time() + (UNREAD_SUMMARY_LOCK_WAIT_SECONDS if wait else 0)
+    while not cache_add(lock_key, True, timeout=UNREAD_SUMMARY_LOCK_SECONDS):
+        if time.time() >= wait_until:
+            return False
+        time.sleep(0.01)
+
+    try:
+        cached = get_unread_summary(user_profile_id)
+        if (cached['version'] if cached is not None else None) != base_version:
+            return False
+
+        summary['version'] = base64.b16encode(os.urandom(8)).decode()
+        value = zlib.compress(pickle.dumps(summary, protocol=pickle.HIGHEST_PROTOCOL))
+        if len(value) > MAX_UNREAD_SUMMARY_BYTES:
+            # Too big to cache; the previous summary, if any, is
+            # out of date.
+            flush_unread_summaries([user_profile_id])
+            return False
+        cache_set(unread_summary_cache_key(user_profile_id), value, timeout=3600*24)
+        return True
+    finally:
+        cache_delete(lock_key)
+
+def remove_read_messages_from_unread_summary(user_profile_id: int,
+                                             message_ids: Optional[List[int]]) -> None:
+    """Updates the user's cached unread summary (see
+    get_unread_conversations) after the given messages, or all of the
+    user's messages if message_ids is None, have been marked as read;
+    unlike flushing it, this doesn't mean the user's next page load
+    needs to fetch all of their unread messages again."""
+    summary = get_unread_summary(user_profile_id)
+    if summary is None:
+        return
+
+    conversations = summary['conversations']
+    if message_ids is None:
+        conversations.clear()
+    else:
+        read_ids = sorted(set(message_ids))
+        for (conversation, (unread_ids, sender_ids, mentioned_ids)) in list(conversations.items()):
+            # Most conversations' messages are nowhere near the ones
+            # marked as read.
+            start = bisect.bisect_left(read_ids, unread_ids[0])
+            end = bisect.bisect_right(read_ids, unread_ids[-1])
+            if start == end:
+                continue
+            conversation_read_ids = set(read_ids[start:end])
+            kept = [i for (i, message_id) in enumerate(unread_ids)
+                    if message_id not in conversation_read_ids]
+            if len(kept) == len(unread_ids):
+                continue
+            if not kept:
+                del conversations[conversation]
+                continue
+            conversations[conversation] = (
+                array('i', (unread_ids[i] for i in kept)),
+                array('i', (sender_ids[i] for i in kept)),
+                array('i', (message_id for message_id in mentioned_ids
+                            if message_id not in conversation_read_ids)),
+            )
+
+    if not save_unread_summary(user_profile_id, summary, summary['version'], wait=True):
+        # Someone else changed the summary meanwhile, or held the lock
+        # for too long; we can't tell whether it's up to date.
+        flush_unread_summaries([user_profile_id])
+
+def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
+
+    excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
+
+    conversations = get_unread_conversations(user_profile, excluded_recipient_ids)
+    excluded_recipient_id_set = set(excluded_recipient_ids)
+    conversation_items = sorted(
+        (messages[0][0], conversation, messages)
+        for (conversation, messages) in conversations.items()
+        if conversation[0] not in excluded_recipient_id_set
+    )
 
-    rows = list(reversed(user_msgs))
+    # The summary may contain more than MAX_UNREAD_MESSAGES messages,
+    # in which case we only return the most recent ones.
+    min_message_id = 0
+    if sum(len(messages[0]) for (_, _, messages) in conversation_items) > MAX_UNREAD_MESSAGES:
+        min_message_id = heapq.nlargest(
+            MAX_UNREAD_MESSAGES,
+            (message_id for (_, _, messages) in conversation_items for message_id in messages[0]),
+        )[-1]
 
     muted_stream_ids = get_muted_stream_ids(user_profile)
 
@@ -793,53 +1115,50 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
         return False
 
-    huddle_cache = {}  # type: Dict[int, str]
-
-    def get_huddle_users(recipient_id: int) -> str:
-        if recipient_id in huddle_cache:
-            return huddle_cache[recipient_id]
-
-        user_ids_string = huddle_users(recipient_id)
-        huddle_cache[recipient_id] = user_ids_string
-        return user_ids_string
-
     pm_dict = {}
     stream_dict = {}
     unmuted_stream_msgs = set()
     huddle_dict = {}
     mentions = set()
 
-    for row in rows:
-        message_id = row['message_id']
-        msg_type = row['message__recipient__type']
-        recipient_id = row['message__recipient_id']
-        sender_id = row['message__sender_id']
-
+    # Each conversation's messages are in increasing ID order, and we
+    # process the conversations in order of their oldest message, so
+    # that aggregate_unread_data lists them the same way it would if
+    # we'd processed all the messages in increasing ID order.
+    for (_, conversation, (message_ids, sender_ids, mentioned_ids)) in conversation_items:
+        (recipient_id, msg_type, type_id, topic) = conversation
         if msg_type == Recipient.STREAM:
-            stream_id = row['message__recipient__type_id']
-            topic = row[MESSAGE__TOPIC]
-            stream_dict[message_id] = dict(
-                stream_id=stream_id,
-                topic=topic,
-                sender_id=sender_id,
-            )
-            if not is_row_muted(stream_id, recipient_id, topic):
-                unmuted_stream_msgs.add(message_id)
+            is_muted = is_row_muted(type_id, recipient_id, topic)
+            for (message_id, sender_id) in zip(message_ids, sender_ids):
+                if message_id < min_message_id:
+                    continue
+                stream_dict[message_id] = dict(
+                    stream_id=type_id,
+                    topic=topic,
+                    sender_id=sender_id,
+                )
+                if not is_muted:
+                    unmuted_stream_msgs.add(message_id)
 
         elif msg_type == Recipient.PERSONAL:
-            pm_dict[message_id] = dict(
-                sender_id=sender_id,
-            )
+            for (message_id, sender_id) in zip(message_ids, sender_ids):
+                if message_id < min_message_id:
+                    continue
+                pm_dict[message_id] = dict(
+                    sender_id=sender_id,
+                )
 
         elif msg_type == Recipient.HUDDLE:
-            user_ids_string = get_huddle_users(recipient_id)
-            huddle_dict[message_id] = dict(
-                user_ids_string=user_ids_string,
-            )
-
-        is_mentioned = (row['flags'] & UserMessage.flags.mentioned) != 0
-        if is_mentioned:
-            mentions.add(message_id)
+            user_ids_string = huddle_users(recipient_id)
+            for message_id in message_ids:
+                if message_id < min_message_id:
+                    continue
+                huddle_dict[message_id] = dict(
+                    user_ids_string=user_ids_string,
+                )
+
+        mentions.update(message_id for message_id in mentioned_ids
+                        if message_id >= min_message_id)
 
     return dict(
         pm_dict=pm_dict,
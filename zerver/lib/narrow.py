@@ -7,7 +7,7 @@ from zerver.lib.topic import (
 from django.conf import settings
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Set
 
 stop_words_list = None  # type: Optional[List[str]]
 def read_stop_words() -> List[str]:
@@ -36,41 +36,66 @@ def is_web_public_compatible(narrow: Iterable[Dict[str, str]]) -> bool:
 
 def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[str, Any]], bool]:
     """Changes to this function should come with corresponding changes to
-    BuildNarrowFilterTest."""
+    BuildNarrowFilterTest.
+
+    The narrow is compiled once, up front, into the handful of checks
+    it implies (with operands already lowercased), since the returned
+    filter is run on every message event for a narrowed event queue.
+    """
     check_supported_events_narrow_filter(narrow)
 
+    message_types = set()  # type: Set[str]
+    streams = set()  # type: Set[str]
+    topics = set()  # type: Set[str]
+    senders = set()  # type: Set[str]
+    required_flags = set()  # type: Set[str]
+    exclude_read = False
+    for element in narrow:
+        operator = element[0]
+        operand = element[1]
+        if operator == "stream":
+            message_types.add("stream")
+            streams.add(operand.lower())
+        elif operator == "topic":
+            message_types.add("stream")
+            topics.add(operand.lower())
+        elif operator == "sender":
+            senders.add(operand.lower())
+        elif operator == "is" and operand == "private":
+            message_types.add("private")
+        elif operator == "is" and operand in ["starred"]:
+            required_flags.add(operand)
+        elif operator == "is" and operand == "unread":
+            exclude_read = True
+        elif operator == "is" and operand in ["alerted", "mentioned"]:
+            required_flags.add("mentioned")
+
+    if len(message_types) > 1 or len(streams) > 1 or len(topics) > 1 or len(senders) > 1:
+        # No message can match contradictory operators.
+        return lambda event: False
+
+    message_type = message_types.pop() if message_types else None
+    stream = streams.pop() if streams else None
+    topic = topics.pop() if topics else None
+    sender = senders.pop() if senders else None
+    check_flags = len(required_flags) > 0 or exclude_read
+
     def narrow_filter(event: Mapping[str, Any]) -> bool:
         message = event["message"]
-        flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
-            if operator == "stream":
-                if message["type"] != "stream":
-                    return False
-                if operand.lower() != message["display_recipient"].lower():
-                    return False
-            elif operator == "topic":
-                if message["type"] != "stream":
-                    return False
-                topic_name = get_topic_from_message_info(message)
-                if operand.lower() != topic_name.lower():
-                    return False
-            elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
-                    return False
-            elif operator == "is" and operand == "private":
-                if message["type"] != "private":
-                    return False
-            elif operator == "is" and operand in ["starred"]:
-                if operand not in flags:
-                    return False
-            elif operator == "is" and operand == "unread":
-                if "read" in flags:
-                    return False
-            elif operator == "is" and operand in ["alerted", "mentioned"]:
-                if "mentioned" not in flags:
+        if message_type is not None and message["type"] != message_type:
+            return False
+        if stream is not None and message["display_recipient"].lower() != stream:
+            return False
+        if topic is not None and get_topic_from_message_info(message).lower() != topic:
+            return False
+        if sender is not None and message["sender_email"].lower() != sender:
+            return False
+        if check_flags:
+            flags = event["flags"]
+            for flag in required_flags:
+                if flag not in flags:
                     return False
-
+            if exclude_read and "read" in flags:
+                return False
         return True
     return narrow_filter
@@ -5,11 +5,13 @@ from django.db import connection, transaction
 from django.db.models import Model
 from django.utils.timezone import now as timezone_now
 
+from zerver.lib.cache import flush_realm_search_results, flush_realm_unread_summaries, \
+    flush_unread_summaries
 from zerver.lib.logging_util import log_to_file
 from zerver.models import (Message, UserMessage, ArchivedUserMessage, Realm,
                            Attachment, ArchivedAttachment, Reaction, ArchivedReaction,
                            SubMessage, ArchivedSubMessage, Recipient, Stream, ArchiveTransaction,
-                           get_stream_recipients, get_user_including_cross_realm)
+                           UserProfile, get_stream_recipients, get_user_including_cross_realm)
 
 from typing import Any, Dict, List, Optional
 
@@ -270,6 +272,9 @@ def archive_messages_by_recipient(recipient: Recipient, message_retention_days:
 def archive_personal_and_huddle_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
     logger.info("Archiving personal and huddle messages for realm " + realm.string_id)
     message_count = move_expired_personal_and_huddle_messages_to_archive(realm, chunk_size)
+    if message_count:
+        flush_realm_unread_summaries(realm.id)
+        flush_realm_search_results(realm.id)
     logger.info("Done. Archived {} messages".format(message_count))
 
 def archive_stream_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) -> None:
@@ -295,6 +300,9 @@ def archive_stream_messages(realm: Realm, chunk_size: int=MESSAGE_BATCH_SIZE) ->
         message_count += archive_messages_by_recipient(
             recipient, retention_policy_dict[recipient.type_id], realm, chunk_size
         )
+    if message_count:
+        flush_realm_unread_summaries(realm.id)
+        flush_realm_search_results(realm.id)
 
     logger.info("Done. Archived {} messages.".format(message_count))
 
@@ -403,6 +411,19 @@ def restore_data_from_archive(archive_transaction: ArchiveTransaction) -> int:
         archive_transaction.restored = True
         archive_transaction.save()
 
+    # Restored messages may be older than what users' unread
+    # summaries and cached search results already cover.
+    if archive_transaction.realm_id is not None:
+        flush_realm_unread_summaries(archive_transaction.realm_id)
+        flush_realm_search_results(archive_transaction.realm_id)
+    else:
+        user_ids = list(UserMessage.objects.filter(
+            message_id__in=msg_ids).values_list('user_profile_id', flat=True).distinct())
+        flush_unread_summaries(user_ids)
+        for realm_id in set(UserProfile.objects.filter(
+                id__in=user_ids).values_list('realm_id', flat=True)):
+            flush_realm_search_results(realm_id)
+
     logger.info("Finished. Restored {} messages".format(len(msg_ids)))
     return len(msg_ids)
 
@@ -9,6 +9,8 @@ from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from typing import DefaultDict, Dict, List, Optional, Union, Any
 
+from zerver.lib.actions import UserMessageLite, bulk_insert_ums
+from zerver.lib.cache import flush_unread_summaries, flush_user_search_results
 from zerver.models import UserProfile, UserMessage, RealmAuditLog, \
     Subscription, Message, Recipient, UserActivity, Realm
 
@@ -19,12 +21,12 @@ BULK_CREATE_BATCH_SIZE = 10000
 def filter_by_subscription_history(user_profile: UserProfile,
                                    all_stream_messages: DefaultDict[int, List[Message]],
                                    all_stream_subscription_logs: DefaultDict[int, List[RealmAuditLog]],
-                                   ) -> List[UserMessage]:
-    user_messages_to_insert = []  # type: List[UserMessage]
+                                   ) -> List[UserMessageLite]:
+    user_messages_to_insert = []  # type: List[UserMessageLite]
 
     def store_user_message_to_insert(message: Message) -> None:
-        message = UserMessage(user_profile=user_profile,
-                              message_id=message['id'], flags=0)
+        message = UserMessageLite(user_profile_id=user_profile.id,
+                                  message_id=message['id'], flags=0)
         user_messages_to_insert.append(message)
 
     for (stream_id, stream_messages_raw) in all_stream_messages.items():
@@ -193,9 +195,11 @@ def add_missing_messages(user_profile: UserProfile) -> None:
         messages, user_messages_to_insert = (
             user_messages_to_insert[0:BULK_CREATE_BATCH_SIZE],
             user_messages_to_insert[BULK_CREATE_BATCH_SIZE:])
-        UserMessage.objects.bulk_create(messages)
+        bulk_insert_ums(messages)
         user_profile.last_active_message_id = messages[-1].message_id
         user_profile.save(update_fields=['last_active_message_id'])
+    flush_unread_summaries([user_profile.id])
+    flush_user_search_results([user_profile.id])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     try:
@@ -1,7 +1,10 @@
+from array import array
 from typing import Any, Dict, List, Tuple
 from typing_extensions import TypedDict
 
+from django.db.models import F
 from django.db.models.query import QuerySet
+from zerver.lib.cache import cache_with_key, stream_subscriber_rows_cache_key
 from zerver.models import (
     Recipient,
     Stream,
@@ -70,6 +73,63 @@ def get_bulk_stream_subscriber_info(
 
     return result
 
+# Bits of the per-subscriber flags returned by get_stream_subscriber_rows.
+STREAM_PUSH_NOTIFY = 1
+STREAM_EMAIL_NOTIFY = 2
+
+def get_stream_notify_flags(row: Dict[str, Any]) -> int:
+    def should_send(setting: str) -> bool:
+        # This implements the structure that the UserProfile stream notification settings
+        # are defaults, which can be overridden by the stream-level settings (if those
+        # values are not null).
+        if row['is_muted']:
+            return False
+        if row[setting] is not None:
+            return row[setting]
+        return row['user_profile_' + setting]
+
+    flags = 0
+    # Note: muting a stream overrides stream_push_notify and stream_email_notify
+    if should_send('push_notifications'):
+        flags |= STREAM_PUSH_NOTIFY
+    if should_send('email_notifications'):
+        flags |= STREAM_EMAIL_NOTIFY
+    return flags
+
+@cache_with_key(stream_subscriber_rows_cache_key, timeout=3600*24*7)
+def get_stream_subscriber_rows(recipient_id: int) -> Tuple['array[int]', bytes]:
+    """Returns the ids of the active users subscribed to a stream, in
+    increasing order, and a byte of STREAM_*_NOTIFY flags for each.
+
+    This is what sending a message to the stream needs to know about
+    its subscribers, in a compact form, since it is cached for streams
+    with tens of thousands of subscribers.  The cache is flushed by
+    bulk_add_subscriptions and bulk_remove_subscriptions, and when a
+    Subscription or the relevant UserProfile fields are saved (see
+    flush_subscription and flush_user_profile)."""
+    rows = Subscription.objects.filter(
+        recipient_id=recipient_id,
+        active=True,
+        user_profile__is_active=True,
+    ).annotate(
+        user_profile_email_notifications=F('user_profile__enable_stream_email_notifications'),
+        user_profile_push_notifications=F('user_profile__enable_stream_push_notifications'),
+    ).values(
+        'user_profile_id',
+        'push_notifications',
+        'email_notifications',
+        'user_profile_email_notifications',
+        'user_profile_push_notifications',
+        'is_muted',
+    ).order_by('user_profile_id')
+
+    user_ids = array('i')
+    flags = bytearray()
+    for row in rows:
+        user_ids.append(row['user_profile_id'])
+        flags.append(get_stream_notify_flags(row))
+    return (user_ids, bytes(flags))
+
 def num_subscribers_for_stream_id(stream_id: int) -> int:
     return get_active_subscriptions_for_stream_id(stream_id).filter(
         user_profile__is_active=True,
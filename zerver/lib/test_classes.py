@@ -47,6 +47,7 @@ from zerver.models import (
     get_stream,
     get_client,
     get_display_recipient,
+    get_huddle_recipient_ids,
     get_user,
     get_realm,
     get_system_bot,
@@ -60,6 +61,7 @@ from zerver.models import (
 )
 from zilencer.models import get_remote_server_by_uuid
 from zerver.decorator import do_two_factor_login
+from zerver.lib.bugdown import clear_realm_render_contexts
 from zerver.tornado.event_queue import clear_client_event_queues_for_testing
 
 import base64
@@ -104,6 +106,8 @@ class ZulipTestCase(TestCase):
         # Important: we need to clear event queues to avoid leaking data to future tests.
         clear_client_event_queues_for_testing()
         clear_supported_auth_backends_cache()
+        clear_realm_render_contexts()
+        get_huddle_recipient_ids.cache_clear()
         flush_per_request_caches()
         translation.activate(settings.LANGUAGE_CODE)
 
@@ -693,6 +697,7 @@ class ZulipTestCase(TestCase):
         '''
         with \
                 self.settings(ERROR_BOT=None), \
+                mock.patch('zerver.lib.bugdown.is_plain_text', return_value=False), \
                 mock.patch('zerver.lib.bugdown.timeout', side_effect=KeyError('foo')), \
                 mock.patch('zerver.lib.bugdown.bugdown_logger'):
             yield
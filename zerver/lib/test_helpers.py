@@ -178,10 +178,26 @@ def queries_captured(include_savepoints: Optional[bool]=False) -> Generator[
         return wrapper_execute(self, super(TimeTrackingCursor, self).executemany, sql, params)  # type: ignore # https://github.com/JukkaL/mypy/issues/1167 # nocoverage -- doesn't actually get used in tests
     TimeTrackingCursor.executemany = cursor_executemany  # type: ignore # https://github.com/JukkaL/mypy/issues/1167
 
+    old_copy_expert = TimeTrackingCursor.copy_expert
+
+    def cursor_copy_expert(self: TimeTrackingCursor, sql: str, file: IO[Any],
+                           size: int=8192) -> None:
+        # COPY's data isn't a query parameter, so it can't be mogrified.
+        start = time.time()
+        try:
+            return old_copy_expert(self, sql, file, size)
+        finally:
+            queries.append({
+                'sql': sql,
+                'time': "%.3f" % (time.time() - start,),
+            })
+    TimeTrackingCursor.copy_expert = cursor_copy_expert  # type: ignore # https://github.com/JukkaL/mypy/issues/1167
+
     yield queries
 
     TimeTrackingCursor.execute = old_execute  # type: ignore # https://github.com/JukkaL/mypy/issues/1167
     TimeTrackingCursor.executemany = old_executemany  # type: ignore # https://github.com/JukkaL/mypy/issues/1167
+    TimeTrackingCursor.copy_expert = old_copy_expert  # type: ignore # https://github.com/JukkaL/mypy/issues/1167
 
 @contextmanager
 def stdout_suppressed() -> Iterator[IO[str]]:
@@ -14,6 +14,7 @@ from zerver.lib.request import REQ
 from zerver.models import (
     Message,
     Recipient,
+    StreamTopic,
     UserMessage,
     UserProfile,
 )
@@ -162,57 +163,31 @@ def generate_topic_history_from_db_rows(rows: List[Tuple[str, int]]) -> List[Dic
         )
     return sorted(history, key=lambda x: -x['max_id'])
 
+def get_topic_history_from_stream_topics(recipient: Recipient) -> List[Dict[str, Any]]:
+    # StreamTopic is maintained by a database trigger, which saves
+    # us doing a GROUP BY over all the messages in the stream.
+    rows = list(StreamTopic.objects.filter(
+        recipient_id=recipient.id,
+    ).values_list('topic_name', 'max_message_id'))
+    return generate_topic_history_from_db_rows(rows)
+
 def get_topic_history_for_stream(user_profile: UserProfile,
                                  recipient: Recipient,
                                  public_history: bool) -> List[Dict[str, Any]]:
-    cursor = connection.cursor()
     if public_history:
-        query = '''
-        SELECT
-            "zerver_message"."subject" as topic,
-            max("zerver_message".id) as max_message_id
-        FROM "zerver_message"
-        WHERE (
-            "zerver_message"."recipient_id" = %s
-        )
-        GROUP BY (
-            "zerver_message"."subject"
-        )
-        ORDER BY max("zerver_message".id) DESC
-        '''
-        cursor.execute(query, [recipient.id])
-    else:
-        query = '''
-        SELECT
-            "zerver_message"."subject" as topic,
-            max("zerver_message".id) as max_message_id
-        FROM "zerver_message"
-        INNER JOIN "zerver_usermessage" ON (
-            "zerver_usermessage"."message_id" = "zerver_message"."id"
-        )
-        WHERE (
-            "zerver_usermessage"."user_profile_id" = %s AND
-            "zerver_message"."recipient_id" = %s
-        )
-        GROUP BY (
-            "zerver_message"."subject"
-        )
-        ORDER BY max("zerver_message".id) DESC
-        '''
-        cursor.execute(query, [user_profile.id, recipient.id])
-    rows = cursor.fetchall()
-    cursor.close()
-
-    return generate_topic_history_from_db_rows(rows)
+        return get_topic_history_from_stream_topics(recipient)
 
-def get_topic_history_for_web_public_stream(recipient: Recipient) -> List[Dict[str, Any]]:
     cursor = connection.cursor()
     query = '''
     SELECT
         "zerver_message"."subject" as topic,
         max("zerver_message".id) as max_message_id
     FROM "zerver_message"
+    INNER JOIN "zerver_usermessage" ON (
+        "zerver_usermessage"."message_id" = "zerver_message"."id"
+    )
     WHERE (
+        "zerver_usermessage"."user_profile_id" = %s AND
         "zerver_message"."recipient_id" = %s
     )
     GROUP BY (
@@ -220,8 +195,11 @@ def get_topic_history_for_web_public_stream(recipient: Recipient) -> List[Dict[s
     )
     ORDER BY max("zerver_message".id) DESC
     '''
-    cursor.execute(query, [recipient.id])
+    cursor.execute(query, [user_profile.id, recipient.id])
     rows = cursor.fetchall()
     cursor.close()
 
     return generate_topic_history_from_db_rows(rows)
+
+def get_topic_history_for_web_public_stream(recipient: Recipient) -> List[Dict[str, Any]]:
+    return get_topic_history_from_stream_topics(recipient)
@@ -23,7 +23,7 @@ from zerver.tornado.application import create_tornado_application, \
     setup_tornado_rabbitmq
 from zerver.tornado.autoreload import start as zulip_autoreload_start
 from zerver.tornado.event_queue import add_client_gc_hook, \
-    missedmessage_hook, process_notification, setup_event_queue
+    missedmessage_hook, queue_notification, setup_event_queue
 from zerver.tornado.sharding import notify_tornado_queue_name, tornado_return_queue_name
 from zerver.tornado.socket import respond_send_message
 
@@ -91,7 +91,7 @@ class Command(BaseCommand):
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
                 queue_client.register_json_consumer(notify_tornado_queue_name(int(port)),
-                                                    process_notification)
+                                                    queue_notification)
                 queue_client.register_json_consumer(tornado_return_queue_name(int(port)),
                                                     respond_send_message)
 
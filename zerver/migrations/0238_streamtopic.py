@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0237_rename_zulip_realm_to_zulipinternal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamTopic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic_name', models.CharField(max_length=60)),
+                ('max_message_id', models.IntegerField()),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zerver.Recipient')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='streamtopic',
+            unique_together=set([('recipient', 'topic_name')]),
+        ),
+        migrations.RunSQL(
+            '''
+            CREATE FUNCTION update_zerver_streamtopic() RETURNS trigger LANGUAGE plpgsql AS $$
+            DECLARE
+                new_max_message_id integer;
+            BEGIN
+                -- OLD and NEW are only assigned for the operations using
+                -- them, so we can't test TG_OP in the same condition.
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    -- If this was the topic's latest message, look up the
+                    -- topic's new latest message.  The redundant condition
+                    -- on upper(subject) lets this use upper_subject_idx,
+                    -- rather than scanning all of the stream's messages;
+                    -- so this is only expensive for statements touching
+                    -- the latest messages of many topics.
+                    --
+                    -- The statements below re-check max_message_id, since
+                    -- a concurrent transaction may have sent a newer
+                    -- message to the topic, which our max(id) can't see;
+                    -- in READ COMMITTED, the condition is re-evaluated
+                    -- once that transaction's row lock is released.
+                    IF EXISTS (
+                        SELECT 1 FROM zerver_streamtopic
+                        WHERE recipient_id = OLD.recipient_id AND topic_name = OLD.subject AND
+                              max_message_id = OLD.id
+                    ) THEN
+                        SELECT max(id) INTO new_max_message_id FROM zerver_message
+                        WHERE upper(subject) = upper(OLD.subject) AND
+                              recipient_id = OLD.recipient_id AND subject = OLD.subject;
+                        IF new_max_message_id IS NULL THEN
+                            DELETE FROM zerver_streamtopic
+                            WHERE recipient_id = OLD.recipient_id AND topic_name = OLD.subject AND
+                                  max_message_id = OLD.id;
+                        ELSE
+                            UPDATE zerver_streamtopic SET max_message_id = new_max_message_id
+                            WHERE recipient_id = OLD.recipient_id AND topic_name = OLD.subject AND
+                                  max_message_id = OLD.id;
+                        END IF;
+                    END IF;
+                END IF;
+
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    IF EXISTS (
+                        SELECT 1 FROM zerver_recipient
+                        WHERE id = NEW.recipient_id AND type = 2
+                    ) THEN
+                        INSERT INTO zerver_streamtopic (recipient_id, topic_name, max_message_id)
+                        VALUES (NEW.recipient_id, NEW.subject, NEW.id)
+                        ON CONFLICT (recipient_id, topic_name) DO UPDATE
+                        SET max_message_id = GREATEST(zerver_streamtopic.max_message_id,
+                                                      EXCLUDED.max_message_id);
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END $$;
+
+            CREATE TRIGGER zerver_message_update_streamtopic
+                AFTER INSERT OR DELETE ON zerver_message
+                FOR EACH ROW EXECUTE PROCEDURE update_zerver_streamtopic();
+            CREATE TRIGGER zerver_message_update_streamtopic_on_move
+                AFTER UPDATE OF recipient_id, subject ON zerver_message
+                FOR EACH ROW
+                WHEN (OLD.recipient_id IS DISTINCT FROM NEW.recipient_id OR
+                      OLD.subject IS DISTINCT FROM NEW.subject)
+                EXECUTE PROCEDURE update_zerver_streamtopic();
+
+            INSERT INTO zerver_streamtopic (recipient_id, topic_name, max_message_id)
+            SELECT zerver_message.recipient_id, zerver_message.subject, max(zerver_message.id)
+            FROM zerver_message
+            INNER JOIN zerver_recipient ON zerver_recipient.id = zerver_message.recipient_id
+            WHERE zerver_recipient.type = 2
+            GROUP BY zerver_message.recipient_id, zerver_message.subject;
+            ''',
+            reverse_sql='''
+            DROP TRIGGER zerver_message_update_streamtopic_on_move ON zerver_message;
+            DROP TRIGGER zerver_message_update_streamtopic ON zerver_message;
+            DROP FUNCTION update_zerver_streamtopic();
+            '''
+        ),
+    ]
@@ -21,13 +21,15 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     get_stream_cache_key, realm_user_dicts_cache_key, \
     bot_dicts_in_realm_cache_key, realm_user_dict_fields, \
     bot_dict_fields, flush_message, flush_submessage, bot_profile_cache_key, \
-    flush_used_upload_space_cache, get_realm_used_upload_space_cache_key
+    flush_used_upload_space_cache, get_realm_used_upload_space_cache_key, \
+    flush_subscription, flush_realm_render_context
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from django.db import transaction
 from django.utils.timezone import now as timezone_now
 from django.contrib.sessions.models import Session
 from zerver.lib.timestamp import datetime_to_timestamp
 from django.db.models.signals import pre_save, post_save, post_delete
+from django.utils.lru_cache import lru_cache
 from django.utils.translation import ugettext_lazy as _
 from zerver.lib import cache
 from zerver.lib.validator import check_int, \
@@ -634,6 +636,7 @@ def flush_realm_emoji(sender: Any, **kwargs: Any) -> None:
     cache_set(get_active_realm_emoji_cache_key(realm),
               get_active_realm_emoji_uncached(realm),
               timeout=3600*24*7)
+    flush_realm_render_context(realm.id)
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
 post_delete.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -710,6 +713,7 @@ def flush_realm_filter(sender: Any, **kwargs: Any) -> None:
         per_request_realm_filters_cache.pop(realm_id)
     except KeyError:
         pass
+    flush_realm_render_context(realm_id)
 
 post_save.connect(flush_realm_filter, sender=RealmFilter)
 post_delete.connect(flush_realm_filter, sender=RealmFilter)
@@ -1436,11 +1440,9 @@ def get_personal_recipient(user_profile_id: int) -> Recipient:
 def get_huddle_recipient(user_profile_ids: Set[int]) -> Recipient:
 
     # The caller should ensure that user_profile_ids includes
-    # the sender.  Note that get_huddle hits the cache, and then
-    # we hit another cache to get the recipient.  We may want to
-    # unify our caching strategy here.
-    huddle = get_huddle(list(user_profile_ids))
-    return get_recipient(Recipient.HUDDLE, huddle.id)
+    # the sender.
+    (huddle_id, recipient_id) = get_huddle_recipient_ids(tuple(sorted(user_profile_ids)))
+    return Recipient(id=recipient_id, type=Recipient.HUDDLE, type_id=huddle_id)
 
 def get_huddle_user_ids(recipient: Recipient) -> List[int]:
     assert(recipient.type == Recipient.HUDDLE)
@@ -1681,6 +1683,25 @@ def get_context_for_message(message: Message) -> Sequence[Message]:
 
 post_save.connect(flush_message, sender=Message)
 
+class StreamTopic(models.Model):
+    """The most recent message in each topic of each stream, for
+    get_topic_history_for_stream.
+
+    This is derived data; rather than being written from Python, it's
+    kept up to date by a database trigger on zerver_message (see
+    migration 0238), so that sending, editing, deleting, archiving and
+    restoring messages, as well as data imports, all maintain it.
+    """
+    recipient = models.ForeignKey(Recipient, on_delete=CASCADE)  # type: Recipient
+    topic_name = models.CharField(max_length=MAX_TOPIC_NAME_LENGTH)  # type: str
+    max_message_id = models.IntegerField()  # type: int
+
+    class Meta:
+        unique_together = ('recipient', 'topic_name')
+
+    def __str__(self) -> str:
+        return "<StreamTopic: %s %s %s>" % (self.recipient, self.topic_name, self.max_message_id)
+
 class AbstractSubMessage(models.Model):
     # We can send little text messages that are associated with a regular
     # Zulip message.  These can be used for experimental widgets like embedded
@@ -2027,6 +2048,8 @@ class Subscription(models.Model):
     def __str__(self) -> str:
         return "<Subscription: %s -> %s>" % (self.user_profile, self.recipient)
 
+post_save.connect(flush_subscription, sender=Subscription)
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -2174,6 +2197,35 @@ def get_huddle_backend(huddle_hash: str, id_list: List[int]) -> Huddle:
             Subscription.objects.bulk_create(subs_to_create)
         return huddle
 
+def huddle_recipient_ids_cache_key(huddle_hash: str) -> str:
+    return u"huddle_recipient_ids_by_hash:%s" % (huddle_hash,)
+
+# A huddle's membership never changes, so the (huddle ID, recipient ID)
+# pair for a set of users can be kept in-process once we've looked it
+# up, saving the memcached round trips on the hot path for sending
+# group private messages.  Since the database is reset between unit
+# tests, our standard tearDown code clears it with cache_clear().
+@lru_cache(maxsize=4096)
+def get_huddle_recipient_ids(user_profile_ids: Tuple[int, ...]) -> Tuple[int, int]:
+    """Takes the sorted IDs of a huddle's users, creating the huddle if it
+    doesn't exist yet, and returns its (huddle ID, recipient ID)."""
+    huddle_hash = get_huddle_hash(list(user_profile_ids))
+    return get_huddle_recipient_ids_backend(huddle_hash, user_profile_ids)
+
+@cache_with_key(lambda huddle_hash, user_profile_ids: huddle_recipient_ids_cache_key(huddle_hash),
+                timeout=3600*24*7)
+def get_huddle_recipient_ids_backend(huddle_hash: str,
+                                     user_profile_ids: Tuple[int, ...]) -> Tuple[int, int]:
+    rows = Recipient.objects.filter(
+        type=Recipient.HUDDLE,
+        type_id__in=Huddle.objects.filter(huddle_hash=huddle_hash).values('id'),
+    ).values_list('type_id', 'id')
+    for (huddle_id, recipient_id) in rows:
+        return (huddle_id, recipient_id)
+
+    huddle = get_huddle_backend(huddle_hash, list(user_profile_ids))
+    return (huddle.id, get_recipient(Recipient.HUDDLE, huddle.id).id)
+
 def clear_database() -> None:  # nocoverage # Only used in populate_db
     pylibmc.Client(['127.0.0.1']).flush_all()
     model = None  # type: Any
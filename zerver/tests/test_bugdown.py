@@ -327,6 +327,55 @@ class BugdownTest(ZulipTestCase):
                 converted = bugdown_convert(inline_url)
                 self.assertEqual(match, converted)
 
+    def test_plain_text_fast_path(self) -> None:
+        format_tests, linkify_tests = self.load_bugdown_tests()
+        inputs = [test['input'] for test in format_tests.values()]
+        inputs += [inline_url for inline_url, reference, url in linkify_tests]
+        inputs += [
+            'ok thanks',
+            'ok thanks!',
+            "it's 5pm, right?",
+            'Ms. Smith said "this & that" to me.',
+            '1. not plain',
+            '1 is plain',
+            'example.com',
+            'a&amp;b',
+            'AT&T',
+        ]
+
+        def full_render(content: str) -> str:
+            with mock.patch('zerver.lib.bugdown.is_plain_text', return_value=False):
+                return bugdown_convert(content)
+
+        plain_inputs = [content for content in inputs if bugdown.is_plain_text(content, [])]
+        self.assertIn('ok thanks', plain_inputs)
+        self.assertIn('Ms. Smith said "this & that" to me.', plain_inputs)
+        self.assertNotIn('1. not plain', plain_inputs)
+        self.assertNotIn('example.com', plain_inputs)
+        self.assertNotIn('a&amp;b', plain_inputs)
+        for content in plain_inputs:
+            with self.subTest(content=content):
+                self.assertEqual(bugdown.render_plain_text(content), full_render(content))
+                self.assertEqual(bugdown_convert(content), full_render(content))
+
+        # Content a realm filter might match isn't plain text.
+        realm_filters = [(r'#?(?P<id>[0-9]{2,8})', r'https://trac.zulip.net/ticket/%(id)s', 1)]
+        self.assertTrue(bugdown.is_plain_text('fixed in 1', realm_filters))
+        self.assertFalse(bugdown.is_plain_text('fixed in 1234', realm_filters))
+
+        # Alert words are still found in plain text.
+        othello = self.example_user('othello')
+        do_set_alert_words(othello, ['lunch'])
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        realm_alert_words_automaton = get_alert_word_automaton(othello.realm)
+        with mock.patch('zerver.lib.bugdown.timeout') as timeout_mock:
+            self.assertEqual(render_markdown(msg, 'it is Lunch time',
+                                             realm_alert_words_automaton=realm_alert_words_automaton,
+                                             user_ids={othello.id}),
+                             '<p>it is Lunch time</p>')
+        timeout_mock.assert_not_called()
+        self.assertEqual(msg.user_ids_with_alert_words, {othello.id})
+
     def test_inline_file(self) -> None:
         msg = 'Check out this file file:///Volumes/myserver/Users/Shared/pi.py'
         converted = bugdown_convert(msg)
@@ -1036,6 +1085,48 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(render(msg, content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_realm_render_context(self) -> None:
+        realm = get_realm('zulip')
+        othello = self.example_user('othello')
+        render_context = bugdown.get_realm_render_context(realm)
+        self.assertIs(bugdown.get_realm_render_context(realm), render_context)
+
+        # Changing the realm's alert words, realm filters or emoji
+        # makes us fetch the render context again, in every process.
+        do_set_alert_words(othello, ["ALERTWORD"])
+        new_render_context = bugdown.get_realm_render_context(realm)
+        self.assertIsNot(new_render_context, render_context)
+        self.assertTrue(new_render_context.realm_alert_words_automaton.exists('alertword'))
+        render_context = new_render_context
+
+        RealmFilter.objects.create(realm=realm, pattern=r'#(?P<id>[0-9]{2,8})',
+                                   url_format_string=r'https://trac.zulip.net/ticket/%(id)s')
+        new_render_context = bugdown.get_realm_render_context(realm)
+        self.assertIsNot(new_render_context, render_context)
+        self.assertIn(r'#(?P<id>[0-9]{2,8})',
+                      [pattern for (pattern, url_format_string, id) in new_render_context.realm_filters])
+        render_context = new_render_context
+
+        self.assertEqual(render_context.get_active_realm_emoji(realm), realm.get_active_emoji())
+        do_remove_realm_emoji(realm, 'green_tick')
+        new_render_context = bugdown.get_realm_render_context(realm)
+        self.assertIsNot(new_render_context, render_context)
+        self.assertNotIn('green_tick', new_render_context.get_active_realm_emoji(realm))
+
+        # Messages are rendered with the realm's render context.
+        msg = Message(sender=othello, sending_client=get_client("test"))
+        content = "Check #1234, it's an ALERTWORD"
+        rendered_content = render_markdown(
+            msg, content,
+            realm_alert_words_automaton=new_render_context.realm_alert_words_automaton,
+            user_ids={othello.id},
+            render_context=new_render_context)
+        self.assertEqual(rendered_content,
+                         '<p>Check <a href="https://trac.zulip.net/ticket/1234" '
+                         'target="_blank" title="https://trac.zulip.net/ticket/1234">#1234</a>, '
+                         'it\'s an ALERTWORD</p>')
+        self.assertEqual(msg.user_ids_with_alert_words, {othello.id})
+
     def test_alert_words_returns_user_ids_with_alert_words(self) -> None:
         alert_words_for_users = {
             'hamlet': ['how'], 'cordelia': ['this possible'],
@@ -1,9 +1,12 @@
 import mock
+import os
+import tempfile
 import time
 import ujson
 
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 from zerver.lib.actions import do_mute_topic, do_change_subscription_property
 from zerver.lib.test_classes import ZulipTestCase
@@ -11,7 +14,13 @@ from zerver.lib.test_helpers import POSTRequestMock
 from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
 from zerver.tornado.event_queue import maybe_enqueue_notifications, \
     allocate_client_descriptor, ClientDescriptor, \
-    get_client_descriptor, missedmessage_hook, persistent_queue_filename
+    get_client_descriptor, missedmessage_hook, persistent_queue_filename, \
+    SnapshotEventQueuePersistence, get_narrow_fanout_key, EventQueue, \
+    dump_event_queues, load_event_queues, send_restart_events, \
+    clear_client_event_queues_for_testing, \
+    get_client_descriptors_for_public_stream_message, get_event_queue_stats, \
+    merge_notifications, process_notifications, gc_event_queues, gc_heap
+from zerver.tornado.sharding import shard_event_users
 from zerver.tornado.views import get_events
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -342,6 +351,91 @@ class FileReloadLogicTest(ZulipTestCase):
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/home/zulip/tornado/event_queues.9993.last.json")
 
+    def test_snapshot_persistence(self) -> None:
+        hamlet = self.example_user('hamlet')
+        client = allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        ))
+        client.add_event({"type": "unknown"})
+        queue_id = client.event_queue.id
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pattern = os.path.join(tmpdir, "event_queues%s.snapshot")
+            with self.settings(SNAPSHOT_PERSISTENT_QUEUE_FILENAME_PATTERN=pattern):
+                persistence = SnapshotEventQueuePersistence(9993)
+                persistence.dump({queue_id: client})
+                restored = persistence.load()[queue_id]
+                self.assertEqual(restored.to_dict(include_event_queue=False),
+                                 client.to_dict(include_event_queue=False))
+
+                # Writing out an untouched queue again doesn't load it.
+                queue = restored.event_queue
+                self.assertFalse(queue.is_loaded())
+                persistence.dump({queue_id: restored})
+                self.assertFalse(queue.is_loaded())
+
+                # Events pushed before the queue is used are deferred.
+                queue.push({"type": "restart", "server_generation": "2"})
+                self.assertFalse(queue.is_loaded())
+                self.assertEqual(queue.contents(),
+                                 [{"id": 0, "type": "unknown"},
+                                  {"id": 1, "type": "restart", "server_generation": "2"}])
+                self.assertTrue(queue.is_loaded())
+
+                restored_again = persistence.load()[queue_id]
+                self.assertEqual(restored_again.event_queue.contents(),
+                                 [{"id": 0, "type": "unknown"}])
+
+    def test_snapshot_persistence_restart(self) -> None:
+        hamlet = self.example_user('hamlet')
+        client = allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        ))
+        client.add_event({"type": "unknown"})
+        queue_id = client.event_queue.id
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pattern = os.path.join(tmpdir, "event_queues%s.snapshot")
+            with self.settings(SNAPSHOT_PERSISTENT_QUEUE_FILENAME_PATTERN=pattern,
+                               TORNADO_QUEUE_PERSISTENCE='snapshot'):
+                dump_event_queues(9993)
+
+                # Two restarts in which the queue isn't used: neither
+                # the restart events nor writing the queue back out
+                # deserialize it.
+                for generation in ["2", "3"]:
+                    clear_client_event_queues_for_testing()
+                    load_event_queues(9993)
+                    queue = get_client_descriptor(queue_id).event_queue
+                    with self.settings(SERVER_GENERATION=generation):
+                        send_restart_events()
+                    self.assertFalse(queue.is_loaded())
+                    dump_event_queues(9993)
+                    self.assertFalse(queue.is_loaded())
+
+                clear_client_event_queues_for_testing()
+                load_event_queues(9993)
+                self.assertEqual(get_client_descriptor(queue_id).event_queue.contents(),
+                                 [{"id": 0, "type": "unknown"},
+                                  {"id": 1, "type": "restart", "server_generation": "2"},
+                                  {"id": 2, "type": "restart", "server_generation": "3"}])
+
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
         hamlet = self.example_user('hamlet')
@@ -527,7 +621,7 @@ class EventQueueTest(ZulipTestCase):
 
         queue.push({"type": "unknown",
                     "timestamp": "1"})
-        self.assertEqual(list(queue.queue),
+        self.assertEqual([event.to_dict() for event in queue.queue],
                          [{'id': 1,
                            'type': 'unknown',
                            "timestamp": "1"}])
@@ -556,3 +650,405 @@ class EventQueueTest(ZulipTestCase):
 
         queue.prune(1)
         self.verify_to_dict_end_to_end(client)
+
+    def test_coalescing(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        queue.push({"type": "realm_user", "op": "update",
+                    "person": {"user_id": 1, "full_name": "A"}})
+        queue.push({"type": "presence", "email": "a@zulip.com", "server_timestamp": 1,
+                    "presence": {"website": {"status": "active"}}})
+        queue.push({"type": "realm_user", "op": "update",
+                    "person": {"user_id": 1, "custom_profile_field": {"id": 3, "value": "x"}}})
+        queue.push({"type": "realm_user", "op": "update",
+                    "person": {"user_id": 1, "avatar_url": "B"}})
+        queue.push({"type": "presence", "email": "a@zulip.com", "server_timestamp": 2,
+                    "presence": {"ZulipMobile": {"status": "idle"}}})
+        # Updates aren't merged across a non-update realm_user event.
+        queue.push({"type": "realm_user", "op": "remove",
+                    "person": {"user_id": 1}})
+        queue.push({"type": "realm_user", "op": "update",
+                    "person": {"user_id": 1, "full_name": "C"}})
+        for op in ["start", "stop"]:
+            queue.push({"type": "typing", "op": op, "sender": {"user_id": 1},
+                        "recipients": [{"user_id": 1}, {"user_id": 2}]})
+        for i in range(2):
+            queue.push({"type": "update_message_flags", "all": True, "flag": "read",
+                        "operation": "add", "messages": []})
+        self.verify_to_dict_end_to_end(client)
+        self.assertEqual(queue.contents(), [
+            {"id": 2, "type": "realm_user", "op": "update",
+             "person": {"user_id": 1, "custom_profile_field": {"id": 3, "value": "x"}}},
+            {"id": 3, "type": "realm_user", "op": "update",
+             "person": {"user_id": 1, "full_name": "A", "avatar_url": "B"}},
+            {"id": 4, "type": "presence", "email": "a@zulip.com", "server_timestamp": 2,
+             "presence": {"website": {"status": "active"},
+                          "ZulipMobile": {"status": "idle"}}},
+            {"id": 5, "type": "realm_user", "op": "remove",
+             "person": {"user_id": 1}},
+            {"id": 6, "type": "realm_user", "op": "update",
+             "person": {"user_id": 1, "full_name": "C"}},
+            {"id": 8, "type": "typing", "op": "stop", "sender": {"user_id": 1},
+             "recipients": [{"user_id": 1}, {"user_id": 2}]},
+            {"id": 10, "type": "update_message_flags", "all": True, "flag": "read",
+             "operation": "add", "messages": []},
+        ])
+
+    def test_message_event_storage(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        message = {"id": 5, "type": "stream", "content": "hello"}
+        client.add_message_event(message, ["read"], {"push_notified": True})
+        queue.push({"type": "message",
+                    "message": message,
+                    "flags": ["mentioned"],
+                    "local_message_id": "1.1"})
+        # Both events reference the shared payload rather than a copy.
+        self.assertIs(queue.queue[0].message, message)
+        self.assertIs(queue.queue[1].message, message)
+        self.verify_to_dict_end_to_end(client)
+        self.assertEqual(queue.contents(),
+                         [{"id": 0,
+                           "type": "message",
+                           "message": message,
+                           "flags": ["read"],
+                           "push_notified": True},
+                          {"id": 1,
+                           "type": "message",
+                           "message": message,
+                           "flags": ["mentioned"],
+                           "local_message_id": "1.1"}])
+
+        queue.prune(0)
+        self.assertEqual(queue.newest_pruned_id, 0)
+        self.assertEqual(len(queue.queue), 1)
+
+    def test_share_message_payloads(self) -> None:
+        clients = [self.get_client_descriptor() for i in range(2)]
+        for client in clients:
+            client.add_message_event({"id": 5, "type": "stream", "content": "hello"}, [])
+        restored = [ClientDescriptor.from_dict(ujson.loads(ujson.dumps(client.to_dict())))
+                    for client in clients]
+        self.assertIsNot(restored[0].event_queue.queue[0].message,
+                         restored[1].event_queue.queue[0].message)
+
+        payloads = {}  # type: Dict[Tuple[Any, ...], Dict[str, Any]]
+        for client in restored:
+            client.event_queue.share_message_payloads(
+                payloads, (client.apply_markdown, client.client_gravatar))
+        self.assertIs(restored[0].event_queue.queue[0].message,
+                      restored[1].event_queue.queue[0].message)
+        self.assertEqual(len(payloads), 1)
+
+    def test_queue_overflow(self) -> None:
+        client = self.get_client_descriptor()
+        queue = client.event_queue
+        with self.settings(EVENT_QUEUE_MAX_EVENTS=3):
+            for message_id in range(3):
+                client.add_message_event({"id": message_id, "type": "stream"}, [])
+            queue.push({"type": "pointer", "pointer": 1})
+            self.assertEqual(len(queue.queue), 3)
+
+            with mock.patch('logging.info') as mock_info:
+                queue.push({"type": "unknown"})
+            mock_info.assert_called_once()
+
+        # The queued events, virtual ones included, were replaced by a
+        # restart event, followed by the event that overflowed the queue.
+        self.assertEqual(queue.virtual_events, {})
+        self.assertIsNone(queue.newest_pruned_id)
+        self.assertEqual(queue.contents(),
+                         [{"id": 4,
+                           "type": "restart",
+                           "server_generation": settings.SERVER_GENERATION,
+                           "immediate": True},
+                          {"id": 5,
+                           "type": "unknown"}])
+        self.verify_to_dict_end_to_end(client)
+
+    def test_lazy_queue_overflow(self) -> None:
+        client = self.get_client_descriptor()
+        client.event_queue.push({"type": "unknown"})
+        serialized = ujson.dumps(client.event_queue.to_dict()).encode('utf-8')
+        queue = EventQueue.lazy(client.event_queue.id, memoryview(serialized))
+        with self.settings(EVENT_QUEUE_MAX_EVENTS=3):
+            # Pushes to a queue that hasn't been loaded are deferred...
+            for message_id in range(3):
+                queue.push_message({"id": message_id, "type": "stream"}, [])
+            self.assertFalse(queue.is_loaded())
+
+            # ...but only as many as the queue may hold; past that, it
+            # is loaded, and the deferred pushes overflow it.
+            with mock.patch('logging.info') as mock_info:
+                queue.push({"type": "unknown"})
+            mock_info.assert_called_once()
+            self.assertTrue(queue.is_loaded())
+
+        contents = queue.contents()
+        self.assertEqual([event["id"] for event in contents], [3, 4, 5])
+        self.assertEqual(contents[0]["type"], "restart")
+        self.assertEqual(contents[1]["message"], {"id": 2, "type": "stream"})
+        self.assertEqual(contents[2]["type"], "unknown")
+
+class RealmMessageClientsTest(ZulipTestCase):
+    def test_get_narrow_fanout_key(self) -> None:
+        self.assertEqual(get_narrow_fanout_key([]), None)
+        self.assertEqual(get_narrow_fanout_key([["is", "starred"]]), None)
+        self.assertEqual(get_narrow_fanout_key([["stream", "Denmark"], ["topic", "x"]]),
+                         ("stream", "denmark"))
+        self.assertEqual(get_narrow_fanout_key([["sender", "Hamlet@zulip.com"], ["stream", "Verona"]]),
+                         ("stream", "verona"))
+        self.assertEqual(get_narrow_fanout_key([["sender", "Hamlet@zulip.com"]]),
+                         ("sender", "hamlet@zulip.com"))
+        self.assertEqual(get_narrow_fanout_key([["is", "private"]]), ("private", ""))
+
+    def test_public_stream_message_clients(self) -> None:
+        hamlet = self.example_user('hamlet')
+        realm_id = hamlet.realm_id
+
+        def allocate(narrow: List[Sequence[str]], all_public_streams: bool=False,
+                     event_types: Optional[List[str]]=None) -> ClientDescriptor:
+            return allocate_client_descriptor(dict(
+                all_public_streams=all_public_streams,
+                apply_markdown=False,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=event_types,
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm_id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            ))
+
+        all_streams = allocate([], all_public_streams=True)
+        denmark = allocate([["stream", "Denmark"], ["topic", "x"]])
+        verona = allocate([["stream", "Verona"]])
+        sender = allocate([["sender", "cordelia@zulip.com"]])
+        allocate([["is", "private"]])
+        allocate([], all_public_streams=True, event_types=["pointer"])
+        allocate([])
+
+        def get_queue_ids(stream_name: str, sender_email: str) -> List[str]:
+            return sorted(client.event_queue.id for client in
+                          get_client_descriptors_for_public_stream_message(
+                              realm_id, stream_name, sender_email))
+
+        self.assertEqual(get_queue_ids("denmark", "hamlet@zulip.com"),
+                         sorted([all_streams.event_queue.id, denmark.event_queue.id]))
+        self.assertEqual(get_queue_ids("Verona", "Cordelia@zulip.com"),
+                         sorted([all_streams.event_queue.id, verona.event_queue.id,
+                                 sender.event_queue.id]))
+
+        denmark.cleanup()
+        all_streams.cleanup()
+        self.assertEqual(get_queue_ids("Denmark", "hamlet@zulip.com"), [])
+        self.assertEqual(get_client_descriptors_for_public_stream_message(
+            realm_id + 1, "Denmark", "hamlet@zulip.com"), [])
+
+class NotificationBatchTest(ZulipTestCase):
+    def flags_notice(self, user_ids: List[int], messages: List[int],
+                     operation: str='add') -> Dict[str, Any]:
+        return dict(users=user_ids, event=dict(type='update_message_flags', operation=operation,
+                                               flag='read', messages=messages, all=False))
+
+    def test_merge_notifications(self) -> None:
+        notices = [
+            self.flags_notice([1], [1, 2]),
+            self.flags_notice([1], [3]),
+            self.flags_notice([2], [4]),
+            self.flags_notice([2], [4], operation='remove'),
+            dict(users=[2], event=dict(type='pointer', pointer=4)),
+            self.flags_notice([2], [5], operation='remove'),
+        ]
+        self.assertEqual(merge_notifications(notices), [
+            self.flags_notice([1], [1, 2, 3]),
+            self.flags_notice([2], [4]),
+            self.flags_notice([2], [4], operation='remove'),
+            dict(users=[2], event=dict(type='pointer', pointer=4)),
+            self.flags_notice([2], [5], operation='remove'),
+        ])
+
+    def test_handler_finished_once_per_batch(self) -> None:
+        hamlet = self.example_user('hamlet')
+        client = allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        ))
+        # Pretend a get_events request is waiting on this queue.
+        client.current_handler_id = 1
+        with mock.patch('zerver.tornado.event_queue.get_handler_by_id'), \
+                mock.patch('zerver.tornado.event_queue.async_request_timer_restart'), \
+                mock.patch('zerver.tornado.event_queue.clear_handler_by_id'), \
+                mock.patch('zerver.tornado.event_queue.clear_descriptor_by_handler_id'), \
+                mock.patch('zerver.tornado.event_queue.finish_handler') as finish_handler:
+            process_notifications([
+                self.flags_notice([hamlet.id], [1]),
+                self.flags_notice([hamlet.id], [2]),
+                dict(users=[hamlet.id], event=dict(type='unknown')),
+            ])
+        self.assertEqual(finish_handler.call_count, 1)
+        events = finish_handler.call_args[0][2]
+        self.assertEqual([event['type'] for event in events],
+                         ['update_message_flags', 'unknown'])
+        self.assertEqual(events[0]['messages'], [1, 2])
+        self.assertIsNone(client.current_handler_id)
+
+class UserShardingTest(ZulipTestCase):
+    def test_shard_event_users(self) -> None:
+        with self.settings(TORNADO_PROCESSES=3, TORNADO_SHARDING='user'):
+            self.assertEqual(shard_event_users(dict(type='pointer'), [1, 2, 4, 7]),
+                             {9801: [1, 4, 7], 9802: [2]})
+
+            users = [dict(id=3, flags=[]), dict(id=5, flags=['read'])]
+            private_message = dict(type='message')
+            self.assertEqual(shard_event_users(private_message, users),
+                             {9800: [dict(id=3, flags=[])], 9802: [dict(id=5, flags=['read'])]})
+
+            # Public stream messages go to every shard, for
+            # all_public_streams and narrowed clients.
+            stream_message = dict(type='message', stream_name='Denmark', invite_only=False)
+            self.assertEqual(shard_event_users(stream_message, users),
+                             {9800: [dict(id=3, flags=[])], 9801: [],
+                              9802: [dict(id=5, flags=['read'])]})
+            private_stream_message = dict(type='message', stream_name='Denmark', invite_only=True)
+            self.assertEqual(shard_event_users(private_stream_message, users),
+                             shard_event_users(private_message, users))
+
+    def test_queue_id_includes_shard(self) -> None:
+        hamlet = self.example_user('hamlet')
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        with self.settings(TORNADO_PROCESSES=3, TORNADO_SHARDING='user'):
+            client = allocate_client_descriptor(queue_data)
+        self.assertTrue(client.event_queue.id.startswith('%d:' % (9800 + hamlet.id % 3,)))
+
+class EventQueueStatsTest(ZulipTestCase):
+    def test_get_event_queue_stats(self) -> None:
+        hamlet = self.example_user('hamlet')
+        queue_data = dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=time.time(),
+            queue_timeout=0,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        )
+        with mock.patch.dict('zerver.tornado.event_queue.clients', clear=True):
+            website_clients = [allocate_client_descriptor(queue_data) for i in range(2)]
+            api_client = allocate_client_descriptor(dict(queue_data, client_type_name='ZulipMobile'))
+            message = {"id": 5, "type": "stream", "content": "hello"}
+            for client in website_clients:
+                client.add_message_event(message, [])
+            api_client.event_queue.push({"type": "pointer", "pointer": 1})
+            api_client.current_handler_id = 1
+
+            with mock.patch('zerver.tornado.event_queue.ujson.dumps') as mock_dumps:
+                self.assertNotIn('retained_bytes', get_event_queue_stats())
+            # By default, we don't encode the queued events.
+            mock_dumps.assert_not_called()
+
+            stats = get_event_queue_stats(include_retained_bytes=True)
+
+        self.assertEqual(stats['queues'], 3)
+        self.assertEqual(stats['queues_by_client_type'], {'website': 2, 'ZulipMobile': 1})
+        self.assertEqual(stats['events_per_queue'],
+                         {'0': 0, '1': 3, '10': 0, '100': 0, '1000': 0, '10000': 0, 'inf': 0})
+        # The shared message payload is counted once.
+        pointer_event = api_client.event_queue.virtual_events['pointer']
+        self.assertEqual(stats['retained_bytes'],
+                         len(ujson.dumps(message)) + len(ujson.dumps(pointer_event)))
+        self.assertEqual(stats['waiting_handlers'], 1)
+        self.assertEqual(stats['unloaded_queues'], 0)
+
+    def test_tornado_stats_endpoint(self) -> None:
+        req = POSTRequestMock(dict(secret=settings.SHARED_SECRET), user_profile=None)
+        req.META['REMOTE_ADDR'] = '127.0.0.1'
+        result = self.client_post_request('/tornado_stats', req)
+        self.assert_json_success(result)
+        self.assertIn('queues_by_client_type', result.json())
+        self.assertNotIn('retained_bytes', result.json())
+
+        req = POSTRequestMock(dict(secret=settings.SHARED_SECRET,
+                                   include_retained_bytes=ujson.dumps(True)),
+                              user_profile=None)
+        req.META['REMOTE_ADDR'] = '127.0.0.1'
+        result = self.client_post_request('/tornado_stats', req)
+        self.assert_json_success(result)
+        self.assertIn('retained_bytes', result.json())
+
+class GarbageCollectionTest(ZulipTestCase):
+    def allocate_client(self, last_connection_time: float, queue_timeout: int) -> ClientDescriptor:
+        hamlet = self.example_user('hamlet')
+        return allocate_client_descriptor(dict(
+            all_public_streams=False,
+            apply_markdown=False,
+            client_gravatar=True,
+            client_type_name='website',
+            event_types=None,
+            last_connection_time=last_connection_time,
+            queue_timeout=queue_timeout,
+            realm_id=hamlet.realm_id,
+            user_profile_id=hamlet.id,
+        ))
+
+    def test_gc_event_queues(self) -> None:
+        now = time.time()
+        expired = self.allocate_client(now - 700, 600)
+        active = self.allocate_client(now - 700, 600)
+        active.last_connection_time = now - 10
+        waiting = self.allocate_client(now - 700, 600)
+        waiting.current_handler_id = 1
+        fresh = self.allocate_client(now, 600)
+
+        gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(expired.event_queue.id))
+        for client in [active, waiting, fresh]:
+            self.assertIs(get_client_descriptor(client.event_queue.id), client)
+
+        # The queues that were looked at are rescheduled for when they
+        # could next expire.
+        heap_entries = {id: expires for (expires, id) in gc_heap}
+        self.assertEqual(heap_entries[active.event_queue.id], now - 10 + 600)
+        self.assertGreater(heap_entries[waiting.event_queue.id], now)
+
+        active.last_connection_time = now - 600
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=now + 600):
+            gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(active.event_queue.id))
+
+    def test_gc_event_queues_in_slices(self) -> None:
+        now = time.time()
+        clients = [self.allocate_client(now - 700, 600) for i in range(3)]
+        with mock.patch('zerver.tornado.event_queue.EVENT_QUEUE_GC_SLICE_SECS', 0), \
+                mock.patch('tornado.ioloop.IOLoop.add_callback') as add_callback:
+            gc_event_queues(9993)
+        # Only one queue was GC'd; the work continues on the next
+        # ioloop iteration.
+        add_callback.assert_called_once_with(gc_event_queues, 9993)
+        remaining = [client for client in clients
+                     if get_client_descriptor(client.event_queue.id) is not None]
+        self.assert_length(remaining, 2)
+
+        gc_event_queues(9993)
+        for client in clients:
+            self.assertIsNone(get_client_descriptor(client.event_queue.id))
@@ -9,6 +9,7 @@ import sys
 
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
+from django.db.models import F
 from django.utils.timezone import now as timezone_now
 from io import StringIO
 
@@ -87,6 +88,7 @@ from zerver.lib.actions import (
     do_unmute_topic,
     do_update_embedded_data,
     do_update_message,
+    do_mark_all_as_read,
     do_update_message_flags,
     do_update_outgoing_webhook_service,
     do_update_pointer,
@@ -110,11 +112,19 @@ from zerver.lib.events import (
     get_raw_user_data,
     post_process_state,
 )
+from zerver.lib.cache import flush_unread_summaries
 from zerver.lib.message import (
+    add_unread_row,
     aggregate_unread_data,
     get_raw_unread_data,
+    get_unread_summary,
     render_markdown,
+    save_unread_summary,
+    UnreadConversations,
     UnreadMessagesResult,
+    UnreadSummary,
+    MAX_UNREAD_MESSAGES,
+    MAX_UNREAD_SUMMARY_BYTES,
 )
 from zerver.lib.test_helpers import POSTRequestMock, get_subscription, \
     get_test_image_file, stub_event_queue_user_events, queries_captured, \
@@ -124,6 +134,7 @@ from zerver.lib.test_classes import (
 )
 from zerver.lib.test_runner import slow
 from zerver.lib.topic import (
+    MESSAGE__TOPIC,
     ORIG_TOPIC,
     TOPIC_NAME,
     TOPIC_LINKS,
@@ -148,8 +159,10 @@ from zerver.tornado.event_queue import (
 from zerver.tornado.views import get_events
 
 import mock
+import pickle
 import time
 import ujson
+import zlib
 
 
 class LogEventsTest(ZulipTestCase):
@@ -3085,6 +3098,94 @@ class GetUnreadMsgsTest(ZulipTestCase):
         result = get_unread_data()
         self.assertEqual(result['mentions'], [stream_message_id])
 
+    def test_unread_summary(self) -> None:
+        cordelia = self.example_user('cordelia')
+        hamlet = self.example_user('hamlet')
+
+        def get_unread_pm_ids() -> Set[int]:
+            return set(get_raw_unread_data(hamlet)['pm_dict'].keys())
+
+        message_ids = [self.send_personal_message(cordelia.email, hamlet.email, "hello %d" % (i,))
+                       for i in range(2)]
+
+        with mock.patch('zerver.lib.message.UNREAD_SUMMARY_SETTLE_SECONDS', 0):
+            # The first call notes the messages as pending, and the
+            # second adds them to the cached summary.
+            self.assertEqual(get_unread_pm_ids(), set(message_ids))
+            self.assertEqual(get_unread_pm_ids(), set(message_ids))
+
+            # Messages sent later are fetched without needing a flush.
+            message_ids.append(self.send_personal_message(cordelia.email, hamlet.email, "later"))
+            self.assertEqual(get_unread_pm_ids(), set(message_ids))
+
+            # Changes bypassing our actions aren't seen until the
+            # summary is flushed.
+            UserMessage.objects.filter(user_profile=hamlet, message_id=message_ids[0]).update(
+                flags=F('flags').bitor(UserMessage.flags.read))
+            self.assertEqual(get_unread_pm_ids(), set(message_ids))
+            flush_unread_summaries([hamlet.id])
+            self.assertEqual(get_unread_pm_ids(), set(message_ids[1:]))
+            self.assertEqual(get_unread_pm_ids(), set(message_ids[1:]))
+
+            # Marking messages as read updates the summary in place.
+            do_update_message_flags(hamlet, get_client("website"), 'add', 'read',
+                                    [message_ids[1]])
+            summary = get_unread_summary(hamlet.id)
+            assert summary is not None
+            self.assertEqual([list(messages[0]) for messages in summary['conversations'].values()],
+                             [[message_ids[2]]])
+            self.assertEqual(get_unread_pm_ids(), {message_ids[2]})
+
+            do_update_message_flags(hamlet, get_client("website"), 'remove', 'read',
+                                    [message_ids[1]])
+            self.assertIsNone(get_unread_summary(hamlet.id))
+            self.assertEqual(get_unread_pm_ids(), set(message_ids[1:]))
+
+            do_mark_all_as_read(hamlet, get_client("website"))
+            self.assertEqual(get_unread_pm_ids(), set())
+
+            # A summary too big to cache is just recomputed each time.
+            message_ids = [self.send_personal_message(cordelia.email, hamlet.email, "again")]
+            with mock.patch('zerver.lib.message.MAX_UNREAD_SUMMARY_BYTES', 10):
+                self.assertEqual(get_unread_pm_ids(), set(message_ids))
+                self.assertEqual(get_unread_pm_ids(), set(message_ids))
+                self.assertIsNone(get_unread_summary(hamlet.id))
+
+    def test_unread_summary_size(self) -> None:
+        # The summary of a full backlog of unread messages fits well
+        # within memcached's 1MB limit on the size of a value.
+        hamlet = self.example_user('hamlet')
+        conversations = {}  # type: UnreadConversations
+        message_id = 150000000
+        for i in range(MAX_UNREAD_MESSAGES):
+            message_id += 1 + (i * 7919) % 997
+            add_unread_row(conversations, {
+                'message_id': message_id,
+                'message__sender_id': 100000 + (i * 31) % 5000,
+                'message__recipient_id': 10 + (i * 17) % 20,
+                'message__recipient__type': Recipient.STREAM,
+                'message__recipient__type_id': 1 + (i * 17) % 20,
+                MESSAGE__TOPIC: 'topic %d' % ((i * 104729) % 500,),
+                'flags': UserMessage.flags.mentioned if i % 20 == 0 else 0,
+            })
+        per_message_tuples = {
+            conversation: [(unread_id, sender_id, unread_id in mentioned_ids)
+                           for (unread_id, sender_id) in zip(unread_ids, sender_ids)]
+            for (conversation, (unread_ids, sender_ids, mentioned_ids)) in conversations.items()
+        }
+
+        summary = dict(version='', max_message_id=message_id, conversations=conversations,
+                       pending_message_id=None, pending_time=0)  # type: UnreadSummary
+        with mock.patch('zerver.lib.message.cache_set') as mock_cache_set:
+            self.assertTrue(save_unread_summary(hamlet.id, summary, None, wait=False))
+        cached_value = mock_cache_set.call_args[0][1]
+        self.assertLess(len(cached_value), MAX_UNREAD_SUMMARY_BYTES)
+        # Much smaller than storing a tuple per message.
+        self.assertLess(2 * len(cached_value),
+                        len(pickle.dumps(per_message_tuples, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(pickle.loads(zlib.decompress(cached_value))['conversations'],
+                         conversations)
+
 class ClientDescriptorsTest(ZulipTestCase):
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
@@ -9,15 +9,23 @@ from django.utils.timezone import now as timezone_now
 from zerver.lib import bugdown
 from zerver.decorator import JsonableError
 from zerver.lib.test_runner import slow
-from zerver.lib.cache import get_stream_cache_key, cache_delete
+from zerver.lib.cache import get_stream_cache_key, cache_delete, cache_get, \
+    message_payload_cache_key
 
 from zerver.lib.addressee import Addressee
 
 from zerver.lib.actions import (
+    UserMessageLite,
+    batch_internal_messages,
+    get_internal_message_batch,
+    bulk_insert_ums,
+    bulk_insert_user_message_batches,
     check_message,
     check_send_stream_message,
     create_mirror_user_if_needed,
+    create_user_messages,
     do_add_alert_words,
+    do_change_full_name,
     do_change_stream_invite_only,
     do_create_user,
     do_deactivate_user,
@@ -30,6 +38,7 @@ from zerver.lib.actions import (
     get_last_message_id,
     get_user_info_for_message_updates,
     internal_prep_private_message,
+    internal_prep_stream_message,
     internal_prep_stream_message_by_name,
     internal_send_huddle_message,
     internal_send_message,
@@ -63,6 +72,7 @@ from zerver.lib.test_helpers import (
     most_recent_usermessage,
     queries_captured,
     get_subscription,
+    tornado_redirected_to_list,
 )
 
 from zerver.lib.test_classes import (
@@ -74,6 +84,7 @@ from zerver.lib.topic import (
     DB_TOPIC_NAME,
 )
 
+from zerver.lib.retention import move_messages_to_archive
 from zerver.lib.soft_deactivation import (
     add_missing_messages,
     do_soft_activate_users,
@@ -87,7 +98,8 @@ from zerver.models import (
     RealmAuditLog, RealmDomain, get_realm, UserPresence, Subscription,
     get_stream, get_stream_recipient, get_system_bot, get_user, Reaction,
     flush_per_request_caches, ScheduledMessage, get_huddle_recipient,
-    bulk_get_huddle_user_ids, get_huddle_user_ids
+    bulk_get_huddle_user_ids, get_huddle_user_ids, get_huddle_recipient_ids,
+    get_huddle_hash, huddle_recipient_ids_cache_key, Huddle, StreamTopic, PreregistrationUser
 )
 
 
@@ -103,9 +115,10 @@ from analytics.models import RealmCount
 
 import datetime
 import mock
+import threading
 import time
 import ujson
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set
 
 from collections import namedtuple
 
@@ -120,6 +133,93 @@ class MiscMessageTest(ZulipTestCase):
 
         self.assertEqual(get_last_message_id(), -1)
 
+    def test_bulk_insert_ums(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        message_id = self.send_stream_message(hamlet.email, 'Verona')
+        UserMessage.objects.filter(message_id=message_id).delete()
+
+        bulk_insert_ums([])
+        with queries_captured() as queries:
+            bulk_insert_ums([
+                UserMessageLite(hamlet.id, message_id, int(UserMessage.flags.read)),
+                UserMessageLite(cordelia.id, message_id, 0),
+            ])
+        self.assert_length(queries, 1)
+        self.assertEqual(
+            set(UserMessage.objects.filter(message_id=message_id).values_list(
+                'user_profile_id', 'flags')),
+            {(hamlet.id, int(UserMessage.flags.read)), (cordelia.id, 0)})
+
+    def test_create_user_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        iago = self.example_user('iago')
+        message_id = self.send_stream_message(hamlet.email, 'Verona')
+        UserMessage.objects.filter(message_id=message_id).delete()
+        message = Message.objects.get(id=message_id)
+        message.mentions_wildcard = False
+        message.user_ids_with_alert_words = {cordelia.id}
+
+        batch = create_user_messages(
+            message=message,
+            um_eligible_user_ids={hamlet.id, cordelia.id, othello.id, iago.id},
+            long_term_idle_user_ids={othello.id, iago.id},
+            stream_push_user_ids=set(),
+            stream_email_user_ids=set(),
+            mentioned_user_ids={cordelia.id, iago.id},
+            mark_as_read=[cordelia.id],
+        )
+        # othello is soft-deactivated and has no flags, so gets no row.
+        self.assertEqual(batch.flags_lists_by_user_id(), {
+            hamlet.id: [],
+            cordelia.id: ['read', 'mentioned', 'has_alert_word'],
+            iago.id: ['mentioned'],
+        })
+
+        with queries_captured() as queries:
+            bulk_insert_user_message_batches([batch])
+        self.assert_length(queries, 1)
+        self.assertEqual(
+            set(UserMessage.objects.filter(message_id=message_id).values_list(
+                'user_profile_id', flat=True)),
+            {hamlet.id, cordelia.id, iago.id})
+
+    def test_get_huddle_recipient(self) -> None:
+        user_ids = {self.example_user(name).id for name in ['hamlet', 'cordelia', 'othello']}
+
+        # A new huddle is created along with its recipient.
+        recipient = get_huddle_recipient(user_ids)
+        self.assertEqual(recipient.type, Recipient.HUDDLE)
+        self.assertEqual(Recipient.objects.get(id=recipient.id).type_id, recipient.type_id)
+        self.assertEqual(set(get_huddle_user_ids(recipient)), user_ids)
+
+        # The ids are then cached in-process, with no queries or
+        # memcached requests needed to resolve the huddle again.
+        with queries_captured() as queries:
+            with mock.patch('zerver.lib.cache.cache_get') as cache_get_mock:
+                self.assertEqual(get_huddle_recipient(set(user_ids)).id, recipient.id)
+        self.assert_length(queries, 0)
+        cache_get_mock.assert_not_called()
+
+        # An existing huddle that isn't cached is resolved in a single query.
+        huddle_ids = (recipient.type_id, recipient.id)
+        cache_key = huddle_recipient_ids_cache_key(get_huddle_hash(list(user_ids)))
+        get_huddle_recipient_ids.cache_clear()
+        cache_delete(cache_key)
+        with queries_captured() as queries:
+            self.assertEqual(get_huddle_recipient(user_ids).id, recipient.id)
+        self.assert_length(queries, 1)
+        self.assertEqual(Huddle.objects.filter(id=recipient.type_id).count(), 1)
+
+        # Both caches are filled again by the lookup.
+        self.assertEqual(cache_get(cache_key), (huddle_ids,))
+        self.assertEqual(get_huddle_recipient_ids.cache_info().currsize, 1)
+        with queries_captured() as queries:
+            self.assertEqual(get_huddle_recipient_ids(tuple(sorted(user_ids))), huddle_ids)
+        self.assert_length(queries, 0)
+
 class TopicHistoryTest(ZulipTestCase):
     def test_topics_history_zephyr_mirror(self) -> None:
         user_profile = self.mit_user('sipbtest')
@@ -251,6 +351,35 @@ class TopicHistoryTest(ZulipTestCase):
         self.assertNotIn('topic1', [topic['name'] for topic in history])
         self.assertNotIn('topic2', [topic['name'] for topic in history])
 
+    def test_stream_topics(self) -> None:
+        hamlet = self.example_user('hamlet')
+        stream = self.make_stream('topic history stream')
+        recipient = get_stream_recipient(stream.id)
+        self.subscribe(hamlet, stream.name)
+
+        def get_stream_topics() -> Dict[str, int]:
+            return dict(StreamTopic.objects.filter(recipient=recipient).values_list(
+                'topic_name', 'max_message_id'))
+
+        first_id = self.send_stream_message(hamlet.email, stream.name, topic_name='first')
+        second_id = self.send_stream_message(hamlet.email, stream.name, topic_name='second')
+        latest_id = self.send_stream_message(hamlet.email, stream.name, topic_name='first')
+        self.assertEqual(get_stream_topics(), {'first': latest_id, 'second': second_id})
+
+        # Moving a topic's latest message updates both topics.
+        Message.objects.filter(id=latest_id).update(subject='second')
+        self.assertEqual(get_stream_topics(), {'first': first_id, 'second': latest_id})
+
+        # Deleting a topic's only message removes the topic.
+        move_messages_to_archive([first_id])
+        self.assertEqual(get_stream_topics(), {'second': latest_id})
+        move_messages_to_archive([latest_id])
+        self.assertEqual(get_stream_topics(), {'second': second_id})
+
+        # Private messages aren't included.
+        self.send_personal_message(hamlet.email, self.example_email('cordelia'))
+        self.assertFalse(StreamTopic.objects.filter(recipient__type=Recipient.PERSONAL).exists())
+
     def test_bad_stream_id(self) -> None:
         email = self.example_email("iago")
         self.login(email)
@@ -626,6 +755,92 @@ class InternalPrepTest(ZulipTestCase):
         # wasn't automatically created.
         Stream.objects.get(name=stream_name, realm_id=realm.id)
 
+    def test_batch_internal_messages(self) -> None:
+        realm = get_realm('zulip')
+        cordelia = self.example_user('cordelia')
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        stream = get_stream('Verona', realm)
+        last_message_id = get_last_message_id()
+
+        with mock.patch('zerver.lib.actions.do_send_messages',
+                        wraps=do_send_messages) as m:
+            with batch_internal_messages():
+                self.assertIsNone(internal_send_private_message(
+                    realm, cordelia, hamlet, 'private'))
+                with batch_internal_messages():
+                    self.assertIsNone(internal_send_huddle_message(
+                        realm, cordelia, [hamlet.email, othello.email], 'huddle'))
+                self.assertIsNone(internal_send_stream_message(
+                    realm, cordelia, stream, 'batch', 'stream'))
+                self.assertIsNone(internal_send_message(
+                    realm, settings.NOTIFICATION_BOT, 'stream', stream.name,
+                    'batch', 'notification'))
+                self.assertEqual(get_last_message_id(), last_message_id)
+        self.assertEqual(m.call_count, 1)
+        messages = Message.objects.filter(id__gt=last_message_id).order_by('id')
+        self.assertEqual([message.content for message in messages],
+                         ['private', 'huddle', 'stream', 'notification'])
+
+        # Messages queued in a block that raises aren't sent.
+        with self.assertRaises(ZeroDivisionError):
+            with batch_internal_messages():
+                internal_send_private_message(realm, cordelia, hamlet, 'discarded')
+                1 / 0
+        self.assertFalse(Message.objects.filter(content='discarded').exists())
+
+        # Outside of a batch, we send the message right away.
+        message_id = internal_send_private_message(realm, cordelia, hamlet, 'unbatched')
+        self.assertEqual(Message.objects.get(id=message_id).content, 'unbatched')
+
+        # Batches are per-thread.
+        other_thread_batches = []  # type: List[Optional[List[Dict[str, Any]]]]
+        with batch_internal_messages():
+            self.assertEqual(get_internal_message_batch(), [])
+            thread = threading.Thread(
+                target=lambda: other_thread_batches.append(get_internal_message_batch()))
+            thread.start()
+            thread.join()
+        self.assertEqual(other_thread_batches, [None])
+
+    def test_batch_new_user_messages(self) -> None:
+        realm = get_realm('zulip')
+        iago = self.example_user('iago')
+        realm.signup_notifications_stream = get_stream('Verona', realm)
+        realm.save()
+
+        def create_user(email: str) -> UserProfile:
+            prereg_user = PreregistrationUser.objects.create(
+                email=email, referred_by=iago, realm=realm)
+            return do_create_user(email, None, realm, 'New user', 'new',
+                                  prereg_user=prereg_user)
+
+        # The invitation notice, the signup notice and the welcome bot
+        # PMs for a new user are all sent with one do_send_messages call.
+        last_message_id = get_last_message_id()
+        with mock.patch('zerver.lib.actions.do_send_messages',
+                        wraps=do_send_messages) as m:
+            new_user = create_user('newuser@zulip.com')
+        self.assertEqual(m.call_count, 1)
+        messages = Message.objects.filter(id__gt=last_message_id).order_by('id')
+        self.assertEqual([message.sender.email for message in messages],
+                         [settings.NOTIFICATION_BOT, settings.NOTIFICATION_BOT,
+                          settings.WELCOME_BOT])
+        self.assertIn('accepted your invitation', messages[0].content)
+        self.assertEqual(messages[1].topic_name(), 'signups')
+        self.assertEqual(messages[2].recipient.type_id, new_user.id)
+
+        # A caller's batch includes the messages for every user it
+        # creates.
+        last_message_id = get_last_message_id()
+        with mock.patch('zerver.lib.actions.do_send_messages',
+                        wraps=do_send_messages) as m:
+            with batch_internal_messages():
+                for i in range(3):
+                    create_user('bulkuser%s@zulip.com' % (i,))
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(Message.objects.filter(id__gt=last_message_id).count(), 9)
+
 class ExtractedRecipientsTest(TestCase):
     def test_extract_recipients_emails(self) -> None:
 
@@ -988,6 +1203,62 @@ class StreamMessagesTest(ZulipTestCase):
         message = most_recent_message(user_profile)
         assert(UserMessage.objects.get(user_profile=user_profile, message=message).flags.mentioned.is_set)
 
+    def test_async_message_fanout(self) -> None:
+        hamlet = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        self.subscribe(iago, "Denmark")
+
+        def send_message() -> Dict[str, Any]:
+            events = []  # type: List[Mapping[str, Any]]
+            with tornado_redirected_to_list(events):
+                self.send_stream_message(hamlet.email, "Denmark",
+                                         content="test @**Iago** rules")
+            self.assertEqual(len(events), 1)
+            return events[0]
+
+        sync_event = send_message()
+        # The test's transaction never commits, so run the on_commit
+        # callbacks right away; without RabbitMQ, the message_fanout
+        # worker then runs inline.
+        with self.settings(ASYNC_MESSAGE_FANOUT=True), \
+                mock.patch('django.db.transaction.on_commit', side_effect=lambda f: f()):
+            async_event = send_message()
+
+        self.assertEqual(async_event['event']['type'], 'message')
+        self.assertEqual(async_event['event']['message'], most_recent_message(iago).id)
+        self.assertEqual(async_event['event']['stream_name'], 'Denmark')
+
+        def users_by_id(event: Mapping[str, Any]) -> Dict[int, Dict[str, Any]]:
+            return {user['id']: user for user in event['users']}
+        self.assertEqual(users_by_id(async_event), users_by_id(sync_event))
+        self.assertIn('mentioned', users_by_id(async_event)[iago.id]['flags'])
+
+    def test_async_message_fanout_deleted_message(self) -> None:
+        hamlet = self.example_user('hamlet')
+        stream = get_stream("Denmark", hamlet.realm)
+        messages = [
+            internal_prep_stream_message(hamlet.realm, hamlet, stream, "test", content)
+            for content in ["deleted", "kept"]
+        ]
+
+        on_commit_callbacks = []  # type: List[Callable[[], None]]
+        with self.settings(ASYNC_MESSAGE_FANOUT=True), \
+                mock.patch('django.db.transaction.on_commit',
+                           side_effect=on_commit_callbacks.append):
+            (deleted_id, kept_id) = do_send_messages(messages)
+        # Nothing is published until the transaction commits.
+        self.assertEqual(len(on_commit_callbacks), 1)
+
+        Message.objects.filter(id=deleted_id).delete()
+
+        events = []  # type: List[Mapping[str, Any]]
+        with tornado_redirected_to_list(events), \
+                mock.patch('logging.warning') as mock_warning:
+            on_commit_callbacks[0]()
+        mock_warning.assert_called_once_with(
+            "message_fanout: Skipping missing message %s" % (deleted_id,))
+        self.assertEqual([event['event']['message'] for event in events], [kept_id])
+
     def test_is_private_flag(self) -> None:
         user_profile = self.example_user('iago')
         self.subscribe(user_profile, "Denmark")
@@ -4282,6 +4553,63 @@ class MessageHydrationTest(ZulipTestCase):
         self.assertIn('class="user-mention"', new_message['content'])
         self.assertEqual(new_message['flags'], ['mentioned'])
 
+    def test_messages_for_ids_cached_payloads(self) -> None:
+        hamlet = self.example_user('hamlet')
+        self.login(hamlet.email)
+        message_id = self.send_stream_message(hamlet.email, 'Denmark',
+                                              content='**before edit**')
+
+        def fetch_message(flags: List[str], apply_markdown: bool=True,
+                          allow_edit_history: bool=True) -> Dict[str, Any]:
+            messages = messages_for_ids(
+                message_ids=[message_id],
+                user_message_flags={message_id: flags},
+                search_fields={},
+                apply_markdown=apply_markdown,
+                client_gravatar=False,
+                allow_edit_history=allow_edit_history,
+            )
+            self.assertEqual(len(messages), 1)
+            return messages[0]
+
+        message = fetch_message(['read'])
+        self.assertIsNotNone(cache_get(message_payload_cache_key(message_id, True, False)))
+        self.assertIsNone(cache_get(message_payload_cache_key(message_id, False, False)))
+
+        # Per-user fields are never served from the cached payload.
+        cached_message = fetch_message(['starred'])
+        self.assertEqual(cached_message['flags'], ['starred'])
+        message['flags'] = ['starred']
+        self.assertEqual(cached_message, message)
+
+        message = fetch_message([], apply_markdown=False)
+        self.assertEqual(message['content'], '**before edit**')
+        self.assertEqual(message['content_type'], 'text/x-markdown')
+
+        # Changes to the sender are picked up...
+        do_change_full_name(hamlet, 'Prince Hamlet', acting_user=None)
+        message = fetch_message([])
+        self.assertEqual(message['sender_full_name'], 'Prince Hamlet')
+
+        # ...as are changes to the message itself.
+        result = self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'content': 'after edit',
+        })
+        self.assert_json_success(result)
+        message = fetch_message([])
+        self.assertEqual(message['content'], '<p>after edit</p>')
+        self.assertIn('edit_history', message)
+
+        message = fetch_message([], allow_edit_history=False)
+        self.assertNotIn('edit_history', message)
+        self.assertIn('edit_history', fetch_message([]))
+
+        uncached = MessageDict.to_dict_uncached_helper(Message.objects.get(id=message_id))
+        MessageDict.post_process_dicts([uncached], apply_markdown=True, client_gravatar=False)
+        uncached['flags'] = []
+        self.assertEqual(fetch_message([]), uncached)
+
 class MessageVisibilityTest(ZulipTestCase):
     def test_update_first_visible_message_id(self) -> None:
         Message.objects.all().delete()
@@ -43,6 +43,7 @@ from zerver.views.messages import (
     NarrowBuilder, BadNarrowOperator, Query,
     post_process_limited_query,
     find_first_unread_anchor,
+    limit_message_ids_to_range,
     LARGER_THAN_MAX_MESSAGE_ID,
 )
 
@@ -379,6 +380,18 @@ class NarrowLibraryTest(TestCase):
             for e in reject_events:
                 self.assertFalse(narrow_filter(e))
 
+    def test_build_narrow_filter_compiled(self) -> None:
+        event = dict(message=dict(type="stream", display_recipient="Devel",
+                                  subject="Python", sender_email="Hamlet@zulip.com"),
+                     flags=["starred"])
+        self.assertTrue(build_narrow_filter([])(event))
+        self.assertTrue(build_narrow_filter([["stream", "DEVEL"], ["topic", "python"],
+                                             ["sender", "hamlet@zulip.com"],
+                                             ["is", "starred"], ["is", "unread"]])(event))
+        self.assertFalse(build_narrow_filter([["stream", "devel"], ["stream", "social"]])(event))
+        self.assertFalse(build_narrow_filter([["stream", "devel"], ["is", "private"]])(event))
+        self.assertFalse(build_narrow_filter([["stream", "devel"], ["is", "mentioned"]])(event))
+
     def test_build_narrow_filter_invalid(self) -> None:
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
@@ -910,6 +923,31 @@ class PostProcessTest(ZulipTestCase):
             found_newest=False, history_limited=False
         )
 
+    def test_limit_message_ids_to_range(self) -> None:
+        def verify(num_before: int, num_after: int, anchor: int,
+                   out_ids: List[int], first_visible_message_id: int=0) -> None:
+            self.assertEqual(limit_message_ids_to_range(
+                message_ids=[2, 4, 6, 8, 10],
+                num_before=num_before,
+                num_after=num_after,
+                anchor=anchor,
+                anchored_to_left=(anchor == 0),
+                anchored_to_right=(anchor == LARGER_THAN_MAX_MESSAGE_ID),
+                first_visible_message_id=first_visible_message_id,
+            ), out_ids)
+
+        verify(num_before=1, num_after=1, anchor=6, out_ids=[4, 6, 8])
+        verify(num_before=1, num_after=1, anchor=5, out_ids=[4, 6, 8])
+        verify(num_before=1, num_after=1, anchor=6, out_ids=[4, 8, 10],
+               first_visible_message_id=7)
+        verify(num_before=2, num_after=0, anchor=6, out_ids=[2, 4, 6])
+        verify(num_before=0, num_after=2, anchor=6, out_ids=[6, 8, 10])
+        verify(num_before=0, num_after=2, anchor=0, out_ids=[2, 4, 6])
+        verify(num_before=2, num_after=2, anchor=LARGER_THAN_MAX_MESSAGE_ID,
+               out_ids=[8, 10])
+        verify(num_before=0, num_after=0, anchor=6, out_ids=[6])
+        verify(num_before=0, num_after=0, anchor=5, out_ids=[])
+
 class GetOldMessagesTest(ZulipTestCase):
 
     def get_and_check_messages(self,
@@ -1614,6 +1652,59 @@ class GetOldMessagesTest(ZulipTestCase):
         self.assertEqual(multi_search_result['messages'][0]['match_content'],
                          '<p>こんに <span class="highlight">ちは</span> 。 <span class="highlight">今日は</span> いい 天気ですね。</p>')
 
+    @override_settings(USING_PGROONGA=False)
+    def test_get_messages_with_search_cache(self) -> None:
+        self.login(self.example_email("cordelia"))
+        cordelia = self.example_user("cordelia")
+        next_message_id = self.get_last_message().id + 1
+
+        lunch_message_ids = [
+            self.send_stream_message(cordelia.email, "Verona", content="lunch %d" % (i,))
+            for i in range(3)
+        ]
+        other_message_id = self.send_stream_message(cordelia.email, "Verona", content="dinner")
+        self._update_tsvector_index()
+
+        def search_ids(num_before: int=0, num_after: int=10) -> List[int]:
+            result = self.get_and_check_messages(dict(
+                narrow=ujson.dumps([dict(operator='search', operand='lunch')]),
+                anchor=next_message_id,
+                num_before=num_before,
+                num_after=num_after,
+            ))  # type: Dict[str, Any]
+            for message in result['messages']:
+                self.assertIn('<span class="highlight">lunch</span>', message['match_content'])
+            return [message['id'] for message in result['messages']]
+
+        with mock.patch('zerver.views.messages.SEARCH_RESULTS_SETTLE_SECONDS', 0):
+            # The search is cached once it's repeated, and the messages
+            # are added to the cache once they've settled.
+            for i in range(3):
+                self.assertEqual(search_ids(), lunch_message_ids)
+            self.assertEqual(search_ids(num_after=1), lunch_message_ids[:2])
+
+            # New messages are found without flushing the cache.
+            lunch_message_ids.append(
+                self.send_stream_message(cordelia.email, "Verona", content="more lunch"))
+            self._update_tsvector_index()
+            self.assertEqual(search_ids(), lunch_message_ids)
+
+            # But older messages that only now match (here, because we
+            # bypass do_update_message) aren't, until the cache is
+            # flushed.
+            Message.objects.filter(id=other_message_id).update(
+                content="lunch", rendered_content="<p>lunch</p>")
+            self._update_tsvector_index()
+            self.assertEqual(search_ids(), lunch_message_ids)
+
+            result = self.client_patch("/json/messages/" + str(other_message_id), {
+                'message_id': other_message_id,
+                'content': 'lunch again',
+            })
+            self.assert_json_success(result)
+            self._update_tsvector_index()
+            self.assertEqual(search_ids(), sorted(lunch_message_ids + [other_message_id]))
+
     @override_settings(USING_PGROONGA=False)
     def test_get_visible_messages_with_search(self) -> None:
         self.login(self.example_email('hamlet'))
@@ -2049,6 +2140,72 @@ class GetOldMessagesTest(ZulipTestCase):
         result = self.client_get("/json/messages", dict(anchor=1, num_before=0, num_after=6000))
         self.assert_json_error(result, "Too many messages requested (maximum 5000).")
 
+    def get_message_batches(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        result = self.client_get("/json/messages/batches", params)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(result.streaming_content).decode('utf-8').splitlines()
+        return [ujson.loads(line) for line in lines]
+
+    def test_get_message_batches(self) -> None:
+        self.login(self.example_email("hamlet"))
+        Message.objects.all().delete()
+
+        message_ids = [self.send_stream_message(self.example_email("cordelia"), "Verona")
+                       for i in range(10)]
+        self.send_personal_message(self.example_email("cordelia"), self.example_email("hamlet"))
+        narrow = ujson.dumps([dict(operator='stream', operand='Verona')])
+
+        with queries_captured() as queries:
+            lines = self.get_message_batches(dict(narrow=narrow, batch_size=3))
+        self.assertEqual([[message['id'] for message in line['messages']] for line in lines[:-1]],
+                         [message_ids[0:3], message_ids[3:6], message_ids[6:9], message_ids[9:]])
+        self.assertEqual(lines[-1], dict(result='success', msg='', found_newest=True,
+                                         anchor=message_ids[9] + 1))
+        self.assertEqual(len([query for query in queries
+                              if '/* get_message_batches */' in query['sql']]), 4)
+
+        # With num_after, we stop early, and return the anchor to resume from.
+        lines = self.get_message_batches(dict(narrow=narrow, batch_size=3, num_after=5))
+        self.assertEqual([[message['id'] for message in line['messages']] for line in lines[:-1]],
+                         [message_ids[0:3], message_ids[3:5]])
+        self.assertEqual(lines[-1]['found_newest'], False)
+        self.assertEqual(lines[-1]['anchor'], message_ids[4] + 1)
+
+        lines = self.get_message_batches(dict(narrow=narrow, anchor=lines[-1]['anchor']))
+        self.assertEqual([message['id'] for message in lines[0]['messages']], message_ids[5:])
+        self.assertEqual(lines[-1]['found_newest'], True)
+
+        # Without a narrow, we return the messages hamlet received,
+        # including the private message, with their flags.
+        lines = self.get_message_batches(dict())
+        self.assert_length(lines, 2)
+        self.assert_length(lines[0]['messages'], 11)
+        self.assertEqual(lines[0]['messages'][-1]['type'], 'private')
+        self.assertEqual(lines[0]['messages'][0]['flags'], [])
+
+        # Messages before the realm's first visible message are skipped.
+        with first_visible_id_as(message_ids[8]):
+            lines = self.get_message_batches(dict(narrow=narrow))
+        self.assertEqual([message['id'] for message in lines[0]['messages']], message_ids[8:])
+
+        # An empty narrow result is just the final line.
+        lines = self.get_message_batches(dict(narrow=narrow, anchor=message_ids[9] + 1))
+        self.assertEqual(lines, [dict(result='success', msg='', found_newest=True,
+                                      anchor=message_ids[9] + 1)])
+
+    def test_get_message_batches_errors(self) -> None:
+        self.login(self.example_email("hamlet"))
+        result = self.client_get("/json/messages/batches", dict(num_after=20001))
+        self.assert_json_error(result, "Too many messages requested (maximum 20000).")
+        result = self.client_get("/json/messages/batches", dict(batch_size=0))
+        self.assert_json_error(result, "Invalid batch_size (maximum 5000).")
+        result = self.client_get("/json/messages/batches", dict(batch_size=5001))
+        self.assert_json_error(result, "Invalid batch_size (maximum 5000).")
+        result = self.client_get("/json/messages/batches", dict(
+            narrow=ujson.dumps([dict(operator='stream', operand='non-existent')])))
+        self.assert_json_error_contains(result, 'Invalid narrow operator: unknown stream')
+
     def test_bad_int_params(self) -> None:
         """
         num_before, num_after, and narrow must all be non-negative
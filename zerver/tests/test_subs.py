@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from typing import Any, Dict, List, Mapping, Optional, Set
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -33,7 +33,10 @@ from zerver.lib.streams import (
 
 from zerver.lib.stream_subscription import (
     get_active_subscriptions_for_stream_id,
+    get_stream_subscriber_rows,
     num_subscribers_for_stream_id,
+    STREAM_EMAIL_NOTIFY,
+    STREAM_PUSH_NOTIFY,
 )
 
 from zerver.lib.test_runner import (
@@ -44,7 +47,7 @@ from zerver.models import (
     Realm, Recipient, Stream, Subscription,
     DefaultStream, UserProfile, get_user_profile_by_id, active_non_guest_user_ids,
     get_default_stream_groups, flush_per_request_caches, DefaultStreamGroup,
-    get_client, get_realm, get_user, Message, UserMessage
+    get_client, get_realm, get_stream_recipient, get_user, Message, UserMessage
 )
 
 from zerver.lib.actions import (
@@ -57,6 +60,9 @@ from zerver.lib.actions import (
     ensure_stream,
     do_deactivate_stream,
     do_deactivate_user,
+    do_reactivate_user,
+    do_change_notification_settings,
+    do_change_subscription_property,
     do_create_default_stream_group,
     do_add_streams_to_default_stream_group, do_remove_streams_from_default_stream_group,
     do_remove_default_stream_group,
@@ -3167,7 +3173,7 @@ class SubscriptionAPITest(ZulipTestCase):
                     principals=ujson.dumps([user1.email, user2.email])
                 )
             )
-        self.assert_length(queries, 53)
+        self.assert_length(queries, 52)
 
 class GetBotOwnerStreamsTest(ZulipTestCase):
     def test_streams_api_for_bot_owners(self) -> None:
@@ -3924,3 +3930,49 @@ class StreamTrafficTest(ZulipTestCase):
 
     def test_round_to_2_significant_digits(self) -> None:
         self.assertEqual(120, round_to_2_significant_digits(116))
+
+class StreamSubscriberRowsTest(ZulipTestCase):
+    def test_get_stream_subscriber_rows(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        stream = self.subscribe(hamlet, 'Test Stream')
+        self.subscribe(cordelia, 'Test Stream')
+        recipient_id = get_stream_recipient(stream.id).id
+
+        def get_rows() -> List[Tuple[int, int]]:
+            (user_ids, flags) = get_stream_subscriber_rows(recipient_id)
+            return list(zip(user_ids, flags))
+
+        self.assertEqual(get_rows(), sorted([(hamlet.id, 0), (cordelia.id, 0)]))
+        # The rows are now cached.
+        with queries_captured() as queries:
+            get_rows()
+        self.assert_length(queries, 0)
+
+        sub = get_subscription('Test Stream', hamlet)
+        do_change_subscription_property(hamlet, sub, stream, 'push_notifications', True)
+        self.assertIn((hamlet.id, STREAM_PUSH_NOTIFY), get_rows())
+
+        # Muting the stream overrides the notification settings.
+        do_change_subscription_property(hamlet, sub, stream, 'in_home_view', False)
+        self.assertIn((hamlet.id, 0), get_rows())
+
+        do_change_notification_settings(cordelia, 'enable_stream_email_notifications', True)
+        self.assertIn((cordelia.id, STREAM_EMAIL_NOTIFY), get_rows())
+
+        self.unsubscribe(cordelia, 'Test Stream')
+        self.assertEqual(get_rows(), [(hamlet.id, 0)])
+
+        # Saving a user without update_fields doesn't query for their
+        # subscriptions to flush.
+        with mock.patch('zerver.lib.cache.delete_stream_subscriber_rows_cache') as flush_mock:
+            cordelia.save()
+        flush_mock.assert_not_called()
+
+        do_deactivate_user(hamlet)
+        self.assertEqual(get_rows(), [])
+
+        do_reactivate_user(hamlet)
+        self.assertEqual(get_rows(), [(hamlet.id, 0)])
+        do_deactivate_stream(stream)
+        self.assertEqual(get_rows(), [])
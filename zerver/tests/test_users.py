@@ -28,6 +28,8 @@ from zerver.lib.send_email import send_future_email, clear_scheduled_emails, \
 from zerver.lib.actions import (
     get_emails_from_user_ids,
     get_recipient_info,
+    bulk_get_recipient_info,
+    RecipientInfoTarget,
     do_deactivate_user,
     do_reactivate_user,
     do_change_is_admin,
@@ -1135,6 +1137,53 @@ class RecipientInfoTest(ZulipTestCase):
                 stream_topic=stream_topic,
             )
 
+    def test_bulk_get_recipient_info(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        realm = hamlet.realm
+
+        stream_name = 'Test Stream'
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream_name)
+        stream = get_stream(stream_name, realm)
+        recipient = get_stream_recipient(stream.id)
+
+        hamlet.enable_stream_push_notifications = True
+        hamlet.save()
+        add_topic_mute(
+            user_profile=hamlet,
+            stream_id=stream.id,
+            recipient_id=recipient.id,
+            topic_name='muted topic',
+        )
+
+        def target(topic_name: str) -> RecipientInfoTarget:
+            return dict(
+                recipient=recipient,
+                sender_id=cordelia.id,
+                stream_topic=StreamTopicTarget(stream_id=stream.id, topic_name=topic_name),
+                possibly_mentioned_user_ids=None,
+            )
+
+        targets = [target('test topic') for i in range(10)] + [target('Muted Topic')]
+        with queries_captured() as queries:
+            infos = bulk_get_recipient_info(targets)
+        # The subscription, topic mute and user queries, once for
+        # each topic.
+        self.assert_length(queries, 6)
+
+        self.assertEqual(infos[0]['stream_push_user_ids'], {hamlet.id})
+        self.assertEqual(infos[-1]['stream_push_user_ids'], set())
+        for (info, target_) in zip(infos, targets):
+            self.assertEqual(info, get_recipient_info(
+                recipient=target_['recipient'],
+                sender_id=target_['sender_id'],
+                stream_topic=target_['stream_topic'],
+            ))
+
+        # Each message gets its own copies of the user id sets.
+        self.assertIsNot(infos[0]['active_user_ids'], infos[1]['active_user_ids'])
+
 class BulkUsersTest(ZulipTestCase):
     def test_client_gravatar_option(self) -> None:
         self.login(self.example_email('cordelia'))
@@ -18,6 +18,7 @@ def setup_tornado_rabbitmq() -> None:  # nocoverage
 def create_tornado_application(port: int) -> tornado.web.Application:
     urls = (
         r"/notify_tornado",
+        r"/tornado_stats",
         r"/json/events",
         r"/api/v1/events",
         r"/api/v1/events/internal",
@@ -1,18 +1,23 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from typing_extensions import Deque, TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from collections import deque
+import abc
+import mmap
 import os
+import struct
 import time
 import logging
 import ujson
 import requests
 import atexit
+import functools
+import heapq
 import sys
 import signal
 import tornado.ioloop
@@ -29,8 +34,9 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
-from zerver.tornado.sharding import get_tornado_uri, get_tornado_port, \
-    notify_tornado_queue_name
+from zerver.tornado.sharding import get_tornado_uri_for_port, get_tornado_uri_for_user, \
+    get_tornado_port, get_user_shard_port, notify_tornado_queue_name, shard_event_users, \
+    user_sharding_enabled
 from zerver.tornado.autoreload import add_reload_hook
 import copy
 
@@ -45,9 +51,12 @@ for host in ['127.0.0.1', 'localhost']:
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each GC only looks at the queues
+# that may have expired since the last one (see gc_event_queues).
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
+# The maximum time a GC may block the ioloop for; the remaining work
+# is done in further slices on the following ioloop iterations.
+EVENT_QUEUE_GC_SLICE_SECS = 0.005
 
 # Capped limit for how long a client can request an event queue
 # to live
@@ -91,6 +100,7 @@ class ClientDescriptor:
         self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.call_later
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_fanout_key = get_narrow_fanout_key(narrow)
 
         # Default for lifespan_secs is DEFAULT_EVENT_QUEUE_TIMEOUT_SECS;
         # but users can set it as high as MAX_QUEUE_TIMEOUT_SECS.
@@ -98,22 +108,24 @@ class ClientDescriptor:
             lifespan_secs = DEFAULT_EVENT_QUEUE_TIMEOUT_SECS
         self.queue_timeout = min(lifespan_secs, MAX_QUEUE_TIMEOUT_SECS)
 
-    def to_dict(self) -> Dict[str, Any]:
+    def to_dict(self, include_event_queue: bool=True) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
-        return dict(user_profile_id=self.user_profile_id,
-                    user_profile_email=self.user_profile_email,
-                    realm_id=self.realm_id,
-                    event_queue=self.event_queue.to_dict(),
-                    queue_timeout=self.queue_timeout,
-                    event_types=self.event_types,
-                    last_connection_time=self.last_connection_time,
-                    apply_markdown=self.apply_markdown,
-                    client_gravatar=self.client_gravatar,
-                    all_public_streams=self.all_public_streams,
-                    narrow=self.narrow,
-                    client_type_name=self.client_type_name)
+        d = dict(user_profile_id=self.user_profile_id,
+                 user_profile_email=self.user_profile_email,
+                 realm_id=self.realm_id,
+                 queue_timeout=self.queue_timeout,
+                 event_types=self.event_types,
+                 last_connection_time=self.last_connection_time,
+                 apply_markdown=self.apply_markdown,
+                 client_gravatar=self.client_gravatar,
+                 all_public_streams=self.all_public_streams,
+                 narrow=self.narrow,
+                 client_type_name=self.client_type_name)  # type: Dict[str, Any]
+        if include_event_queue:
+            d['event_queue'] = self.event_queue.to_dict()
+        return d
 
     def __repr__(self) -> str:
         return "ClientDescriptor<%s>" % (self.event_queue.id,)
@@ -162,7 +174,19 @@ class ClientDescriptor:
             async_request_timer_restart(handler._request)
 
         self.event_queue.push(event)
-        self.finish_current_handler()
+        self.finish_current_handler_after_batch()
+
+    def add_message_event(self, message: Dict[str, Any], flags: Iterable[str],
+                          extra: Optional[Dict[str, Any]]=None) -> None:
+        # Unlike add_event, `message` and `extra` may be shared with
+        # other clients; the event queue stores references to them
+        # and never mutates them.
+        if self.current_handler_id is not None:
+            handler = get_handler_by_id(self.current_handler_id)
+            async_request_timer_restart(handler._request)
+
+        self.event_queue.push_message(message, flags, extra)
+        self.finish_current_handler_after_batch()
 
     def finish_current_handler(self) -> bool:
         if self.current_handler_id is not None:
@@ -177,6 +201,15 @@ class ClientDescriptor:
                 return True
         return False
 
+    def finish_current_handler_after_batch(self) -> None:
+        # While process_notifications is running, hold off on
+        # finishing the handler, so that it returns every event from
+        # the batch in one response.
+        if clients_to_finish is not None and self.current_handler_id is not None:
+            clients_to_finish.add(self)
+            return
+        self.finish_current_handler()
+
     def accepts_event(self, event: Mapping[str, Any]) -> bool:
         if self.event_types is not None and event["type"] not in self.event_types:
             return False
@@ -188,6 +221,15 @@ class ClientDescriptor:
     def accepts_messages(self) -> bool:
         return self.event_types is None or "message" in self.event_types
 
+    def accepts_message(self, message: Mapping[str, Any], flags: Iterable[str]) -> bool:
+        # Equivalent to accepts_event on the message event for this
+        # client, without having to construct that event.
+        if not self.accepts_messages():
+            return False
+        if not self.narrow:
+            return True
+        return self.narrow_filter(dict(message=message, flags=flags))
+
     def expired(self, now: float) -> bool:
         return (self.current_handler_id is None and
                 now - self.last_connection_time >= self.queue_timeout)
@@ -241,81 +283,316 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+class CoalescingRule:
+    """Describes how EventQueue.push collapses events of a given type
+    into "virtual" events, for types where a client that has been
+    away only needs the latest state, keeping the queues of idle
+    clients short.
+
+    `key` returns which pending virtual event of this type an event
+    should be merged into ("" if there is only one per queue), or None
+    if the event must be queued as is; in that case, pending virtual
+    events of the type are sealed, so that later events are never
+    merged into them (and thus moved past this one).  `merge` updates
+    a virtual event with a newer event; the id and timestamp are
+    always updated, since a virtual event takes the place in the queue
+    of the newest event merged into it.
+    """
+    def __init__(self, key: Callable[[Mapping[str, Any]], Optional[str]],
+                 merge: Callable[[Dict[str, Any], Mapping[str, Any]], None]) -> None:
+        self.key = key
+        self.merge = merge
+
+def merge_latest(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    virtual_event.update(copy.deepcopy(event))
+
+def merge_pointer(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    virtual_event["pointer"] = event["pointer"]
+
+def merge_restart(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    virtual_event["server_generation"] = event["server_generation"]
+
+def merge_flags(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    virtual_event["messages"] += event["messages"]
+
+def merge_presence(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    # Each event has the status from one of the user's clients.
+    virtual_event["server_timestamp"] = event["server_timestamp"]
+    virtual_event["presence"].update(copy.deepcopy(event["presence"]))
+
+def merge_person(virtual_event: Dict[str, Any], event: Mapping[str, Any]) -> None:
+    virtual_event["person"].update(copy.deepcopy(event["person"]))
+
+def get_typing_key(event: Mapping[str, Any]) -> str:
+    recipient_ids = sorted(recipient["user_id"] for recipient in event["recipients"])
+    return "%s/%s" % (event["sender"]["user_id"], ",".join(str(id) for id in recipient_ids))
+
+def get_realm_user_key(event: Mapping[str, Any]) -> Optional[str]:
+    if event["op"] != "update" or "user_id" not in event["person"]:
+        return None
+    user_id = event["person"]["user_id"]
+    if "custom_profile_field" in event["person"]:
+        # Each update is for a single field, so key by the field.
+        return "%s/custom_profile_field/%s" % (user_id, event["person"]["custom_profile_field"]["id"])
+    return str(user_id)
+
+COALESCING_RULES = {
+    "pointer": CoalescingRule(lambda event: "", merge_pointer),
+    "restart": CoalescingRule(lambda event: "", merge_restart),
+    "presence": CoalescingRule(lambda event: event["email"], merge_presence),
+    "typing": CoalescingRule(get_typing_key, merge_latest),
+    "realm_user": CoalescingRule(get_realm_user_key, merge_person),
+}  # type: Dict[str, CoalescingRule]
+FLAGS_COALESCING_RULE = CoalescingRule(lambda event: "", merge_flags)
+ALL_FLAGS_COALESCING_RULE = CoalescingRule(lambda event: "", merge_latest)
+
+def get_coalescing_rule(full_event_type: str) -> Optional[CoalescingRule]:
+    if full_event_type.startswith("flags/"):
+        return FLAGS_COALESCING_RULE
+    if full_event_type.startswith("all_flags/"):
+        return ALL_FLAGS_COALESCING_RULE
+    return COALESCING_RULES.get(full_event_type)
+
+class QueuedEvent:
+    """A single event stored in an EventQueue.
+
+    Message events are most of what accumulates in an idle client's
+    queue, so rather than keeping a fully materialized event dict for
+    each one, we keep a reference to the message payload (which is
+    shared between all clients with the same (apply_markdown,
+    client_gravatar) settings; see process_message_event), plus the
+    few per-client fields: the flags and any extra keys (notification
+    metadata, local_message_id).  The shared payload and `extra` must
+    never be mutated.  The event dict is only built when the event is
+    returned to the client, in to_dict.
+
+    Any other event is stored as its (unique) event dict.
+    """
+    __slots__ = ('id', 'event', 'message', 'flags')
+
+    def __init__(self, id: int, event: Optional[Dict[str, Any]],
+                 message: Optional[Dict[str, Any]]=None,
+                 flags: Tuple[str, ...]=()) -> None:
+        self.id = id
+        self.event = event
+        self.message = message
+        self.flags = flags
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.message is None:
+            assert self.event is not None
+            return self.event
+        event = dict(type='message', message=self.message,
+                     flags=list(self.flags))  # type: Dict[str, Any]
+        if self.event is not None:
+            event.update(self.event)
+        event['id'] = self.id
+        return event
+
+    @classmethod
+    def from_dict(cls, event: Dict[str, Any]) -> 'QueuedEvent':
+        if event['type'] != 'message' or 'message' not in event:
+            return cls(event['id'], event)
+        extra = {key: value for (key, value) in event.items()
+                 if key not in ('id', 'type', 'message', 'flags')}
+        return cls(event['id'], extra or None, event['message'],
+                   tuple(event.get('flags', [])))
+
 class EventQueue:
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue = deque()  # type: Deque[Dict[str, Any]]
+        self.queue = deque()  # type: Deque[QueuedEvent]
         self.next_event_id = 0  # type: int
         self.newest_pruned_id = -1  # type: Optional[int] # will only be None for migration from old versions
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
 
+        # For queues restored lazily by the snapshot persistence
+        # backend: the serialized to_dict() of the queue, and any
+        # events pushed before it was deserialized, as (method name,
+        # arguments) pairs to replay.  While `serialized` is set, the
+        # attributes above are placeholders; see lazy().
+        self.serialized = None  # type: Optional[memoryview]
+        self.pending_pushes = []  # type: List[Tuple[str, List[Any]]]
+
     def to_dict(self) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
+        self.ensure_loaded()
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=[event.to_dict() for event in self.queue],
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
             d['newest_pruned_id'] = self.newest_pruned_id
         return d
 
+    def restore(self, d: Dict[str, Any]) -> None:
+        self.next_event_id = d['next_event_id']
+        self.newest_pruned_id = d.get('newest_pruned_id', None)
+        self.queue = deque(QueuedEvent.from_dict(event) for event in d['queue'])
+        self.virtual_events = d.get("virtual_events", {})
+
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> 'EventQueue':
         ret = cls(d['id'])
-        ret.next_event_id = d['next_event_id']
-        ret.newest_pruned_id = d.get('newest_pruned_id', None)
-        ret.queue = deque(d['queue'])
-        ret.virtual_events = d.get("virtual_events", {})
+        ret.restore(d)
         return ret
 
+    @classmethod
+    def lazy(cls, id: str, serialized: memoryview,
+             pending_pushes: Optional[List[Tuple[str, List[Any]]]]=None) -> 'EventQueue':
+        """Returns an EventQueue whose contents are only deserialized
+        from `serialized` (the JSON encoding of to_dict()) by
+        ensure_loaded(), which the methods accessing them call.  Until
+        then, pushed events are held in pending_pushes, so that e.g.
+        the restart event sent to every queue at startup does not
+        force every queue to be loaded."""
+        ret = cls(id)
+        ret.serialized = serialized
+        if pending_pushes is not None:
+            ret.pending_pushes = pending_pushes
+        return ret
+
+    def ensure_loaded(self) -> None:
+        if self.serialized is None:
+            return
+        serialized = self.serialized
+        self.serialized = None
+        self.restore(ujson.loads(bytes(serialized)))
+        pending_pushes = self.pending_pushes
+        self.pending_pushes = []
+        for (method, args) in pending_pushes:
+            if method == 'push':
+                self.push(*args)
+            else:
+                self.push_message(*args)
+
+    def defer_push(self, method: str, args: List[Any]) -> bool:
+        """For a queue that hasn't been loaded yet, records a push to
+        replay once it is, and returns True.  Once as many pushes are
+        pending as the queue may hold events, we load it instead, so
+        that check_size_limit and the coalescing rules bound its size."""
+        if self.serialized is None:
+            return False
+        max_events = settings.EVENT_QUEUE_MAX_EVENTS
+        if max_events is None or len(self.pending_pushes) < max_events:
+            self.pending_pushes.append((method, args))
+            return True
+        self.ensure_loaded()
+        return False
+
+    def is_loaded(self) -> bool:
+        return self.serialized is None
+
+    def serialize(self) -> Tuple[Union[bytes, memoryview], List[Tuple[str, List[Any]]]]:
+        """Returns the JSON encoding of to_dict(), as a prefix of the
+        queue's contents and the pushes to replay on top of it (see
+        lazy()).  Queues that were never loaded since they were
+        restored are returned as they were, without deserializing
+        them, even if events were pushed to them since."""
+        if self.serialized is not None:
+            return (self.serialized, self.pending_pushes)
+        return (ujson.dumps(self.to_dict()).encode('utf-8'), [])
+
     def push(self, event: Dict[str, Any]) -> None:
+        if self.defer_push('push', [event]):
+            return
+        self.check_size_limit()
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
-        if (full_event_type in ["pointer", "restart"] or
-                full_event_type.startswith("flags/")):
-            if full_event_type not in self.virtual_events:
-                self.virtual_events[full_event_type] = copy.deepcopy(event)
-                return
-            # Update the virtual event with the values from the event
-            virtual_event = self.virtual_events[full_event_type]
-            virtual_event["id"] = event["id"]
-            if "timestamp" in event:
-                virtual_event["timestamp"] = event["timestamp"]
-            if full_event_type == "pointer":
-                virtual_event["pointer"] = event["pointer"]
-            elif full_event_type == "restart":
-                virtual_event["server_generation"] = event["server_generation"]
-            elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
-        else:
-            self.queue.append(event)
+        rule = get_coalescing_rule(full_event_type)
+        if rule is None:
+            self.queue.append(QueuedEvent.from_dict(event))
+            return
+        key = rule.key(event)
+        if key is None:
+            self.seal_virtual_events(full_event_type)
+            self.queue.append(QueuedEvent.from_dict(event))
+            return
+
+        virtual_key = full_event_type if key == "" else full_event_type + "/" + key
+        if virtual_key not in self.virtual_events:
+            self.virtual_events[virtual_key] = copy.deepcopy(event)
+            return
+        # Update the virtual event with the values from the event
+        virtual_event = self.virtual_events[virtual_key]
+        virtual_event["id"] = event["id"]
+        if "timestamp" in event:
+            virtual_event["timestamp"] = event["timestamp"]
+        rule.merge(virtual_event, event)
+
+    def seal_virtual_events(self, full_event_type: str) -> None:
+        # Renames this type's pending virtual events so that nothing
+        # more is merged into them; see CoalescingRule.
+        for virtual_key in list(self.virtual_events.keys()):
+            if virtual_key == full_event_type or virtual_key.startswith(full_event_type + "/"):
+                virtual_event = self.virtual_events.pop(virtual_key)
+                self.virtual_events["sealed:%s" % (virtual_event["id"],)] = virtual_event
+
+    def push_message(self, message: Dict[str, Any], flags: Iterable[str],
+                     extra: Optional[Dict[str, Any]]=None) -> None:
+        # Fast path for push() of a message event; see QueuedEvent.
+        if self.defer_push('push_message', [message, list(flags), extra]):
+            return
+        self.check_size_limit()
+        self.queue.append(QueuedEvent(self.next_event_id, extra, message, tuple(flags)))
+        self.next_event_id += 1
+
+    def check_size_limit(self) -> None:
+        """If the queue holds EVENT_QUEUE_MAX_EVENTS events, e.g. because
+        its client stopped polling, replaces them all with a restart
+        event that makes the client reload, rather than let the queue
+        keep growing until it is garbage-collected.  Queues that haven't
+        been loaded yet are bounded by defer_push instead."""
+        max_events = settings.EVENT_QUEUE_MAX_EVENTS
+        if max_events is None or len(self.queue) < max_events:
+            return
+
+        global queue_overflow_count
+        queue_overflow_count += 1
+        statsd.incr('tornado.event_queue_overflows')
+        logging.info("Event queue %s exceeded %d events; replacing them with a restart event"
+                     % (self.id, max_events))
+
+        self.queue.clear()
+        self.virtual_events = {}
+        # The client can't have seen the discarded events, so its next
+        # last_event_id will be older than the events in the queue;
+        # like for queues restored from old versions, skip the checks
+        # for that in fetch_events until the restart event is acknowledged.
+        self.newest_pruned_id = None
+        self.push(dict(type='restart', server_generation=settings.SERVER_GENERATION,
+                       immediate=True))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> QueuedEvent:
+        self.ensure_loaded()
         return self.queue.popleft()
 
     def empty(self) -> bool:
+        self.ensure_loaded()
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.newest_pruned_id = self.queue[0]['id']
+        self.ensure_loaded()
+        while len(self.queue) != 0 and self.queue[0].id <= through_id:
+            self.newest_pruned_id = self.queue[0].id
             self.pop()
 
     def contents(self) -> List[Dict[str, Any]]:
-        contents = []  # type: List[Dict[str, Any]]
-        virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
+        self.ensure_loaded()
+        contents = []  # type: List[QueuedEvent]
+        virtual_id_map = {}  # type: Dict[int, Dict[str, Any]]
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
         virtual_ids = sorted(list(virtual_id_map.keys()))
@@ -324,24 +601,146 @@ class EventQueue:
         index = 0
         length = len(virtual_ids)
         for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
+            while index < length and virtual_ids[index] < event.id:
+                contents.append(QueuedEvent(virtual_ids[index], virtual_id_map[virtual_ids[index]]))
                 index += 1
             contents.append(event)
         while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
+            contents.append(QueuedEvent(virtual_ids[index], virtual_id_map[virtual_ids[index]]))
             index += 1
 
         self.virtual_events = {}
         self.queue = deque(contents)
-        return contents
+        return [event.to_dict() for event in contents]
+
+    def share_message_payloads(self, payloads: Dict[Tuple[Any, ...], Dict[str, Any]],
+                               variant: Tuple[Any, ...]) -> None:
+        """Deduplicates the message payloads in this queue against
+        `payloads`, for use after restoring queues from disk, where
+        each queue gets its own copy of every message.  `variant`
+        identifies the payload format the owning client receives."""
+        self.ensure_loaded()
+        for event in self.queue:
+            if event.message is None:
+                continue
+            key = (event.message['id'], event.message.get('invite_only_stream', False)) + variant
+            event.message = payloads.setdefault(key, event.message)
+
+def get_narrow_fanout_key(narrow: Iterable[Sequence[str]]) -> Optional[Tuple[str, str]]:
+    """Returns a key that every message event matching `narrow` has,
+    which RealmMessageClients uses to find the clients that might want
+    a given stream message without checking every narrowed client in
+    the realm: ("stream", name) or ("sender", email), lowercased, or
+    ("private", "") for narrows that can only match private messages.
+    Narrows that don't restrict any of those have no key."""
+    sender_key = None  # type: Optional[Tuple[str, str]]
+    private = False
+    for element in narrow:
+        (operator, operand) = (element[0], element[1])
+        if operator == "stream":
+            return ("stream", operand.lower())
+        if operator == "sender" and sender_key is None:
+            sender_key = ("sender", operand.lower())
+        if operator == "is" and operand == "private":
+            private = True
+    if sender_key is not None:
+        return sender_key
+    if private:
+        return ("private", "")
+    return None
+
+class RealmMessageClients:
+    """The clients in a realm that get messages sent to public streams
+    regardless of their subscriptions: those registered with
+    all_public_streams=True or with a narrow.  Narrowed clients are
+    indexed by get_narrow_fanout_key, so that finding the clients that
+    might want a message costs about the number of clients that
+    actually want it, rather than every such client in the realm.
+    Clients that don't want message events at all are not included.
+    """
+    def __init__(self) -> None:
+        self.unkeyed = set()  # type: Set[ClientDescriptor]
+        self.by_stream = {}  # type: Dict[str, Set[ClientDescriptor]]
+        self.by_sender = {}  # type: Dict[str, Set[ClientDescriptor]]
+        self.count = 0
+
+    def get_bucket(self, client: ClientDescriptor) -> Optional[Set[ClientDescriptor]]:
+        key = client.narrow_fanout_key
+        if key is None:
+            return self.unkeyed
+        if key[0] == "stream":
+            return self.by_stream.setdefault(key[1], set())
+        if key[0] == "sender":
+            return self.by_sender.setdefault(key[1], set())
+        # Narrows to private messages never match a stream message.
+        return None
+
+    def add(self, client: ClientDescriptor) -> None:
+        bucket = self.get_bucket(client)
+        if bucket is not None:
+            bucket.add(client)
+            self.count += 1
+
+    def remove(self, client: ClientDescriptor) -> None:
+        bucket = self.get_bucket(client)
+        if bucket is None or client not in bucket:
+            return
+        bucket.remove(client)
+        self.count -= 1
+        key = client.narrow_fanout_key
+        if len(bucket) == 0 and key is not None:
+            if key[0] == "stream":
+                del self.by_stream[key[1]]
+            else:
+                del self.by_sender[key[1]]
+
+    def get_clients(self, stream_name: str, sender_email: str) -> List[ClientDescriptor]:
+        # Clients returned here still need to be checked with
+        # accepts_message, for e.g. topic narrows.
+        result = list(self.unkeyed)
+        result.extend(self.by_stream.get(stream_name.lower(), ()))
+        result.extend(self.by_sender.get(sender_email.lower(), ()))
+        return result
+
+class TimingStats:
+    """Cumulative timings of some operation, for get_event_queue_stats;
+    a metrics scraper can derive rates and averages from the
+    differences between successive polls."""
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.last_seconds = seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(count=self.count,
+                    total_seconds=self.total_seconds,
+                    max_seconds=self.max_seconds,
+                    last_seconds=self.last_seconds)
+
+notification_timings = TimingStats()
+gc_timings = TimingStats()
+
+# number of times an event queue has hit EVENT_QUEUE_MAX_EVENTS
+queue_overflow_count = 0
 
 # maps queue ids to client descriptors
 clients = {}  # type: Dict[str, ClientDescriptor]
+# heap of (earliest time the queue could expire, queue id), with an
+# entry for every client in `clients`, plus stale ones for queues
+# already removed some other way, which GC skips.  Entries aren't
+# updated when clients connect; GC pushes them back instead.
+gc_heap = []  # type: List[Tuple[float, str]]
 # maps user id to list of client descriptors
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
-# maps realm id to list of client descriptors with all_public_streams=True
-realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps realm id to the clients with all_public_streams=True or a narrow
+realm_clients_all_streams = {}  # type: Dict[int, RealmMessageClients]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -358,6 +757,7 @@ def clear_client_event_queues_for_testing() -> None:
     user_clients.clear()
     realm_clients_all_streams.clear()
     gc_hooks.clear()
+    gc_heap.clear()
     global next_queue_id
     next_queue_id = 0
 
@@ -370,17 +770,26 @@ def get_client_descriptor(queue_id: str) -> ClientDescriptor:
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
     return user_clients.get(user_profile_id, [])
 
-def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
-    return realm_clients_all_streams.get(realm_id, [])
+def get_client_descriptors_for_public_stream_message(realm_id: int, stream_name: str,
+                                                    sender_email: str) -> List[ClientDescriptor]:
+    realm_clients = realm_clients_all_streams.get(realm_id)
+    if realm_clients is None:
+        return []
+    return realm_clients.get_clients(stream_name, sender_email)
 
 def add_to_client_dicts(client: ClientDescriptor) -> None:
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    if (client.all_public_streams or client.narrow != []) and client.accepts_messages():
+        realm_clients_all_streams.setdefault(client.realm_id, RealmMessageClients()).add(client)
+    heapq.heappush(gc_heap, (client.last_connection_time + client.queue_timeout,
+                             client.event_queue.id))
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
     queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    if user_sharding_enabled():
+        # Lets the proxy route get_events requests to the right process.
+        queue_id = str(get_user_shard_port(new_queue_data['user_profile_id'])) + ':' + queue_id
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
@@ -403,8 +812,13 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
     for user_id in affected_users:
         filter_client_dict(user_clients, user_id)
 
+    for id in to_remove:
+        realm_clients = realm_clients_all_streams.get(clients[id].realm_id)
+        if realm_clients is not None:
+            realm_clients.remove(clients[id])
     for realm_id in affected_realms:
-        filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_clients_all_streams and realm_clients_all_streams[realm_id].count == 0:
+            del realm_clients_all_streams[realm_id]
 
     for id in to_remove:
         for cb in gc_hooks:
@@ -416,41 +830,239 @@ def gc_event_queues(port: int) -> None:
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    num_popped = 0
+    while len(gc_heap) != 0 and gc_heap[0][0] <= start:
+        # We always process at least one entry, so that each pass
+        # makes progress.
+        if num_popped > 0 and time.time() - start >= EVENT_QUEUE_GC_SLICE_SECS:
+            # Leave the rest for the next ioloop iteration.
+            tornado.ioloop.IOLoop.instance().add_callback(gc_event_queues, port)
+            break
+        (expires, id) = heapq.heappop(gc_heap)
+        num_popped += 1
+        client = clients.get(id)
+        if client is None or id in to_remove:
+            continue
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+            continue
+
+        # The client has connected since this entry was pushed.
+        expires = client.last_connection_time + client.queue_timeout
+        if client.current_handler_id is not None:
+            # Connected right now, so it won't expire before the
+            # handler finishes; check again at the next GC.
+            expires = max(expires, start + EVENT_QUEUE_GC_FREQ_MSECS / 1000)
+        heapq.heappush(gc_heap, (expires, id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
+    duration = time.time() - start
+    gc_timings.record(duration)
 
     if settings.PRODUCTION:
         logging.info(('Tornado %d removed %d expired event queues owned by %d users in %.3fs.' +
                       '  Now %d active queues, %s')
-                     % (port, len(to_remove), len(affected_users), time.time() - start,
+                     % (port, len(to_remove), len(affected_users), duration,
                         len(clients), handler_stats_string()))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
-def persistent_queue_filename(port: int, last: bool=False) -> str:
+# Upper bounds of the buckets of the events-per-queue histogram.
+EVENTS_PER_QUEUE_BUCKETS = [0, 1, 10, 100, 1000, 10000]
+
+def get_event_queue_stats(include_retained_bytes: bool=False) -> Dict[str, Any]:
+    """Returns a snapshot of the state of this Tornado process's event
+    queues, for the tornado_stats endpoint.
+
+    If include_retained_bytes is set, we also report an estimate of
+    the memory used by queued events: the size of the JSON encoding of
+    the queued events, counting each message payload once however many
+    queues share it.  That means encoding every queued event, which
+    blocks this process for a while if it has a lot of them, so it
+    shouldn't be polled routinely.  Queues restored lazily and not
+    accessed since aren't deserialized for this; their serialized size
+    is reported instead."""
+    queues_by_client_type = {}  # type: Dict[str, int]
+    histogram = [0] * (len(EVENTS_PER_QUEUE_BUCKETS) + 1)
+    waiting_handlers = 0
+    unloaded_queues = 0
+    unloaded_bytes = 0
+    retained_bytes = 0
+    seen_messages = set()  # type: Set[int]
+
+    for client in clients.values():
+        queues_by_client_type[client.client_type_name] = \
+            queues_by_client_type.get(client.client_type_name, 0) + 1
+        if client.current_handler_id is not None:
+            waiting_handlers += 1
+
+        queue = client.event_queue
+        if queue.serialized is not None:
+            unloaded_queues += 1
+            unloaded_bytes += len(queue.serialized)
+            continue
+
+        num_events = len(queue.queue) + len(queue.virtual_events)
+        bucket = 0
+        while bucket < len(EVENTS_PER_QUEUE_BUCKETS) and num_events > EVENTS_PER_QUEUE_BUCKETS[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+
+        if not include_retained_bytes:
+            continue
+        for event in queue.queue:
+            if event.event is not None:
+                retained_bytes += len(ujson.dumps(event.event))
+            if event.message is not None and id(event.message) not in seen_messages:
+                seen_messages.add(id(event.message))
+                retained_bytes += len(ujson.dumps(event.message))
+        for virtual_event in queue.virtual_events.values():
+            retained_bytes += len(ujson.dumps(virtual_event))
+
+    bucket_names = [str(bound) for bound in EVENTS_PER_QUEUE_BUCKETS] + ['inf']
+    stats = dict(
+        queues=len(clients),
+        users=len(user_clients),
+        queues_by_client_type=queues_by_client_type,
+        events_per_queue=dict(zip(bucket_names, histogram)),
+        unloaded_queues=unloaded_queues,
+        unloaded_bytes=unloaded_bytes,
+        waiting_handlers=waiting_handlers,
+        pending_notifications=len(pending_notifications),
+        queue_overflows=queue_overflow_count,
+        notifications=notification_timings.to_dict(),
+        gc=gc_timings.to_dict(),
+    )  # type: Dict[str, Any]
+    if include_retained_bytes:
+        stats['retained_bytes'] = retained_bytes
+    return stats
+
+def persistent_queue_filename(port: int, last: bool=False,
+                              pattern: Optional[str]=None) -> str:
+    if pattern is None:
+        pattern = settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN
     if settings.TORNADO_PROCESSES == 1:
         # Use non-port-aware, legacy version.
         if last:
-            return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('',) + '.last'
-        return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('',)
+            return pattern % ('',) + '.last'
+        return pattern % ('',)
     if last:
-        return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port) + '.last',)
-    return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
+        return pattern % ('.' + str(port) + '.last',)
+    return pattern % ('.' + str(port),)
+
+class EventQueuePersistence(abc.ABC):
+    """Saves the event queues of a Tornado process across restarts.
+    The backend is selected by settings.TORNADO_QUEUE_PERSISTENCE."""
+    def __init__(self, port: int) -> None:
+        self.port = port
+
+    @abc.abstractmethod
+    def filename(self, last: bool=False) -> str:
+        pass
+
+    @abc.abstractmethod
+    def dump(self, clients: Mapping[str, ClientDescriptor]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def load(self) -> Dict[str, ClientDescriptor]:
+        pass
+
+class JsonEventQueuePersistence(EventQueuePersistence):
+    """The original format: one JSON file with every queue, fully
+    deserialized on startup."""
+    def filename(self, last: bool=False) -> str:
+        return persistent_queue_filename(self.port, last=last)
+
+    def dump(self, clients: Mapping[str, ClientDescriptor]) -> None:
+        with open(self.filename(), "w") as stored_queues:
+            ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
+                       stored_queues)
+
+    def load(self) -> Dict[str, ClientDescriptor]:
+        # ujson chokes on bad input pretty easily.  We separate out the actual
+        # file reading from the loading so that we don't silently fail if we get
+        # bad input.
+        with open(self.filename(), "r") as stored_queues:
+            json_data = stored_queues.read()
+        return dict((qid, ClientDescriptor.from_dict(client))
+                    for (qid, client) in ujson.loads(json_data))
+
+class SnapshotEventQueuePersistence(EventQueuePersistence):
+    """A binary snapshot file, which is memory-mapped on startup so that
+    each queue's contents are only deserialized when the queue is
+    first used (see EventQueue.lazy); the many queues that are never
+    used again before being garbage-collected are never deserialized.
+    Likewise, queues that were not used since startup are written
+    back out without being re-serialized; events pushed to them in the
+    meantime, like the restart event sent at startup, are saved
+    alongside to be replayed when the queue is loaded.
+
+    The format is SNAPSHOT_MAGIC, then the JSON-encoded EventQueue of
+    each client, then a JSON index with the rest of each client's
+    ClientDescriptor.to_dict(), where to find its EventQueue, and its
+    pending pushes, and finally the offset of that index, as an 8-byte
+    integer.
+    """
+    SNAPSHOT_MAGIC = b'ZULIPEQ1'
+    INDEX_OFFSET_FORMAT = '<Q'
+
+    def filename(self, last: bool=False) -> str:
+        return persistent_queue_filename(self.port, last=last,
+                                         pattern=settings.SNAPSHOT_PERSISTENT_QUEUE_FILENAME_PATTERN)
+
+    def dump(self, clients: Mapping[str, ClientDescriptor]) -> None:
+        # Write to a temporary file and rename it into place, since
+        # lazily restored queues may still reference the old file.
+        tmp_filename = self.filename() + '.tmp'
+        index = []  # type: List[Tuple[str, Dict[str, Any], int, int, List[Tuple[str, List[Any]]]]]
+        with open(tmp_filename, "wb") as snapshot:
+            snapshot.write(self.SNAPSHOT_MAGIC)
+            for (qid, client) in clients.items():
+                (serialized, pending_pushes) = client.event_queue.serialize()
+                index.append((qid, client.to_dict(include_event_queue=False),
+                              snapshot.tell(), len(serialized), pending_pushes))
+                snapshot.write(serialized)
+            index_offset = snapshot.tell()
+            snapshot.write(ujson.dumps(index).encode('utf-8'))
+            snapshot.write(struct.pack(self.INDEX_OFFSET_FORMAT, index_offset))
+        os.rename(tmp_filename, self.filename())
+
+    def load(self) -> Dict[str, ClientDescriptor]:
+        with open(self.filename(), "rb") as snapshot:
+            data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(self.SNAPSHOT_MAGIC)] != self.SNAPSHOT_MAGIC:
+            raise ValueError("Not an event queue snapshot")
+        offset_size = struct.calcsize(self.INDEX_OFFSET_FORMAT)
+        (index_offset,) = struct.unpack(self.INDEX_OFFSET_FORMAT, data[-offset_size:])
+        index = ujson.loads(data[index_offset:-offset_size])
+
+        view = memoryview(data)
+        clients = {}  # type: Dict[str, ClientDescriptor]
+        for (qid, client_dict, offset, length, pending_pushes) in index:
+            client_dict['event_queue'] = EventQueue(qid).to_dict()
+            client = ClientDescriptor.from_dict(client_dict)
+            client.event_queue = EventQueue.lazy(qid, view[offset:offset + length],
+                                                 [(method, args) for (method, args) in pending_pushes])
+            clients[qid] = client
+        return clients
+
+def get_event_queue_persistence(port: int) -> EventQueuePersistence:
+    if settings.TORNADO_QUEUE_PERSISTENCE == 'snapshot':
+        return SnapshotEventQueuePersistence(port)
+    return JsonEventQueuePersistence(port)
 
 def dump_event_queues(port: int) -> None:
     start = time.time()
+    # Don't lose notifications that were received but not yet processed.
+    process_pending_notifications()
 
-    with open(persistent_queue_filename(port), "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    get_event_queue_persistence(port).dump(clients)
 
     logging.info('Tornado %d dumped %d event queues in %.3fs'
                  % (port, len(clients), time.time() - start))
@@ -458,28 +1070,41 @@ def dump_event_queues(port: int) -> None:
 def load_event_queues(port: int) -> None:
     global clients
     start = time.time()
+    persistence = get_event_queue_persistence(port)
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
+    dumped_at = None  # type: Optional[float]
     try:
-        with open(persistent_queue_filename(port), "r") as stored_queues:
-            json_data = stored_queues.read()
+        dumped_at = os.path.getmtime(persistence.filename())
         try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+            clients = persistence.load()
         except Exception:
             logging.exception("Tornado %d could not deserialize event queues" % (port,))
     except (IOError, EOFError):
         pass
 
+    # Restored queues each have their own copy of every queued message
+    # payload; share them again, as process_message_event does.
+    # Lazily restored queues are skipped, since sharing would require
+    # loading them.
+    message_payloads = {}  # type: Dict[Tuple[Any, ...], Dict[str, Any]]
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
 
+        if client.event_queue.is_loaded():
+            client.event_queue.share_message_payloads(
+                message_payloads, (client.apply_markdown, client.client_gravatar))
         add_to_client_dicts(client)
 
+    end = time.time()
     logging.info('Tornado %d loaded %d event queues in %.3fs'
-                 % (port, len(clients), time.time() - start))
+                 % (port, len(clients), end - start))
+    statsd.timing('tornado.load_event_queues', int(1000 * (end - start)))
+    if dumped_at is not None:
+        # The time from the previous process saving its queues to
+        # this one being ready to serve them, i.e. how long clients
+        # were unable to get events.
+        logging.info('Tornado %d restart downtime was %.3fs' % (port, end - dumped_at))
+        statsd.timing('tornado.restart_downtime', int(1000 * (end - dumped_at)))
 
 def send_restart_events(immediate: bool=False) -> None:
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
@@ -497,8 +1122,9 @@ def setup_event_queue(port: int) -> None:
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         add_reload_hook(lambda: dump_event_queues(port))
 
+    persistence = get_event_queue_persistence(port)
     try:
-        os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
+        os.rename(persistence.filename(), persistence.filename(last=True))
     except OSError:
         pass
 
@@ -538,6 +1164,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 raise BadEventQueueIdError(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
+            client.event_queue.ensure_loaded()
             if (
                 client.event_queue.newest_pruned_id is not None
                 and last_event_id < client.event_queue.newest_pruned_id
@@ -584,7 +1211,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
                         all_public_streams: bool=False,
                         narrow: Iterable[Sequence[str]]=[]) -> Optional[str]:
     if settings.TORNADO_SERVER:
-        tornado_uri = get_tornado_uri(user_profile.realm)
+        tornado_uri = get_tornado_uri_for_user(user_profile)
         req = {'dont_block': 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'client_gravatar': ujson.dumps(client_gravatar),
@@ -617,7 +1244,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
 
 def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int) -> List[Dict[str, Any]]:
     if settings.TORNADO_SERVER:
-        tornado_uri = get_tornado_uri(user_profile.realm)
+        tornado_uri = get_tornado_uri_for_user(user_profile)
         post_data = {
             'queue_id': queue_id,
             'last_event_id': last_event_id,
@@ -756,7 +1383,7 @@ def maybe_enqueue_notifications(user_profile_id: int, message_id: int, private_m
 
 ClientInfo = TypedDict('ClientInfo', {
     'client': ClientDescriptor,
-    'flags': Optional[Iterable[str]],
+    'flags': Tuple[str, ...],
     'is_sender': bool,
 })
 
@@ -781,16 +1408,19 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
     # bots) that are registered to get events for ALL streams.
     if 'stream_name' in event_template and not event_template.get("invite_only"):
         realm_id = event_template['realm_id']
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        sender_email = event_template['message_dict']['sender_email']
+        for client in get_client_descriptors_for_public_stream_message(
+                realm_id, event_template['stream_name'], sender_email):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
-                flags=[],
+                flags=(),
                 is_sender=is_sender_client(client)
             )
 
     for user_data in users:
         user_profile_id = user_data['id']  # type: int
-        flags = user_data.get('flags', [])  # type: Iterable[str]
+        # A tuple, so that every queue for this user can share it.
+        flags = tuple(user_data.get('flags', []))  # type: Tuple[str, ...]
 
         for client in get_client_descriptors_for_user(user_profile_id):
             send_to_clients[client.event_queue.id] = dict(
@@ -854,10 +1484,10 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
         client = client_data['client']
         flags = client_data['flags']
         is_sender = client_data.get('is_sender', False)  # type: bool
-        extra_data = extra_user_data.get(client.user_profile_id, None)  # type: Optional[Mapping[str, bool]]
+        extra_data = extra_user_data.get(client.user_profile_id, None)  # type: Optional[Dict[str, Any]]
 
         if not client.accepts_messages():
-            # The actual check is the accepts_event() check below;
+            # The actual check is the accepts_message() check below;
             # this line is just an optimization to avoid copying
             # message data unnecessarily
             continue
@@ -869,16 +1499,7 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             message_dict = message_dict.copy()
             message_dict["invite_only_stream"] = True
 
-        user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
-        if extra_data is not None:
-            user_event.update(extra_data)
-
-        if is_sender:
-            local_message_id = event_template.get('local_id', None)
-            if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
-
-        if not client.accepts_event(user_event):
+        if not client.accepts_message(message_dict, flags):
             continue
 
         # The below prevents (Zephyr) mirroring loops.
@@ -886,9 +1507,15 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
                 sending_client.lower() == client.client_type_name.lower()):
             continue
 
-        # We don't need to create a new dict here, since the
-        # `user_event` was already constructed from scratch above.
-        client.add_event(user_event)
+        # The queue keeps references to message_dict and extra_data
+        # rather than a per-client copy of the event; only the sender
+        # needs its own copy, for local_message_id.
+        if is_sender:
+            local_message_id = event_template.get('local_id', None)
+            if local_message_id is not None:
+                extra_data = dict(extra_data or {}, local_message_id=local_message_id)
+
+        client.add_message_event(message_dict, flags, extra_data)
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
@@ -1013,17 +1640,85 @@ def process_notification(notice: Mapping[str, Any]) -> None:
         process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
     else:
         process_event(event, cast(Iterable[int], users))
+    duration = time.time() - start_time
+    notification_timings.record(duration)
     logging.debug("Tornado: Event %s for %s users took %sms" % (
-        event['type'], len(users), int(1000 * (time.time() - start_time))))
+        event['type'], len(users), int(1000 * duration)))
+
+# Notifications from the notify_tornado queue are processed in
+# batches of up to NOTIFICATION_BATCH_SIZE per ioloop iteration, so
+# that a burst of events (e.g. a bulk subscription change) finishes
+# each waiting get_events handler once, rather than once per event.
+NOTIFICATION_BATCH_SIZE = 100
+pending_notifications = deque()  # type: Deque[Mapping[str, Any]]
+# The clients whose handlers to finish at the end of the current
+# batch; None when not processing a batch.
+clients_to_finish = None  # type: Optional[Set[ClientDescriptor]]
+
+def queue_notification(notice: Mapping[str, Any]) -> None:
+    """Consumer for the notify_tornado queue."""
+    if len(pending_notifications) == 0:
+        tornado.ioloop.IOLoop.instance().add_callback(process_notification_batch)
+    pending_notifications.append(notice)
+
+def process_notification_batch() -> None:
+    batch = []  # type: List[Mapping[str, Any]]
+    while len(pending_notifications) != 0 and len(batch) < NOTIFICATION_BATCH_SIZE:
+        batch.append(pending_notifications.popleft())
+    if len(pending_notifications) != 0:
+        tornado.ioloop.IOLoop.instance().add_callback(process_notification_batch)
+    process_notifications(batch)
+
+def process_pending_notifications() -> None:
+    batch = list(pending_notifications)
+    pending_notifications.clear()
+    process_notifications(batch)
+
+def merge_notifications(notices: Iterable[Mapping[str, Any]]) -> List[Mapping[str, Any]]:
+    """Combines consecutive notifications where doing so can't change
+    what clients see; currently, runs of update_message_flags events
+    for the same users, flag and operation (e.g. from a client marking
+    messages as read one batch at a time), which EventQueue.push would
+    collapse anyway."""
+    merged = []  # type: List[Mapping[str, Any]]
+    for notice in notices:
+        event = notice['event']
+        if merged and event['type'] == 'update_message_flags' and not event['all']:
+            previous = merged[-1]['event']
+            if (previous['type'] == 'update_message_flags' and not previous['all'] and
+                    previous['flag'] == event['flag'] and
+                    previous['operation'] == event['operation'] and
+                    merged[-1]['users'] == notice['users']):
+                merged[-1] = dict(users=notice['users'], event=dict(
+                    previous, messages=previous['messages'] + event['messages']))
+                continue
+        merged.append(notice)
+    return merged
+
+def process_notifications(notices: Iterable[Mapping[str, Any]]) -> None:
+    global clients_to_finish
+    clients_to_finish = set()
+    try:
+        for notice in merge_notifications(notices):
+            try:
+                process_notification(notice)
+            except Exception:
+                logging.exception("Error processing notification for event %s" % (
+                    notice['event']['type'],))
+    finally:
+        to_finish = clients_to_finish
+        clients_to_finish = None
+        for client in to_finish:
+            client.finish_current_handler()
 
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        tornado_uri = get_tornado_uri(realm)
+        tornado_uri = get_tornado_uri_for_port(port)
         requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
@@ -1035,7 +1730,12 @@ def send_event(realm: Realm, event: Mapping[str, Any],
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    port = get_tornado_port(realm)
-    queue_json_publish(notify_tornado_queue_name(port),
-                       dict(event=event, users=users),
-                       lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
+    if user_sharding_enabled():
+        users_by_port = shard_event_users(event, users)
+    else:
+        users_by_port = {get_tornado_port(realm): list(users)}
+
+    for (port, port_users) in users_by_port.items():
+        queue_json_publish(notify_tornado_queue_name(port),
+                           dict(event=event, users=port_users),
+                           functools.partial(send_notification_http, port))
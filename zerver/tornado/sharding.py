@@ -1,6 +1,12 @@
+from typing import Any, Dict, Iterable, List, Mapping, Union
+
 from django.conf import settings
 
-from zerver.models import Realm
+from zerver.models import Realm, UserProfile
+
+# With multiple Tornado processes, they listen on consecutive ports
+# starting here; see puppet/zulip/manifests/app_frontend_base.pp.
+TORNADO_SHARD_BASE_PORT = 9800
 
 def get_tornado_port(realm: Realm) -> int:
     if settings.TORNADO_SERVER is None:
@@ -9,13 +15,52 @@ def get_tornado_port(realm: Realm) -> int:
         return int(settings.TORNADO_SERVER.split(":")[-1])
     return 9993
 
-def get_tornado_uri(realm: Realm) -> str:
+def user_sharding_enabled() -> bool:
+    """Whether the users of a realm are spread across all the Tornado
+    processes (TORNADO_SHARDING = 'user'), rather than every realm
+    being handled by a single one."""
+    return settings.TORNADO_PROCESSES > 1 and settings.TORNADO_SHARDING == 'user'
+
+def get_user_shard_port(user_profile_id: int) -> int:
+    return TORNADO_SHARD_BASE_PORT + user_profile_id % settings.TORNADO_PROCESSES
+
+def get_all_tornado_ports() -> List[int]:
+    return [TORNADO_SHARD_BASE_PORT + shard for shard in range(settings.TORNADO_PROCESSES)]
+
+def get_tornado_port_for_user(user_profile: UserProfile) -> int:
+    if user_sharding_enabled():
+        return get_user_shard_port(user_profile.id)
+    return get_tornado_port(user_profile.realm)
+
+def get_tornado_uri_for_port(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return settings.TORNADO_SERVER
 
-    port = get_tornado_port(realm)
     return "http://127.0.0.1:%d" % (port,)
 
+def get_tornado_uri_for_user(user_profile: UserProfile) -> str:
+    return get_tornado_uri_for_port(get_tornado_port_for_user(user_profile))
+
+def shard_event_users(event: Mapping[str, Any],
+                      users: Union[Iterable[int], Iterable[Mapping[str, Any]]]
+                      ) -> Dict[int, List[Any]]:
+    """For user sharding, splits the `users` of a send_event call by the
+    port of the Tornado process holding their event queues.
+
+    Messages to public streams go to every process, even those with
+    none of the recipients, since any process may have clients
+    registered with all_public_streams=True or a narrow for the realm
+    (see get_client_info_for_message_event)."""
+    users_by_port = {}  # type: Dict[int, List[Any]]
+    if (event['type'] == 'message' and 'stream_name' in event and
+            not event.get('invite_only')):
+        for port in get_all_tornado_ports():
+            users_by_port[port] = []
+    for user in users:
+        user_profile_id = user if isinstance(user, int) else user['id']
+        users_by_port.setdefault(get_user_shard_port(user_profile_id), []).append(user)
+    return users_by_port
+
 def notify_tornado_queue_name(port: int) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return "notify_tornado"
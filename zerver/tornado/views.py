@@ -13,7 +13,7 @@ from zerver.lib.response import json_error, json_success
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
 from zerver.tornado.event_queue import fetch_events, \
-    get_client_descriptor, process_notification
+    get_client_descriptor, get_event_queue_stats, process_notification
 from zerver.tornado.exceptions import BadEventQueueIdError
 
 @internal_notify_view(True)
@@ -21,6 +21,13 @@ def notify(request: HttpRequest) -> HttpResponse:
     process_notification(ujson.loads(request.POST['data']))
     return json_success()
 
+@internal_notify_view(True)
+@has_request_variables
+def get_tornado_stats(request: HttpRequest,
+                      include_retained_bytes: bool=REQ(default=False,
+                                                       validator=check_bool)) -> HttpResponse:
+    return json_success(get_event_queue_stats(include_retained_bytes))
+
 @has_request_variables
 def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: str=REQ()) -> HttpResponse:
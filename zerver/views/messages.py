@@ -4,8 +4,8 @@ from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db import connection, IntegrityError
-from django.http import HttpRequest, HttpResponse
-from typing import Dict, List, Set, Any, Iterable, \
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from typing import Dict, List, Set, Any, Iterable, Iterator, \
     Optional, Tuple, Union, Sequence, cast
 from zerver.lib.exceptions import JsonableError, ErrorCode
 from zerver.lib.html_diff import highlight_html_differences
@@ -21,6 +21,8 @@ from zerver.lib.actions import recipient_for_user_profiles, do_update_message_fl
     do_mark_all_as_read, do_mark_stream_messages_as_read, \
     get_user_info_for_message_updates, check_schedule_message
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
+from zerver.lib.cache import cache_get, cache_set, get_search_results_version, \
+    search_results_cache_key
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.message import (
     access_message,
@@ -44,7 +46,7 @@ from zerver.lib.topic import (
     REQ_topic,
 )
 from zerver.lib.topic_mutes import exclude_topic_mutes
-from zerver.lib.utils import statsd
+from zerver.lib.utils import statsd, make_safe_digest
 from zerver.lib.validator import \
     check_list, check_int, check_dict, check_string, check_bool, \
     check_string_or_int_list, check_string_or_int
@@ -59,12 +61,27 @@ from sqlalchemy.sql import select, join, column, literal_column, literal, and_,
     or_, not_, union_all, alias, Selectable, ColumnElement, table
 
 from dateutil.parser import parse as dateparser
+import bisect
 import re
+import time
 import ujson
 import datetime
 
 LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
 MAX_MESSAGES_PER_FETCH = 5000
+# The most messages GET /messages/batches returns in one request; this
+# needs to stay well within the uwsgi request timeout.
+MAX_MESSAGES_PER_BATCHED_FETCH = 20000
+DEFAULT_MESSAGE_BATCH_SIZE = 1000
+
+# We cache the IDs of the messages matching searches that users repeat
+# or page through (see get_search_message_ids), as long as the search
+# doesn't depend on message flags or muting and doesn't match more than
+# MAX_CACHED_SEARCH_RESULTS messages.
+SEARCH_RESULTS_CACHE_OPERATORS = {'search', 'stream', 'topic', 'sender',
+                                  'pm-with', 'group-pm-with', 'has'}
+MAX_CACHED_SEARCH_RESULTS = 10000
+SEARCH_RESULTS_SETTLE_SECONDS = 60
 
 class BadNarrowOperator(JsonableError):
     code = ErrorCode.BAD_NARROW
@@ -739,31 +756,12 @@ def find_first_unread_anchor(sa_conn: Any,
 
     return anchor
 
-@has_request_variables
-def zcommand_backend(request: HttpRequest, user_profile: UserProfile,
-                     command: str=REQ('command')) -> HttpResponse:
-    return json_success(process_zcommands(command, user_profile))
-
-@has_request_variables
-def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
-                         anchor: Optional[int]=REQ(converter=int, default=None),
-                         num_before: int=REQ(converter=to_non_negative_int),
-                         num_after: int=REQ(converter=to_non_negative_int),
-                         narrow: OptionalNarrowListT=REQ('narrow', converter=narrow_parameter, default=None),
-                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
-                         client_gravatar: bool=REQ(validator=check_bool, default=False),
-                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
-    if anchor is None and not use_first_unread_anchor:
-        return json_error(_("Missing 'anchor' argument (or set 'use_first_unread_anchor'=True)."))
-    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
-        return json_error(_("Too many messages requested (maximum %s).")
-                          % (MAX_MESSAGES_PER_FETCH,))
-
-    if user_profile.realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS:
-        # If email addresses are only available to administrators,
-        # clients cannot compute gravatars, so we force-set it to false.
-        client_gravatar = False
-
+def get_query_for_narrow(user_profile: UserProfile,
+                         narrow: OptionalNarrowListT) -> Tuple[Query, ColumnElement, bool, bool]:
+    """Returns a query for the messages matching `narrow` that user_profile
+    can access (not yet limited to a range of message IDs), along with
+    its message ID column, whether it includes historical messages the
+    user has no UserMessage row for, and whether it is a search."""
     include_history = ok_to_include_history(narrow, user_profile)
     if include_history:
         # The initial query in this case doesn't use `zerver_usermessage`,
@@ -796,65 +794,17 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         narrow=narrow,
     )
 
-    if narrow is not None:
-        # Add some metadata to our logging data for narrows
-        verbose_operators = []
-        for term in narrow:
-            if term['operator'] == "is":
-                verbose_operators.append("is:" + term['operand'])
-            else:
-                verbose_operators.append(term['operator'])
-        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
+    return (query, inner_msg_id_col, include_history, is_search)
 
-    sa_conn = get_sqlalchemy_connection()
-
-    if use_first_unread_anchor:
-        anchor = find_first_unread_anchor(
-            sa_conn,
-            user_profile,
-            narrow,
-        )
-
-    # Hint to mypy that anchor is now unconditionally an integer,
-    # since its inference engine can't figure that out.
-    assert anchor is not None
-    anchored_to_left = (anchor == 0)
-
-    # Set value that will be used to short circuit the after_query
-    # altogether and avoid needless conditions in the before_query.
-    anchored_to_right = (anchor == LARGER_THAN_MAX_MESSAGE_ID)
-    if anchored_to_right:
-        num_after = 0
-
-    first_visible_message_id = get_first_visible_message_id(user_profile.realm)
-    query = limit_query_to_range(
-        query=query,
-        num_before=num_before,
-        num_after=num_after,
-        anchor=anchor,
-        anchored_to_left=anchored_to_left,
-        anchored_to_right=anchored_to_right,
-        id_col=inner_msg_id_col,
-        first_visible_message_id=first_visible_message_id,
-    )
-
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_messages */")
-    rows = list(sa_conn.execute(query).fetchall())
-
-    query_info = post_process_limited_query(
-        rows=rows,
-        num_before=num_before,
-        num_after=num_after,
-        anchor=anchor,
-        anchored_to_left=anchored_to_left,
-        anchored_to_right=anchored_to_right,
-        first_visible_message_id=first_visible_message_id,
-    )
-
-    rows = query_info['rows']
+def messages_for_rows(rows: List[Any],
+                      user_profile: UserProfile,
+                      include_history: bool,
+                      is_search: bool,
+                      narrow: OptionalNarrowListT,
+                      apply_markdown: bool,
+                      client_gravatar: bool) -> List[Dict[str, Any]]:
+    """Hydrates the rows fetched by a query from get_query_for_narrow
+    into the message dicts we return to clients."""
 
     # The following is a little messy, but ensures that the code paths
     # are similar regardless of the value of include_history.  The
@@ -898,7 +848,7 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
                 # debugged the case that makes it happen.
                 raise Exception(str(err), message_id, narrow)
 
-    message_list = messages_for_ids(
+    return messages_for_ids(
         message_ids=message_ids,
         user_message_flags=user_message_flags,
         search_fields=search_fields,
@@ -907,6 +857,132 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         allow_edit_history=user_profile.realm.allow_edit_history,
     )
 
+@has_request_variables
+def zcommand_backend(request: HttpRequest, user_profile: UserProfile,
+                     command: str=REQ('command')) -> HttpResponse:
+    return json_success(process_zcommands(command, user_profile))
+
+@has_request_variables
+def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
+                         anchor: Optional[int]=REQ(converter=int, default=None),
+                         num_before: int=REQ(converter=to_non_negative_int),
+                         num_after: int=REQ(converter=to_non_negative_int),
+                         narrow: OptionalNarrowListT=REQ('narrow', converter=narrow_parameter, default=None),
+                         use_first_unread_anchor: bool=REQ(validator=check_bool, default=False),
+                         client_gravatar: bool=REQ(validator=check_bool, default=False),
+                         apply_markdown: bool=REQ(validator=check_bool, default=True)) -> HttpResponse:
+    if anchor is None and not use_first_unread_anchor:
+        return json_error(_("Missing 'anchor' argument (or set 'use_first_unread_anchor'=True)."))
+    if num_before + num_after > MAX_MESSAGES_PER_FETCH:
+        return json_error(_("Too many messages requested (maximum %s).")
+                          % (MAX_MESSAGES_PER_FETCH,))
+
+    if user_profile.realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS:
+        # If email addresses are only available to administrators,
+        # clients cannot compute gravatars, so we force-set it to false.
+        client_gravatar = False
+
+    query, inner_msg_id_col, include_history, is_search = get_query_for_narrow(
+        user_profile, narrow)
+
+    if narrow is not None:
+        # Add some metadata to our logging data for narrows
+        verbose_operators = []
+        for term in narrow:
+            if term['operator'] == "is":
+                verbose_operators.append("is:" + term['operand'])
+            else:
+                verbose_operators.append(term['operator'])
+        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
+
+    sa_conn = get_sqlalchemy_connection()
+
+    if use_first_unread_anchor:
+        anchor = find_first_unread_anchor(
+            sa_conn,
+            user_profile,
+            narrow,
+        )
+
+    # Hint to mypy that anchor is now unconditionally an integer,
+    # since its inference engine can't figure that out.
+    assert anchor is not None
+    anchored_to_left = (anchor == 0)
+
+    # Set value that will be used to short circuit the after_query
+    # altogether and avoid needless conditions in the before_query.
+    anchored_to_right = (anchor == LARGER_THAN_MAX_MESSAGE_ID)
+    if anchored_to_right:
+        num_after = 0
+
+    first_visible_message_id = get_first_visible_message_id(user_profile.realm)
+
+    search_message_ids = None  # type: Optional[List[int]]
+    message_ids = None  # type: Optional[List[int]]
+    if is_search:
+        search_message_ids = get_search_message_ids(
+            sa_conn=sa_conn,
+            user_profile=user_profile,
+            narrow=narrow,
+            query=query,
+            id_col=inner_msg_id_col,
+            include_history=include_history,
+        )
+
+    if search_message_ids is not None:
+        # We only need to run the (expensive) search query, with
+        # highlighting, on the messages we're going to return.
+        message_ids = limit_message_ids_to_range(
+            message_ids=search_message_ids,
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            first_visible_message_id=first_visible_message_id,
+        )
+        query = query.where(inner_msg_id_col.in_(message_ids))
+    else:
+        query = limit_query_to_range(
+            query=query,
+            num_before=num_before,
+            num_after=num_after,
+            anchor=anchor,
+            anchored_to_left=anchored_to_left,
+            anchored_to_right=anchored_to_right,
+            id_col=inner_msg_id_col,
+            first_visible_message_id=first_visible_message_id,
+        )
+
+    if message_ids == []:
+        rows = []  # type: List[Any]
+    else:
+        main_query = alias(query)
+        query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_messages */")
+        rows = list(sa_conn.execute(query).fetchall())
+
+    query_info = post_process_limited_query(
+        rows=rows,
+        num_before=num_before,
+        num_after=num_after,
+        anchor=anchor,
+        anchored_to_left=anchored_to_left,
+        anchored_to_right=anchored_to_right,
+        first_visible_message_id=first_visible_message_id,
+    )
+
+    message_list = messages_for_rows(
+        rows=query_info['rows'],
+        user_profile=user_profile,
+        include_history=include_history,
+        is_search=is_search,
+        narrow=narrow,
+        apply_markdown=apply_markdown,
+        client_gravatar=client_gravatar,
+    )
+
     statsd.incr('loaded_old_messages', len(message_list))
 
     ret = dict(
@@ -1065,6 +1141,218 @@ def post_process_limited_query(rows: List[Any],
         history_limited=history_limited,
     )
 
+def limit_message_ids_to_range(message_ids: List[int],
+                               num_before: int,
+                               num_after: int,
+                               anchor: int,
+                               anchored_to_left: bool,
+                               anchored_to_right: bool,
+                               first_visible_message_id: int) -> List[int]:
+    """Returns the IDs, from the sorted list message_ids, that
+    limit_query_to_range would have selected, so that
+    post_process_limited_query can handle them the same way."""
+    need_before_query = (not anchored_to_left) and (num_before > 0)
+    need_after_query = (not anchored_to_right) and (num_after > 0)
+
+    if not need_before_query and not need_after_query:
+        index = bisect.bisect_left(message_ids, anchor)
+        if index < len(message_ids) and message_ids[index] == anchor:
+            return [anchor]
+        return []
+
+    before_ids = []  # type: List[int]
+    if need_before_query:
+        if need_after_query:
+            before_anchor = anchor - 1
+            before_limit = num_before
+        else:
+            before_anchor = anchor
+            before_limit = num_before
+            if not anchored_to_right:
+                before_limit += 1
+        if anchored_to_right:
+            end = len(message_ids)
+        else:
+            end = bisect.bisect_right(message_ids, before_anchor)
+        before_ids = message_ids[max(0, end - before_limit):end]
+
+    after_ids = []  # type: List[int]
+    if need_after_query:
+        if anchored_to_left:
+            start = 0
+        else:
+            start = bisect.bisect_left(message_ids, max(anchor, first_visible_message_id))
+        after_ids = message_ids[start:start + num_after + 1]
+
+    return before_ids + after_ids
+
+def get_search_message_ids(sa_conn: Any,
+                           user_profile: UserProfile,
+                           narrow: OptionalNarrowListT,
+                           query: Query,
+                           id_col: ColumnElement,
+                           include_history: bool) -> Optional[List[int]]:
+    """Returns the IDs of all the messages matching a search narrow, in
+    increasing order, or None if we shouldn't serve this search from
+    the cache.
+
+    Since the first page of most searches is also the last one, we
+    only start caching a search the second time the user runs it.
+    After that, we only query for matching messages newer than the
+    cached max_message_id, like get_unread_conversations does (and
+    with the same concern about uncommitted messages with lower IDs,
+    hence SEARCH_RESULTS_SETTLE_SECONDS).
+
+    Code that changes which messages match a cached search (editing,
+    deleting or archiving messages, adding historical UserMessage
+    rows, renaming streams) needs to call flush_realm_search_results
+    or flush_user_search_results.
+    """
+    assert narrow is not None
+    if any(term['operator'] not in SEARCH_RESULTS_CACHE_OPERATORS for term in narrow):
+        return None
+
+    normalized_narrow = [
+        (term['operator'], term['operand'], term.get('negated', False))
+        for term in narrow
+    ]
+    key = search_results_cache_key(
+        user_profile.id,
+        get_search_results_version(user_profile.realm_id, user_profile.id),
+        make_safe_digest(ujson.dumps([include_history, normalized_narrow])),
+    )
+    cached = cache_get(key)
+    if cached is None:
+        cache_set(key, None, timeout=3600)
+        return None
+    if cached[0] is None:
+        results = dict(
+            message_ids=[],
+            max_message_id=0,
+            pending_message_id=None,
+            pending_time=0,
+        )  # type: Dict[str, Any]
+        changed = True
+    elif cached[0]['message_ids'] is None:
+        return None
+    else:
+        results = cached[0]
+        changed = False
+
+    id_query = query.with_only_columns([id_col]).where(
+        id_col > results['max_message_id'],
+    ).order_by(id_col.desc()).limit(MAX_CACHED_SEARCH_RESULTS + 1)
+    id_query = id_query.prefix_with("/* get_search_message_ids */")
+    new_message_ids = sorted(row[0] for row in sa_conn.execute(id_query).fetchall())
+
+    if len(results['message_ids']) + len(new_message_ids) > MAX_CACHED_SEARCH_RESULTS:
+        cache_set(key, dict(message_ids=None), timeout=3600)
+        return None
+
+    now = time.time()
+    if (results['pending_message_id'] is not None and
+            now - results['pending_time'] >= SEARCH_RESULTS_SETTLE_SECONDS):
+        results['max_message_id'] = results['pending_message_id']
+        results['pending_message_id'] = None
+        changed = True
+
+    settled_message_ids = [message_id for message_id in new_message_ids
+                           if message_id <= results['max_message_id']]
+    unsettled_message_ids = new_message_ids[len(settled_message_ids):]
+    if settled_message_ids:
+        results['message_ids'] += settled_message_ids
+        changed = True
+    if unsettled_message_ids and results['pending_message_id'] is None:
+        results['pending_message_id'] = unsettled_message_ids[-1]
+        results['pending_time'] = now
+        changed = True
+
+    if changed:
+        cache_set(key, results, timeout=3600*24)
+    return results['message_ids'] + unsettled_message_ids
+
+@has_request_variables
+def get_message_batches_backend(request: HttpRequest, user_profile: UserProfile,
+                                anchor: int=REQ(converter=to_non_negative_int, default=0),
+                                num_after: int=REQ(converter=to_non_negative_int,
+                                                   default=MAX_MESSAGES_PER_BATCHED_FETCH),
+                                batch_size: int=REQ(converter=to_non_negative_int,
+                                                    default=DEFAULT_MESSAGE_BATCH_SIZE),
+                                narrow: OptionalNarrowListT=REQ('narrow', converter=narrow_parameter,
+                                                                default=None),
+                                client_gravatar: bool=REQ(validator=check_bool, default=False),
+                                apply_markdown: bool=REQ(validator=check_bool, default=True)
+                                ) -> HttpResponse:
+    """Streams up to `num_after` messages matching `narrow`, starting
+    with the oldest one with ID >= `anchor`, for clients (like archival
+    bots) that walk through a large part of a realm's history.
+
+    The response is newline-delimited JSON: a `{"messages": [...]}`
+    line for each batch of up to `batch_size` messages, followed by a
+    final line with `result`, `found_newest`, and the `anchor` to pass
+    to continue from where this request stopped.  A response without
+    that final line was interrupted by an error.
+
+    Each batch is fetched with a keyset query (`id >= anchor ORDER BY
+    id LIMIT batch_size`), which walks the message ID index, rather
+    than the two-sided range queries get_messages_backend builds
+    around an anchor.
+    """
+    if num_after > MAX_MESSAGES_PER_BATCHED_FETCH:
+        return json_error(_("Too many messages requested (maximum %s).")
+                          % (MAX_MESSAGES_PER_BATCHED_FETCH,))
+    if batch_size == 0 or batch_size > MAX_MESSAGES_PER_FETCH:
+        return json_error(_("Invalid batch_size (maximum %s).") % (MAX_MESSAGES_PER_FETCH,))
+
+    if user_profile.realm.email_address_visibility == Realm.EMAIL_ADDRESS_VISIBILITY_ADMINS:
+        # See the comment in get_messages_backend.
+        client_gravatar = False
+
+    # We build the query (which validates the narrow) before starting
+    # the response, so that errors can still be returned as JSON.
+    query, inner_msg_id_col, include_history, is_search = get_query_for_narrow(
+        user_profile, narrow)
+    query = query.order_by(inner_msg_id_col.asc())
+    first_visible_message_id = get_first_visible_message_id(user_profile.realm)
+    sa_conn = get_sqlalchemy_connection()
+
+    def generate_batches() -> Iterator[str]:
+        next_anchor = max(anchor, first_visible_message_id)
+        num_remaining = num_after
+        found_newest = False
+        while num_remaining > 0:
+            limit = min(batch_size, num_remaining)
+            batch_query = query.where(inner_msg_id_col >= next_anchor).limit(limit)
+            # This is a hack to tag the query we use for testing
+            batch_query = batch_query.prefix_with("/* get_message_batches */")
+            rows = list(sa_conn.execute(batch_query).fetchall())
+            if rows:
+                message_list = messages_for_rows(
+                    rows=rows,
+                    user_profile=user_profile,
+                    include_history=include_history,
+                    is_search=is_search,
+                    narrow=narrow,
+                    apply_markdown=apply_markdown,
+                    client_gravatar=client_gravatar,
+                )
+                statsd.incr('loaded_old_messages', len(message_list))
+                yield ujson.dumps(dict(messages=message_list)) + "\n"
+                next_anchor = rows[-1][0] + 1
+                num_remaining -= len(rows)
+            if len(rows) < limit:
+                found_newest = True
+                break
+
+        yield ujson.dumps(dict(
+            result='success',
+            msg='',
+            found_newest=found_newest,
+            anchor=next_anchor,
+        )) + "\n"
+
+    return StreamingHttpResponse(generate_batches(), content_type='application/x-ndjson')
+
 @has_request_variables
 def update_message_flags(request: HttpRequest, user_profile: UserProfile,
                          messages: List[int]=REQ(validator=check_list(check_int)),
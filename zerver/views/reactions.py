@@ -5,6 +5,7 @@ from zerver.decorator import \
     has_request_variables, REQ
 from zerver.lib.actions import do_add_reaction, do_add_reaction_legacy, \
     do_remove_reaction, do_remove_reaction_legacy
+from zerver.lib.cache import flush_user_search_results
 from zerver.lib.emoji import check_emoji_request, check_valid_emoji, \
     emoji_name_to_emoji_code
 from zerver.lib.message import access_message
@@ -23,6 +24,7 @@ def create_historical_message(user_profile: UserProfile, message: Message) -> No
     UserMessage.objects.create(user_profile=user_profile,
                                message=message,
                                flags=UserMessage.flags.historical | UserMessage.flags.read)
+    flush_user_search_results([user_profile.id])
 
 @has_request_variables
 def add_reaction(request: HttpRequest, user_profile: UserProfile, message_id: int,
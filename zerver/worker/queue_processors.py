@@ -29,7 +29,8 @@ from zerver.lib.push_notifications import handle_push_notification, handle_remov
 from zerver.lib.actions import do_send_confirmation_email, \
     do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
     internal_send_message, internal_send_private_message, notify_realm_export, \
-    render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
+    render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read, \
+    do_send_queued_message_events
 from zerver.lib.url_preview import preview as url_preview
 from zerver.lib.digest import handle_digest_email
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
@@ -372,6 +373,11 @@ class PushNotificationsWorker(QueueProcessingWorker):  # nocoverage
         else:
             handle_push_notification(data['user_profile_id'], data)
 
+@assign_queue('message_fanout')
+class MessageFanoutWorker(QueueProcessingWorker):
+    def consume(self, event: Mapping[str, Any]) -> None:
+        do_send_queued_message_events(event)
+
 # We probably could stop running this queue worker at all if ENABLE_FEEDBACK is False
 @assign_queue('feedback_messages')
 class FeedbackBot(QueueProcessingWorker):
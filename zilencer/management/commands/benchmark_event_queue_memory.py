@@ -0,0 +1,98 @@
+import copy
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import EventQueue
+
+def make_message_payload(message_id: int, content_length: int) -> Dict[str, Any]:
+    # Shaped like the output of MessageDict.finalize_payload for a
+    # stream message.
+    content = 'x' * content_length
+    return dict(
+        id=message_id,
+        sender_id=10,
+        sender_email='hamlet@zulip.com',
+        sender_full_name='King Hamlet',
+        sender_short_name='hamlet',
+        sender_realm_str='zulip',
+        sender_is_mirror_dummy=False,
+        avatar_url=None,
+        client='website',
+        content='<p>%s</p>' % (content,),
+        content_type='text/html',
+        display_recipient='Denmark',
+        stream_id=1,
+        recipient_id=2,
+        subject='Verona',
+        topic_links=[],
+        is_me_message=False,
+        reactions=[],
+        submessages=[],
+        timestamp=1500000000,
+        type='stream',
+    )
+
+def measure(build: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    retained = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del retained
+    return after - before
+
+class Command(BaseCommand):
+    help = """Measure the memory used per queued message event in Tornado event queues.
+
+Usage: ./manage.py benchmark_event_queue_memory [--queues=1000] [--messages=100]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--queues', type=int, default=1000,
+                            help='Number of event queues')
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of message events in each queue')
+        parser.add_argument('--content-length', type=int, default=500,
+                            help='Length of the rendered content of each message')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_queues = options['queues']
+        num_messages = options['messages']
+        payloads = [make_message_payload(message_id, options['content_length'])
+                    for message_id in range(num_messages)]
+        flags = ['read']
+
+        def build_legacy(copy_payloads: bool) -> List[List[Dict[str, Any]]]:
+            # The previous representation: one materialized event dict
+            # per event per client.  After a restart, every queue also
+            # had its own copy of each message payload.
+            queues = []
+            for queue_index in range(num_queues):
+                queue = []
+                for event_id, payload in enumerate(payloads):
+                    if copy_payloads:
+                        payload = copy.deepcopy(payload)
+                    queue.append(dict(type='message', message=payload,
+                                      flags=list(flags), id=event_id))
+                queues.append(queue)
+            return queues
+
+        def build_compact() -> List[EventQueue]:
+            queues = []
+            for queue_index in range(num_queues):
+                queue = EventQueue(str(queue_index))
+                for payload in payloads:
+                    queue.push_message(payload, flags)
+                queues.append(queue)
+            return queues
+
+        num_events = num_queues * num_messages
+        results = [
+            ('dict per event', measure(lambda: build_legacy(False))),
+            ('dict per event, restored from disk', measure(lambda: build_legacy(True))),
+            ('compact', measure(build_compact)),
+        ]
+        self.stdout.write('%d queues with %d message events each' % (num_queues, num_messages))
+        for (name, total) in results:
+            self.stdout.write('%-40s %10.1f bytes/event' % (name, total / num_events))
@@ -0,0 +1,45 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.test.utils import override_settings
+
+from zerver.lib.actions import check_send_stream_message
+from zerver.models import get_client, get_realm, get_user
+
+class Command(BaseCommand):
+    help = """Compare the latency of sending a stream message with the post-commit
+fanout done inline and with it handed off to the message_fanout queue
+(ASYNC_MESSAGE_FANOUT).
+
+With RabbitMQ, the queued fanout is done later by the message_fanout
+worker, so only its publish is included in the time measured.
+
+Usage: ./manage.py benchmark_message_fanout [--messages=100] [--stream=Verona]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of messages to send in each mode')
+        parser.add_argument('--stream', type=str, default='Verona',
+                            help='Stream (in the zulip realm) the messages are sent to')
+        parser.add_argument('--sender', type=str, default='hamlet@zulip.com',
+                            help='Email of the sender')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        sender = get_user(options['sender'], get_realm('zulip'))
+        client = get_client('benchmark_message_fanout')
+
+        for async_fanout in [False, True]:
+            timings = []  # type: List[float]
+            with override_settings(ASYNC_MESSAGE_FANOUT=async_fanout):
+                for i in range(options['messages']):
+                    start = time.perf_counter()
+                    check_send_stream_message(sender, client, options['stream'],
+                                              'fanout benchmark', 'message %d' % (i,))
+                    timings.append(time.perf_counter() - start)
+            timings.sort()
+            self.stdout.write('%-6s fanout: mean %6.1fms, p50 %6.1fms, p99 %6.1fms' % (
+                'async' if async_fanout else 'inline',
+                1000 * sum(timings) / len(timings),
+                1000 * timings[len(timings) // 2],
+                1000 * timings[min(len(timings) - 1, len(timings) * 99 // 100)]))
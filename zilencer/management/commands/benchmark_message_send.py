@@ -0,0 +1,210 @@
+import random
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Union
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection, transaction
+
+from zerver.lib import actions
+from zerver.lib.actions import check_send_message, do_create_realm, get_last_message_id
+from zerver.lib.bugdown import get_bugdown_time
+from zerver.lib.bulk_create import bulk_create_streams, bulk_create_users
+from zerver.lib.cache import get_remote_cache_requests, get_remote_cache_time
+from zerver.lib.db import reset_queries
+from zerver.models import Realm, Recipient, Stream, Subscription, UserProfile, \
+    get_client, get_realm
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import allocate_client_descriptor, process_notification
+
+METRICS = ['latency', 'tornado', 'queries', 'db', 'memcached', 'memcached_time', 'bugdown']
+
+def create_benchmark_realm(string_id: str, num_users: int, num_streams: int,
+                           subscribers_per_stream: int,
+                           soft_deactivated_fraction: float) -> Realm:
+    realm = do_create_realm(string_id, 'Benchmark %s' % (string_id,))
+    bulk_create_users(realm, {
+        ('user%d@%s.example.com' % (i, string_id), 'User %d' % (i,), 'user%d' % (i,), True)
+        for i in range(num_users)
+    })
+    bulk_create_streams(realm, {
+        'stream %d' % (i,): dict(description='Benchmark stream %d' % (i,))
+        for i in range(num_streams)
+    })
+
+    rng = random.Random(string_id)
+    user_ids = list(UserProfile.objects.filter(realm=realm).values_list('id', flat=True))
+    recipient_ids = Recipient.objects.filter(
+        type=Recipient.STREAM,
+        type_id__in=Stream.objects.filter(realm=realm).values('id'),
+    ).values_list('id', flat=True)
+    subscriptions = []  # type: List[Subscription]
+    for recipient_id in recipient_ids:
+        for user_id in rng.sample(user_ids, min(subscribers_per_stream, len(user_ids))):
+            subscriptions.append(Subscription(user_profile_id=user_id,
+                                              recipient_id=recipient_id))
+    Subscription.objects.bulk_create(subscriptions)
+
+    # Marked soft-deactivated directly, rather than via
+    # do_soft_deactivate_users, since they have no messages yet.
+    idle_user_ids = rng.sample(user_ids, int(len(user_ids) * soft_deactivated_fraction))
+    UserProfile.objects.filter(id__in=idle_user_ids).update(
+        long_term_idle=True, last_active_message_id=max(get_last_message_id(), 0))
+    return realm
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Command(BaseCommand):
+    help = """Measure the end-to-end cost of sending messages, from check_message
+through do_send_messages to process_message_event in Tornado, in a
+synthetic realm.
+
+The realm is created (with the given sizes) if it doesn't exist yet;
+otherwise the sizes options are ignored.  Tornado's side runs in this
+process, with an event queue for some of the realm's users; work
+handed off to other queue workers isn't included.
+
+For each kind of traffic, reports the p50/p99 latency and the mean
+time spent in Tornado, database queries (count and time), memcached
+requests (count and time) and bugdown per message.
+
+Usage: ./manage.py benchmark_message_send [--realm=benchmark] [--users=1000]
+    [--streams=10] [--subscribers=500] [--soft-deactivated=0.5]
+    [--messages=100] [--traffic=stream,private,huddle]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--realm', type=str, default='benchmark',
+                            help='string_id of the synthetic realm')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Number of users in the realm')
+        parser.add_argument('--streams', type=int, default=10,
+                            help='Number of streams in the realm')
+        parser.add_argument('--subscribers', type=int, default=500,
+                            help='Number of subscribers of each stream')
+        parser.add_argument('--soft-deactivated', type=float, default=0.5,
+                            help='Fraction of the users who are soft-deactivated')
+        parser.add_argument('--queues', type=int, default=100,
+                            help='Number of users with a Tornado event queue')
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of messages to send of each kind')
+        parser.add_argument('--huddle-size', type=int, default=4,
+                            help='Number of recipients of huddle messages')
+        parser.add_argument('--traffic', type=str, default='stream,private,huddle',
+                            help='Comma-separated kinds of messages to send')
+        parser.add_argument('--content', type=str,
+                            default='Benchmark message with **some** `markdown` in it.',
+                            help='Content of the messages')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        try:
+            realm = get_realm(options['realm'])
+        except Realm.DoesNotExist:
+            realm = None
+        if realm is None:
+            with transaction.atomic():
+                realm = create_benchmark_realm(
+                    options['realm'], options['users'], options['streams'],
+                    options['subscribers'], options['soft_deactivated'])
+            self.stdout.write('Created realm %s' % (options['realm'],))
+
+        rng = random.Random(0)
+        client = get_client('benchmark_message_send')
+        users = list(UserProfile.objects.select_related('realm').filter(
+            realm=realm, is_active=True, is_bot=False, long_term_idle=False))
+        streams = list(Stream.objects.filter(realm=realm, deactivated=False))
+        stream_subscriber_emails = {}  # type: Dict[int, List[str]]
+        for stream in streams:
+            stream_subscriber_emails[stream.id] = list(Subscription.objects.filter(
+                recipient__type=Recipient.STREAM, recipient__type_id=stream.id, active=True,
+                user_profile__long_term_idle=False,
+            ).values_list('user_profile__email', flat=True))
+        users_by_email = {user.email: user for user in users}
+
+        def send_stream_message(i: int) -> None:
+            stream = rng.choice([stream for stream in streams
+                                 if stream_subscriber_emails[stream.id]])
+            sender = users_by_email[rng.choice(stream_subscriber_emails[stream.id])]
+            check_send_message(sender, client, 'stream', [stream.name],
+                               'topic %d' % (i % 10,), options['content'])
+
+        def send_private_message(i: int) -> None:
+            (sender, recipient) = rng.sample(users, 2)
+            check_send_message(sender, client, 'private', [recipient.email],
+                               None, options['content'])
+
+        def send_huddle_message(i: int) -> None:
+            huddle = rng.sample(users, options['huddle_size'] + 1)
+            check_send_message(huddle[0], client, 'private',
+                               [user.email for user in huddle[1:]],
+                               None, options['content'])
+
+        senders = dict(
+            stream=send_stream_message,
+            private=send_private_message,
+            huddle=send_huddle_message,
+        )  # type: Dict[str, Callable[[int], None]]
+
+        for user in users[:options['queues']]:
+            allocate_client_descriptor(dict(
+                user_profile_id=user.id,
+                user_profile_email=user.email,
+                realm_id=realm.id,
+                event_types=None,
+                client_type_name='website',
+                apply_markdown=True,
+                client_gravatar=True,
+                all_public_streams=False,
+                queue_timeout=0,
+                narrow=[],
+            ))
+
+        tornado_time = [0.0]
+
+        def send_event_in_process(realm: Realm, event: Mapping[str, Any],
+                                  users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None:
+            start = time.perf_counter()
+            process_notification(dict(event=event, users=list(users)))
+            tornado_time[0] += time.perf_counter() - start
+
+        real_send_event = actions.send_event
+        actions.send_event = send_event_in_process
+        try:
+            for traffic in options['traffic'].split(','):
+                results = {metric: [] for metric in METRICS}  # type: Dict[str, List[float]]
+                for i in range(options['messages']):
+                    reset_queries()
+                    tornado_time[0] = 0.0
+                    remote_cache_time = get_remote_cache_time()
+                    remote_cache_requests = get_remote_cache_requests()
+                    bugdown_time = get_bugdown_time()
+                    start = time.perf_counter()
+
+                    senders[traffic](i)
+
+                    results['latency'].append(time.perf_counter() - start)
+                    results['tornado'].append(tornado_time[0])
+                    queries = connection.connection.queries
+                    results['queries'].append(len(queries))
+                    results['db'].append(sum(float(query.get('time', 0)) for query in queries))
+                    results['memcached'].append(get_remote_cache_requests() - remote_cache_requests)
+                    results['memcached_time'].append(get_remote_cache_time() - remote_cache_time)
+                    results['bugdown'].append(get_bugdown_time() - bugdown_time)
+
+                def mean(metric: str) -> float:
+                    return sum(results[metric]) / len(results[metric])
+                self.stdout.write(
+                    '%-7s p50 %6.1fms  p99 %6.1fms  tornado %5.1fms  '
+                    'db %5.1f queries/%5.1fms  mem %5.1f requests/%5.1fms  bugdown %5.1fms' % (
+                        traffic,
+                        1000 * percentile(results['latency'], 0.5),
+                        1000 * percentile(results['latency'], 0.99),
+                        1000 * mean('tornado'),
+                        mean('queries'), 1000 * mean('db'),
+                        mean('memcached'), 1000 * mean('memcached_time'),
+                        1000 * mean('bugdown')))
+        finally:
+            actions.send_event = real_send_event
+            event_queue.clients.clear()
+            event_queue.user_clients.clear()
+            event_queue.realm_clients_all_streams.clear()
@@ -0,0 +1,61 @@
+import time
+from typing import Any, Dict, List, Sequence
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue
+
+NARROWS = [
+    [],
+    [["stream", "Denmark"]],
+    [["stream", "Denmark"], ["topic", "Verona"]],
+    [["sender", "hamlet@zulip.com"]],
+    [["is", "private"]],
+    [["is", "mentioned"]],
+]  # type: List[List[Sequence[str]]]
+
+def make_message_events(count: int) -> List[Dict[str, Any]]:
+    streams = ["Denmark", "Verona", "Scotland", "Rome"]
+    senders = ["hamlet@zulip.com", "cordelia@zulip.com", "iago@zulip.com"]
+    events = []
+    for i in range(count):
+        if i % 5 == 0:
+            message = dict(type="private", display_recipient=[],
+                           sender_email=senders[i % len(senders)])  # type: Dict[str, Any]
+        else:
+            message = dict(type="stream", display_recipient=streams[i % len(streams)],
+                           subject="Verona" if i % 2 else "other topic",
+                           sender_email=senders[i % len(senders)])
+        flags = ["mentioned"] if i % 7 == 0 else []
+        events.append(dict(type="message", message=message, flags=flags))
+    return events
+
+class Command(BaseCommand):
+    help = """Time ClientDescriptor.accepts_event on synthetic message events for typical narrows.
+
+Usage: ./manage.py benchmark_narrow_filter [--events=100000]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--events', type=int, default=100000,
+                            help='Number of message events to filter per narrow')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        events = make_message_events(options['events'])
+        for narrow in NARROWS:
+            client = ClientDescriptor(
+                user_profile_id=1,
+                user_profile_email="hamlet@zulip.com",
+                realm_id=1,
+                event_queue=EventQueue("benchmark"),
+                event_types=None,
+                client_type_name="website",
+                narrow=narrow,
+            )
+            start = time.perf_counter()
+            accepted = 0
+            for event in events:
+                if client.accepts_event(event):
+                    accepted += 1
+            elapsed = time.perf_counter() - start
+            self.stdout.write("%-55s %7.0f ns/event  (%d accepted)" % (
+                narrow, 1e9 * elapsed / len(events), accepted))
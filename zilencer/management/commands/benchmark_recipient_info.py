@@ -0,0 +1,58 @@
+import time
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from zerver.lib.actions import RecipientInfoTarget, bulk_get_recipient_info, \
+    get_recipient_info
+from zerver.lib.stream_topic import StreamTopicTarget
+from zerver.models import get_realm, get_stream, get_stream_recipient, get_system_bot
+
+class Command(BaseCommand):
+    help = """Compare the database queries needed to compute the recipient info for a
+batch of messages to one stream, one message at a time and in bulk.
+
+Usage: ./manage.py benchmark_recipient_info [--messages=100] [--stream=Verona] [--topics=1]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of messages in the batch')
+        parser.add_argument('--stream', type=str, default='Verona',
+                            help='Stream (in the zulip realm) the messages are sent to')
+        parser.add_argument('--topics', type=int, default=1,
+                            help='Number of topics the messages are spread over')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        stream = get_stream(options['stream'], get_realm('zulip'))
+        recipient = get_stream_recipient(stream.id)
+        sender = get_system_bot('notification-bot@zulip.com')
+        targets = []  # type: List[RecipientInfoTarget]
+        for i in range(options['messages']):
+            targets.append(dict(
+                recipient=recipient,
+                sender_id=sender.id,
+                stream_topic=StreamTopicTarget(
+                    stream_id=stream.id,
+                    topic_name='topic %d' % (i % options['topics'],),
+                ),
+                possibly_mentioned_user_ids=None,
+            ))
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for target in targets:
+                get_recipient_info(
+                    recipient=target['recipient'],
+                    sender_id=target['sender_id'],
+                    stream_topic=target['stream_topic'],
+                )
+            duration = time.perf_counter() - start
+        self.stdout.write('one at a time: %5d queries, %.3fs' % (len(queries), duration))
+
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            bulk_get_recipient_info(targets)
+            duration = time.perf_counter() - start
+        self.stdout.write('bulk:          %5d queries, %.3fs' % (len(queries), duration))
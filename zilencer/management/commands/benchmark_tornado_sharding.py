@@ -0,0 +1,113 @@
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.test import override_settings
+
+from zerver.models import UserProfile
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import allocate_client_descriptor, process_notification
+from zerver.tornado.sharding import get_all_tornado_ports, get_user_shard_port, \
+    shard_event_users
+
+def make_message_event(message_id: int, realm_id: int) -> Dict[str, Any]:
+    # Shaped like the event do_send_messages sends for a stream message.
+    message_dict = dict(
+        id=message_id,
+        sender_id=1,
+        sender_email='hamlet@zulip.com',
+        sender_full_name='King Hamlet',
+        sender_short_name='hamlet',
+        sender_realm_id=realm_id,
+        sender_realm_str='zulip',
+        sender_avatar_source=UserProfile.AVATAR_FROM_GRAVATAR,
+        sender_avatar_version=1,
+        sender_is_mirror_dummy=False,
+        client='website',
+        content='hello',
+        rendered_content='<p>hello</p>',
+        display_recipient='Denmark',
+        raw_display_recipient='Denmark',
+        recipient_type=2,
+        recipient_type_id=1,
+        stream_id=1,
+        recipient_id=2,
+        subject='Verona',
+        topic_links=[],
+        is_me_message=False,
+        reactions=[],
+        submessages=[],
+        timestamp=1500000000,
+        type='stream',
+    )
+    return dict(type='message', message_dict=message_dict, realm_id=realm_id,
+                stream_name='Denmark', invite_only=False, presence_idle_user_ids=[])
+
+def reset_event_queues() -> None:
+    event_queue.clients.clear()
+    event_queue.user_clients.clear()
+    event_queue.realm_clients_all_streams.clear()
+    event_queue.gc_heap.clear()
+
+class Command(BaseCommand):
+    help = """Estimate Tornado message throughput for a single large realm as a function
+of the number of user shards (TORNADO_SHARDING = 'user').
+
+Each shard's share of the fanout for a burst of stream messages is
+processed in turn in this process; since shards run in parallel, the
+slowest one bounds the throughput.
+
+Usage: ./manage.py benchmark_tornado_sharding [--users=10000] [--messages=100]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--users', type=int, default=10000,
+                            help='Number of subscribers, each with one event queue')
+        parser.add_argument('--messages', type=int, default=100,
+                            help='Number of stream messages to send')
+        parser.add_argument('--shards', type=str, default='1,2,4,8',
+                            help='Comma-separated numbers of shards to test')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm_id = 1
+        user_ids = list(range(1, options['users'] + 1))
+        events = [make_message_event(message_id, realm_id)
+                  for message_id in range(options['messages'])]
+        users = [dict(id=user_id, flags=[]) for user_id in user_ids]
+
+        for num_shards in [int(n) for n in options['shards'].split(',')]:
+            with override_settings(TORNADO_PROCESSES=num_shards, TORNADO_SHARDING='user'):
+                shard_times = self.time_shards(realm_id, events, user_ids, users)
+
+            slowest = max(shard_times)
+            self.stdout.write('%2d shards: slowest shard %.3fs, %8.1f messages/s' % (
+                num_shards, slowest, len(events) / slowest))
+
+    def time_shards(self, realm_id: int, events: List[Dict[str, Any]], user_ids: List[int],
+                    users: List[Dict[str, Any]]) -> List[float]:
+        # Split the recipients of each event as send_event does.
+        users_by_port_for_events = [shard_event_users(event, users) for event in events]
+
+        shard_times = []  # type: List[float]
+        for port in get_all_tornado_ports():
+            reset_event_queues()
+            for user_id in user_ids:
+                if get_user_shard_port(user_id) == port:
+                    allocate_client_descriptor(dict(
+                        user_profile_id=user_id,
+                        user_profile_email='user%d@zulip.com' % (user_id,),
+                        realm_id=realm_id,
+                        event_types=None,
+                        client_type_name='website',
+                        apply_markdown=True,
+                        client_gravatar=True,
+                        all_public_streams=False,
+                        queue_timeout=0,
+                        narrow=[],
+                    ))
+
+            start = time.perf_counter()
+            for (event, users_by_port) in zip(events, users_by_port_for_events):
+                process_notification(dict(event=event, users=users_by_port.get(port, [])))
+            shard_times.append(time.perf_counter() - start)
+        reset_event_queues()
+        return shard_times
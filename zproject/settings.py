@@ -415,6 +415,23 @@ DEFAULT_SETTINGS.update({
     # Hostname used for Zulip's statsd logging integration.
     'STATSD_HOST': '',
 
+    # How Tornado saves event queues across restarts: 'json' (one
+    # JSON file, fully loaded at startup) or 'snapshot' (a binary
+    # snapshot whose queues are loaded as they are first used, which
+    # restarts much faster on servers with many queues).
+    'TORNADO_QUEUE_PERSISTENCE': 'json',
+
+    # Maximum number of events an event queue may hold (e.g. for a
+    # client that stopped polling but whose queue hasn't expired);
+    # past that, the events are replaced with a restart event telling
+    # the client to reload.  None means no limit.
+    'EVENT_QUEUE_MAX_EVENTS': None,
+
+    # Whether do_send_messages hands the work that follows saving the
+    # messages (sending events, triggering bots, etc.) to the
+    # message_fanout queue worker, so that senders don't wait for it.
+    'ASYNC_MESSAGE_FANOUT': False,
+
     # Configuration for JWT auth.
     'JWT_AUTH_KEYS': {},
 
@@ -596,6 +613,9 @@ CORPORATE_ENABLED = 'corporate' in INSTALLED_APPS
 # We set it to None when running backend tests or populate_db.
 # We override the port number when running frontend tests.
 TORNADO_PROCESSES = int(get_config('application_server', 'tornado_processes', 1))
+# With multiple Tornado processes, 'realm' handles each realm in a
+# single process; 'user' spreads each realm's users across all of them.
+TORNADO_SHARDING = get_config('application_server', 'tornado_sharding', 'realm')
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
 AUTORELOAD = DEBUG
@@ -975,6 +995,7 @@ ZULIP_PATHS = [
     ("MANAGEMENT_LOG_PATH", "/var/log/zulip/manage.log"),
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("JSON_PERSISTENT_QUEUE_FILENAME_PATTERN", "/home/zulip/tornado/event_queues%s.json"),
+    ("SNAPSHOT_PERSISTENT_QUEUE_FILENAME_PATTERN", "/home/zulip/tornado/event_queues%s.snapshot"),
     ("EMAIL_LOG_PATH", "/var/log/zulip/send_email.log"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email_mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
@@ -201,6 +201,8 @@ v1_api_and_json_patterns = [
         {'GET': 'zerver.views.messages.get_message_edit_history'}),
     url(r'^messages/matches_narrow$', rest_dispatch,
         {'GET': 'zerver.views.messages.messages_in_narrow_backend'}),
+    url(r'^messages/batches$', rest_dispatch,
+        {'GET': 'zerver.views.messages.get_message_batches_backend'}),
 
     url(r'^users/me/subscriptions/properties$', rest_dispatch,
         {'POST': 'zerver.views.streams.update_subscription_properties_backend'}),
@@ -697,6 +699,8 @@ for app_name in settings.EXTRA_INSTALLED_APPS:
 urls += [
     # Used internally for communication between Django and Tornado processes
     url(r'^notify_tornado$', zerver.tornado.views.notify, name='zerver.tornado.views.notify'),
+    # Used by monitoring to poll the state of the event queues
+    url(r'^tornado_stats$', zerver.tornado.views.get_tornado_stats),
     url(r'^api/v1/events/internal$', zerver.tornado.views.get_events_internal),
 ]
 